@@ -0,0 +1,126 @@
+import hashlib
+import re
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from models import db, CachedAnswer
+
+# --- TAチャットの回答キャッシュ ---
+# 同じ授業・同じスライドでは、生徒は似た質問（「この式の意味は？」など）を繰り返す。
+# キーは (課題ID, スライド本文のハッシュ, 正規化した質問)。完全一致しなければ、同じスライドの
+# キャッシュから文字bigramの類似度が閾値以上の質問を探す。TTLと件数上限(LRU)で古いものを捨てる。
+# ★回答はDB(CachedAnswer)に保存するので、gunicorn の全ワーカーで共有され、先生の「消去」も全ワーカーに効く。
+# ヒット・ミスの回数はワーカーごとに数える（stats() の entries / stored_hits は全体の値）。
+
+_KATAKANA = re.compile('[ァ-ヶ]')
+_NUMBERS = re.compile(r'[0-9a-z]+')
+
+
+def normalize_question(question):
+    """全角/半角・カタカナ/ひらがな・大文字/小文字・空白・句読点の違いを吸収する"""
+    text = unicodedata.normalize('NFKC', question or '').lower()
+    text = _KATAKANA.sub(lambda m: chr(ord(m.group(0)) - 0x60), text)
+    return ''.join(ch for ch in text if not ch.isspace() and not unicodedata.category(ch).startswith('P'))
+
+
+def _bigrams(text):
+    if len(text) < 2: return {text}
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def similarity(a, b):
+    """文字bigramのJaccard係数"""
+    if not a or not b: return 0.0
+    return len(a & b) / len(a | b)
+
+
+MAX_CANDIDATES = 200  # 類似の質問を探すときに読む、同じスライドの回答の上限
+
+
+class AnswerCache:
+    def __init__(self, max_entries=2000, ttl=24 * 3600, threshold=0.7):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "similar_hits": 0, "misses": 0}
+
+    def init_app(self, app):
+        self.max_entries = int(app.config.get('ANSWER_CACHE_MAX_ENTRIES', self.max_entries))
+        self.ttl = float(app.config.get('ANSWER_CACHE_TTL', self.ttl))
+        self.threshold = float(app.config.get('ANSWER_CACHE_SIMILARITY', self.threshold))
+
+    @staticmethod
+    def _slide_hash(context):
+        return hashlib.sha256((context or '').encode('utf-8')).hexdigest()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _find(self, assignment_id, context, question):
+        normalized = normalize_question(question)
+        rows = (CachedAnswer.query
+                .filter_by(assignment_id=assignment_id, slide_hash=self._slide_hash(context))
+                .filter(CachedAnswer.expires_at > datetime.utcnow())
+                .order_by(CachedAnswer.last_used_at.desc()).limit(MAX_CANDIDATES).all())
+        for row in rows:
+            if row.question == normalized: return row, 'hits'
+        # 同じスライドの質問の中から最も似ているものを探す
+        # 「問1」と「問2」のように数字や記号名だけが違う質問は別物として扱う
+        grams, tokens = _bigrams(normalized), frozenset(_NUMBERS.findall(normalized))
+        best, best_score = None, self.threshold
+        for row in rows:
+            if frozenset(_NUMBERS.findall(row.question)) != tokens: continue
+            score = similarity(grams, _bigrams(row.question))
+            if score >= best_score:
+                best, best_score = row, score
+        return best, 'similar_hits'
+
+    def get(self, assignment_id, context, question):
+        """キャッシュ済みの回答（なければ None）。ヒットの記録はその場でコミットする"""
+        row, kind = self._find(assignment_id, context, question)
+        if row is None:
+            self._count("misses")
+            return None
+        self._count(kind)
+        CachedAnswer.query.filter_by(id=row.id).update(
+            {"hits": CachedAnswer.hits + 1, "last_used_at": datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        return row.answer
+
+    def put(self, assignment_id, context, question, answer):
+        """回答を保存する（同じトランザクションで、コミットは呼び出し側）"""
+        keys = dict(assignment_id=assignment_id, slide_hash=self._slide_hash(context), question=normalize_question(question))
+        now = datetime.utcnow()
+        values = dict(answer=answer, expires_at=now + timedelta(seconds=self.ttl), last_used_at=now)
+        try:
+            with db.session.begin_nested():
+                if not CachedAnswer.query.filter_by(**keys).update(values, synchronize_session=False):
+                    db.session.add(CachedAnswer(**keys, **values))
+        except IntegrityError:
+            pass  # 同時に別のワーカーが同じ質問を保存した
+        self._evict(now)
+
+    def _evict(self, now):
+        CachedAnswer.query.filter(CachedAnswer.expires_at <= now).delete(synchronize_session=False)
+        excess = CachedAnswer.query.count() - self.max_entries
+        if excess > 0:
+            oldest = db.session.query(CachedAnswer.id).order_by(CachedAnswer.last_used_at).limit(excess)
+            CachedAnswer.query.filter(CachedAnswer.id.in_(oldest.scalar_subquery())).delete(synchronize_session=False)
+
+    def clear(self, assignment_id=None):
+        """課題ごと（None なら全体）のキャッシュを消去し、消した件数を返す"""
+        query = CachedAnswer.query if assignment_id is None else CachedAnswer.query.filter_by(assignment_id=assignment_id)
+        count = query.delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    def stats(self):
+        entries, stored_hits = db.session.query(db.func.count(CachedAnswer.id), db.func.coalesce(db.func.sum(CachedAnswer.hits), 0)).one()
+        with self._lock:
+            return dict(self.counters, entries=entries, stored_hits=stored_hits)
+
+
+cache = AnswerCache()
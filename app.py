@@ -2,84 +2,184 @@ import os
 import json
 import base64
 import traceback
-from datetime import datetime, date, timedelta
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
-import google.generativeai as genai
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, session, jsonify, flash, Response, stream_with_context
+import click
 from dotenv import load_dotenv
-from models import db, User, Assignment, Report, LessonLog, GradingLog, QuizLog
-
-# Google連携用ライブラリ
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+from sqlalchemy.orm import joinedload
+from models import db, User, Assignment, Report, LessonLog, GradingLog, QuizLog, GeneratedContent, CalendarSyncStatus, ensure_schema, insert_or_get, SQLITE_ENGINE_OPTIONS
+import gen_cache
+import assignment_stats
+import log_archive
+import log_export
+from pagination import keyset_page
+import llm
+import metrics
+import upload_cache
+import answer_cache
+import chat_memory
+import rendering
+from jobs import GradingJobQueue, QueueFull, job_to_dict
+from calendar_sync import CalendarSyncEngine, run_sync, claim_sync, status_to_dict
+# Google連携用ライブラリは google_services の中で、使うときに import する
+import google_services
 
 load_dotenv()
 
-app = Flask(__name__)
-app.secret_key = 'kosen_pbl_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///kosen.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-# 画像アップロード用に128MBまで許可
-app.config['MAX_CONTENT_LENGTH'] = 128 * 1024 * 1024
-
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
 
-db.init_app(app)
-
-try:
-    genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-except KeyError:
-    print("エラー: GOOGLE_API_KEYが設定されていません。")
-
-# --- ★モデル設定（Gemini 3 Preview に変更） ---
-try:
-    # 採点・スライド生成用: 高精度な Gemini 3 Pro
-    model_pro = genai.GenerativeModel('gemini-3-pro-preview')
-    
-    # チャット・即答用: 高速な Gemini 3 Flash
-    model_flash = genai.GenerativeModel('gemini-3-flash-preview')
-except Exception as e:
-    print(f"モデル初期化エラー: {e}")
-    # フォールバック（万が一Gemini 3が使えない場合）
-    model_pro = genai.GenerativeModel('gemini-1.5-pro')
-    model_flash = genai.GenerativeModel('gemini-1.5-flash')
-
-# --- Google OAuth設定 ---
-CLIENT_SECRETS_FILE = "client_secret.json"
-SCOPES = [
-    'openid',
-    'https://www.googleapis.com/auth/userinfo.email',
-    'https://www.googleapis.com/auth/userinfo.profile',
-    'https://www.googleapis.com/auth/classroom.courses.readonly',
-    'https://www.googleapis.com/auth/classroom.coursework.me.readonly',
-    'https://www.googleapis.com/auth/calendar'
-]
-
-with app.app_context():
+# ルートはすべてこの Blueprint に登録し、create_app() でアプリに組み込む
+bp = Blueprint('main', __name__, cli_group=None)
+grading_jobs = GradingJobQueue()
+
+# --- ★アプリケーションファクトリ ---
+# import 時には設定とルートの登録だけを行い、重い処理は最初に必要になったときまで遅らせる。
+#   - Gemini のクライアント: 最初のモデル呼び出し時（llm.get_backend）
+#   - Google API のライブラリとディスカバリー文書: Google連携のリクエスト時（google_services）
+#   - テーブル作成と初期ユーザーの登録: flask init-db で明示的に行う
+def create_app(config=None):
+    app = Flask(__name__)
+    app.secret_key = 'kosen_pbl_secret_key'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///kosen.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # ★古いログのアーカイブ先（別ファイル）。ARCHIVE_AFTER_DAYS 日より前のログを flask archive-logs で移す
+    app.config['ARCHIVE_DATABASE_URL'] = os.environ.get('ARCHIVE_DATABASE_URL', 'sqlite:///kosen_archive.db')
+    app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+    # 画像アップロード用に128MBまで許可
+    app.config['MAX_CONTENT_LENGTH'] = 128 * 1024 * 1024
+    # アップロード画像のキャッシュ先（未指定なら instance/upload_cache）
+    app.config['UPLOAD_CACHE_DIR'] = os.environ.get('UPLOAD_CACHE_DIR')
+    # Classroom の課題一覧を並行取得するスレッド数
+    app.config['CALENDAR_SYNC_WORKERS'] = int(os.environ.get('CALENDAR_SYNC_WORKERS', 4))
+    # 授業の生成後に確認テストをバックグラウンドで事前生成するか（QUIZ_PREGENERATE=0 で無効）
+    app.config['QUIZ_PREGENERATE'] = os.environ.get('QUIZ_PREGENERATE', '1') not in ('0', 'false')
+    app.config['QUIZ_PREGENERATE_WORKERS'] = int(os.environ.get('QUIZ_PREGENERATE_WORKERS', 2))
+    # 確認テストを1問ずつ並行採点するスレッド数と、形式が崩れた応答の再採点回数
+    app.config['QUIZ_GRADING_WORKERS'] = int(os.environ.get('QUIZ_GRADING_WORKERS', 8))
+    app.config['QUIZ_GRADING_RETRIES'] = int(os.environ.get('QUIZ_GRADING_RETRIES', 2))
+    # 採点ジョブのワーカー数と待機できるジョブ数
+    app.config['GRADING_WORKERS'] = int(os.environ.get('GRADING_WORKERS', 4))
+    app.config['GRADING_MAX_PENDING'] = int(os.environ.get('GRADING_MAX_PENDING', 32))
+    # ★事前にビルドした CSS（static/ からの相対パス）。未指定でも static/css/app.css があれば使い、無ければ Tailwind の CDN を使う
+    app.config['STATIC_CSS'] = os.environ.get('STATIC_CSS') or (
+        'css/app.css' if os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'css', 'app.css')) else None)
+    # 描画済みスライドをブラウザがキャッシュしてよい秒数（ETag で再検証する）
+    app.config['RENDERED_MAX_AGE'] = int(os.environ.get('RENDERED_MAX_AGE', 3600))
+    # ★非同期モード(asgi.py)でDBアクセスに使うスレッド数と、Flaskのままのルートを処理するスレッド数
+    app.config['ASYNC_DB_THREADS'] = int(os.environ.get('ASYNC_DB_THREADS', 16))
+    app.config['ASYNC_WSGI_THREADS'] = int(os.environ.get('ASYNC_WSGI_THREADS', 8))
+    # ★TAチャットの文脈の予算（推定トークン数）、そのまま残す直近のやりとりの件数、古いやりとりの要約の上限
+    app.config['CHAT_CONTEXT_TOKENS'] = int(os.environ.get('CHAT_CONTEXT_TOKENS', 2000))
+    app.config['CHAT_RECENT_TURNS'] = int(os.environ.get('CHAT_RECENT_TURNS', 4))
+    app.config['CHAT_SUMMARY_TOKENS'] = int(os.environ.get('CHAT_SUMMARY_TOKENS', 300))
+    app.config['CHAT_SUMMARY_WORKERS'] = int(os.environ.get('CHAT_SUMMARY_WORKERS', 2))
+
+    # --- ★メトリクス ---
+    # /metrics で Prometheus 形式のメトリクスを公開する。SERVER_TIMING=1 で Server-Timing ヘッダーを付ける
+    # gunicorn の複数ワーカーで動かすときは METRICS_DIR に共有ディレクトリを指定すると全ワーカー分を合算する
+    app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '') in ('1', 'true')
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+    # --- ★LLMバックエンド設定 ---
+    # gemini: 実API (採点・スライド生成は Gemini 3 Pro、チャットは Gemini 3 Flash) / stub: 負荷試験用のローカルスタブ
+    # レート制限などのスケジューラ設定も LLM_PRO_RPM / LLM_FLASH_MAX_INFLIGHT などの環境変数で上書きできる
+    app.config['LLM_BACKEND'] = 'gemini'
+    for key, value in os.environ.items():
+        if key.startswith('LLM_'): app.config[key] = value
+    if config: app.config.update(config)
+
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = SQLITE_ENGINE_OPTIONS
+    archive_url = app.config['ARCHIVE_DATABASE_URL']
+    app.config['SQLALCHEMY_BINDS'] = {'archive': dict(url=archive_url, **SQLITE_ENGINE_OPTIONS) if archive_url.startswith('sqlite') else archive_url}
+
+    db.init_app(app)
+    metrics.init_app(app)
+    grading_jobs.init_app(app)
+    # モデルのクライアントは最初の呼び出し時に作る
+    llm.init_app(app)
+    upload_cache.cache.init_app(app)
+    answer_cache.cache.init_app(app)
+    app.add_template_filter(rendering.markdown_filter, 'markdown')
+    app.register_blueprint(bp)
+    return app
+
+def init_db():
+    """テーブルを作成・更新し、初期ユーザーを登録する（何度実行しても安全）"""
     db.create_all()
+    ensure_schema()
     if not User.query.filter_by(username='sensei').first():
         db.session.add(User(username='sensei', role='teacher'))
         db.session.add(User(username='gakusei', role='student'))
         db.session.commit()
 
+# 確認テストの事前生成・採点用のスレッドプール（最初に使うときに設定に合わせて作る）
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool(name, size_key):
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(max_workers=current_app.config[size_key], thread_name_prefix=name)
+        return _pools[name]
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """テーブルを作成し、初期ユーザー(sensei / gakusei)を登録する"""
+    init_db()
+    print("データベースを初期化しました。")
+
+@bp.cli.command('upgrade-db')
+def upgrade_db_command():
+    """既存のデータベースに不足している列・インデックスを追加する"""
+    db.create_all()
+    ensure_schema()
+    print("データベースを更新しました。")
+
+@bp.cli.command('archive-logs')
+@click.option('--days', type=int, default=None, help='この日数より前のログを移す（既定: ARCHIVE_AFTER_DAYS）')
+@click.option('--vacuum', is_flag=True, help='移動後にデータベースファイルを縮小する')
+def archive_logs_command(days, vacuum):
+    """古い授業・確認テスト・採点ログをアーカイブDBへ移す"""
+    moved = log_archive.archive_logs(days if days is not None else current_app.config['ARCHIVE_AFTER_DAYS'])
+    for table, count in moved.items(): print(f"{table}: {count}件をアーカイブしました。")
+    if vacuum: log_archive.vacuum()
+
+@bp.cli.command('compress-logs')
+@click.option('--vacuum', is_flag=True, help='圧縮後にデータベースファイルを縮小する')
+def compress_logs_command(vacuum):
+    """圧縮保存を導入する前の平文の行を圧縮し直す"""
+    print(f"{log_archive.compress_existing()}件を圧縮しました。")
+    if vacuum: log_archive.vacuum()
+
+@bp.cli.command('rebuild-stats')
+@click.option('--assignment-id', type=int, default=None, help='指定した課題だけ作り直す')
+def rebuild_stats_command(assignment_id):
+    """LessonLog / QuizLog から課題ごとの集計を作り直す（既存データの取り込み用）"""
+    count = assignment_stats.rebuild(assignment_id)
+    print(f"{count}件の課題の集計を作り直しました。")
+
 # --- ルート処理 ---
 
-@app.route('/')
+@bp.route('/')
 def index():
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('.login'))
     user = User.query.get(session['user_id'])
     if not user:
         session.clear()
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     if user.role == 'teacher':
-        return redirect(url_for('teacher_dashboard'))
+        return redirect(url_for('.teacher_dashboard'))
     else:
-        return redirect(url_for('student_dashboard'))
+        return redirect(url_for('.student_dashboard'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -87,32 +187,32 @@ def login():
         if user:
             session['user_id'] = user.id
             session['role'] = user.role
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
-@app.route('/google_login')
+@bp.route('/google_login')
 def google_login():
-    if not os.path.exists(CLIENT_SECRETS_FILE):
+    if not os.path.exists(google_services.CLIENT_SECRETS_FILE):
         return "エラー: client_secret.json が見つかりません。", 500
-    flow = Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, redirect_uri=url_for('oauth2callback', _external=True))
+    flow = google_services.oauth_flow(url_for('.oauth2callback', _external=True))
     authorization_url, state = flow.authorization_url(access_type='offline', include_granted_scopes='true', prompt='consent')
     session['state'] = state
     return redirect(authorization_url)
 
-@app.route('/oauth2callback')
+@bp.route('/oauth2callback')
 def oauth2callback():
     state = session.get('state')
-    if not state: return redirect(url_for('login'))
+    if not state: return redirect(url_for('.login'))
     try:
-        flow = Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, state=state, redirect_uri=url_for('oauth2callback', _external=True))
+        flow = google_services.oauth_flow(url_for('.oauth2callback', _external=True), state=state)
         flow.fetch_token(authorization_response=request.url)
         creds = flow.credentials
-        user_info = build('oauth2', 'v2', credentials=creds).userinfo().get().execute()
+        user_info = google_services.build_service('oauth2', 'v2', creds).userinfo().get().execute()
         email = user_info.get('email')
         user = User.query.filter_by(username=email).first()
         if not user:
@@ -122,277 +222,702 @@ def oauth2callback():
         db.session.commit()
         session['user_id'] = user.id
         session['role'] = user.role
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     except Exception as e:
         return f"認証エラー: {str(e)}", 500
 
-@app.route('/sync_calendar')
+def _calendar_engine(user_id):
+    user = User.query.get(user_id)
+    creds, refreshed = google_services.load_credentials(user.google_credentials)
+    if refreshed:
+        user.google_credentials = creds.to_json()
+        db.session.commit()
+    return CalendarSyncEngine(lambda: google_services.build_service('classroom', 'v1', creds),
+                              google_services.build_service('calendar', 'v3', creds),
+                              max_workers=current_app.config['CALENDAR_SYNC_WORKERS'])
+
+def _sync_calendar_in_background(app, user_id):
+    with app.app_context():
+        run_sync(user_id, lambda: _calendar_engine(user_id), claimed=True)
+
+@bp.route('/sync_calendar')
 def sync_calendar():
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('.login'))
     user = User.query.get(session['user_id'])
     if not user.google_credentials: return "Google連携されていません。"
-    try:
-        creds = Credentials.from_authorized_user_info(json.loads(user.google_credentials), SCOPES)
-        if creds.expired and creds.refresh_token: creds.refresh(Request())
-        
-        classroom = build('classroom', 'v1', credentials=creds)
-        calendar = build('calendar', 'v3', credentials=creds)
-        courses = classroom.courses().list(studentId='me', courseStates=['ACTIVE']).execute().get('courses', [])
-        
-        sync_count = 0
-        cutoff = date.today() - timedelta(days=7)
-        
-        for c in courses:
-            works = classroom.courses().courseWork().list(courseId=c['id']).execute().get('courseWork', [])
-            for w in works:
-                if 'dueDate' in w:
-                    d = w['dueDate']
-                    if not (d.get('year') and d.get('month') and d.get('day')): continue
-                    if date(d['year'], d['month'], d['day']) < cutoff: continue
-                    
-                    dt = f"{d['year']}-{d['month']:02d}-{d['day']:02d}"
-                    body = {
-                        'summary': f"【課題】{w['title']} ({c['name']})",
-                        'description': f"リンク: {w['alternateLink']}\n{w.get('description','')}",
-                        'start': {'date': dt}, 'end': {'date': dt}
-                    }
-                    try:
-                        calendar.events().insert(calendarId='primary', body=body).execute()
-                        sync_count += 1
-                    except: pass
-        flash(f"{sync_count}件同期しました", "success")
-        return redirect(url_for('student_dashboard'))
-    except Exception as e: return f"同期エラー: {e}", 500
-
-@app.route('/teacher')
+    if request.args.get('wait'):
+        # ?wait=1 のときは完了まで待って結果を表示する
+        status = run_sync(user.id, lambda: _calendar_engine(user.id))
+        if status is None:
+            flash("カレンダー同期は実行中です", "success")
+            return redirect(url_for('.student_dashboard'))
+        if status.status == 'error' and not (status.inserted or status.updated):
+            return f"同期エラー: {status.message}", 500
+        flash(f"{status.inserted}件追加・{status.updated}件更新しました", "success")
+        return redirect(url_for('.student_dashboard'))
+    # 通常はバックグラウンドで同期し、進捗はダッシュボードから確認する
+    # 実行中かの確認と開始の予約は claim_sync() が1つの UPDATE で行う（同時に押されても同期は1つだけ）
+    if claim_sync(user.id):
+        threading.Thread(target=_sync_calendar_in_background, args=(current_app._get_current_object(), user.id), daemon=True).start()
+        flash("カレンダー同期を開始しました", "success")
+    else:
+        flash("カレンダー同期は実行中です", "success")
+    return redirect(url_for('.student_dashboard'))
+
+@bp.route('/api/calendar_sync/status')
+def calendar_sync_status_api():
+    if 'user_id' not in session: return jsonify({"error": "ログインしてください"}), 401
+    return jsonify(status_to_dict(CalendarSyncStatus.query.get(session['user_id'])))
+
+# --- ダッシュボードの一覧（必要な行だけをSQLで絞り込み、キーセットで少しずつ読み込む） ---
+DASHBOARD_PAGE_SIZE = 12
+
+# セクション名: (閲覧できるロール, ユーザーIDからクエリを作る関数, モデル, 部分テンプレート)
+DASHBOARD_SECTIONS = {
+    'teacher_assignments': ('student', lambda uid: Assignment.query.join(Assignment.creator).filter(User.role == 'teacher'),
+                            Assignment, '_student_teacher_cards.html'),
+    'self_study': ('student', lambda uid: Assignment.query.filter_by(created_by=uid), Assignment, '_student_self_cards.html'),
+    'my_assignments': ('teacher', lambda uid: Assignment.query.filter_by(created_by=uid).options(joinedload(Assignment.stats)),
+                       Assignment, '_teacher_assignment_cards.html'),
+    'grading_logs': ('teacher', lambda uid: GradingLog.query.options(joinedload(GradingLog.student)), GradingLog, '_grading_log_rows.html'),
+}
+
+def _dashboard_page(section, cursor=None):
+    _, make_query, model, _ = DASHBOARD_SECTIONS[section]
+    items, next_cursor = keyset_page(make_query(session['user_id']), model, cursor, DASHBOARD_PAGE_SIZE)
+    # 採点結果のHTMLはテンプレートで1行ずつ引かず、ページ分をまとめて読み込んでおく
+    if model is GradingLog: rendering.preload(log.feedback_content for log in items)
+    return items, next_cursor
+
+@bp.route('/dashboard/more/<section>')
+def dashboard_more(section):
+    if section not in DASHBOARD_SECTIONS: return "", 404
+    role, _, _, template = DASHBOARD_SECTIONS[section]
+    if session.get('role') != role: return "", 403
+    items, next_cursor = _dashboard_page(section, request.args.get('cursor'))
+    headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+    return render_template(template, items=items), 200, headers
+
+@bp.route('/teacher')
 def teacher_dashboard():
-    if session.get('role') != 'teacher': return redirect(url_for('index'))
-    my_assignments = Assignment.query.filter_by(created_by=session['user_id']).order_by(Assignment.created_at.desc()).all()
-    logs = GradingLog.query.order_by(GradingLog.created_at.desc()).limit(20).all()
-    return render_template('teacher_dashboard.html', assignments=my_assignments, logs=logs)
+    if session.get('role') != 'teacher': return redirect(url_for('.index'))
+    my_assignments, assignments_cursor = _dashboard_page('my_assignments')
+    logs, logs_cursor = _dashboard_page('grading_logs')
+    return render_template('teacher_dashboard.html', assignments=my_assignments, logs=logs,
+                           assignments_cursor=assignments_cursor, logs_cursor=logs_cursor)
 
-@app.route('/create_assignment', methods=['POST'])
+@bp.route('/create_assignment', methods=['POST'])
 def create_assignment():
-    if session.get('role') != 'teacher': return redirect(url_for('index'))
+    if session.get('role') != 'teacher': return redirect(url_for('.index'))
     title = request.form['title']
     description = request.form['description']
     new_assignment = Assignment(title=title, description=description, created_by=session['user_id'])
     db.session.add(new_assignment)
     db.session.commit()
-    return redirect(url_for('teacher_dashboard'))
+    # 事前生成: 生徒が開く前に授業スライドを共有キャッシュへ作っておく
+    if request.form.get('prewarm'):
+        threading.Thread(target=_prewarm_lesson, args=(current_app._get_current_object(), new_assignment.id), daemon=True).start()
+    return redirect(url_for('.teacher_dashboard'))
 
-@app.route('/student')
+@bp.route('/student')
 def student_dashboard():
-    if session.get('role') != 'student': return redirect(url_for('index'))
+    if session.get('role') != 'student': return redirect(url_for('.index'))
     user = User.query.get(session['user_id'])
-    all_assignments = Assignment.query.order_by(Assignment.created_at.desc()).all()
-    teacher_assignments = [a for a in all_assignments if a.creator.role == 'teacher']
-    my_lessons = [a for a in all_assignments if a.created_by == user.id]
+    teacher_assignments, teacher_cursor = _dashboard_page('teacher_assignments')
+    my_lessons, self_cursor = _dashboard_page('self_study')
     is_google_linked = True if user.google_credentials else False
-    return render_template('student_dashboard.html', teacher_assignments=teacher_assignments, my_lessons=my_lessons, is_google_linked=is_google_linked)
+    sync_status = status_to_dict(CalendarSyncStatus.query.get(user.id)) if is_google_linked else None
+    return render_template('student_dashboard.html', teacher_assignments=teacher_assignments, my_lessons=my_lessons, is_google_linked=is_google_linked,
+                           teacher_cursor=teacher_cursor, self_cursor=self_cursor, sync_status=sync_status)
 
-@app.route('/create_self_study', methods=['POST'])
+@bp.route('/create_self_study', methods=['POST'])
 def create_self_study():
-    if session.get('role') != 'student': return redirect(url_for('index'))
+    if session.get('role') != 'student': return redirect(url_for('.index'))
     title = request.form['title']
     description = request.form['description']
     new_lesson = Assignment(title=title, description=description, created_by=session['user_id'])
     db.session.add(new_lesson)
     db.session.commit()
-    return redirect(url_for('student_dashboard'))
+    return redirect(url_for('.student_dashboard'))
 
-@app.route('/lesson_page/<int:assignment_id>')
+@bp.route('/lesson_page/<int:assignment_id>')
 def lesson_page(assignment_id):
     assignment = Assignment.query.get_or_404(assignment_id)
     if session.get('role') == 'student':
         if assignment.creator.role != 'teacher' and assignment.created_by != session['user_id']:
-            return redirect(url_for('student_dashboard'))
-    lesson_log = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=session['user_id']).first()
-    saved_slides = lesson_log.slides_content if lesson_log else None
-    return render_template('lesson.html', assignment=assignment, saved_slides=saved_slides)
-
-@app.route('/api/generate_lesson', methods=['POST'])
-def generate_lesson_api():
-    data = request.json
-    assignment_id = data.get('assignment_id')
-    user_id = session.get('user_id')
-    existing = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=user_id).first()
-    if existing: return jsonify({"slides": existing.slides_content})
-    assignment = Assignment.query.get(assignment_id)
-    prompt = f"""
+            return redirect(url_for('.student_dashboard'))
+    # 保存済みのスライドはページに埋め込まず、ブラウザにキャッシュされる /api/lesson_slides から読み込む
+    has_saved = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=session['user_id']).first() is not None
+    return render_template('lesson.html', assignment=assignment, has_saved_slides=has_saved)
+
+# ★描画済みスライド（Markdown と HTML）。内容が変わらない限り ETag が一致するので 304 で返せる
+@bp.route('/api/lesson_slides/<int:assignment_id>')
+def lesson_slides_api(assignment_id):
+    lesson_log = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=session.get('user_id')).first()
+    if not lesson_log: return jsonify({"error": "授業がまだ生成されていません"}), 404
+    text = lesson_log.slides
+    etag = rendering.render_key(text, slides=True)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        _, html = rendering.render(text, slides=True)
+        db.session.commit()
+        response = jsonify({"slides": rendering.split_slides(text), "html": html})
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['RENDERED_MAX_AGE']
+    return response
+
+# スライドの区切り文字（プロンプトとクライアント側の分割処理で共通）
+SLIDE_BREAK = rendering.SLIDE_BREAK
+
+def _error_response(e):
+    """LLMが混雑・障害で一時的に使えない場合は 503 + Retry-After、それ以外は 500"""
+    if isinstance(e, llm.LLMUnavailable):
+        return jsonify({"error": str(e)}), 503, {'Retry-After': str(e.retry_after)}
+    return jsonify({"error": str(e)}), 500
+
+def _sse(event, payload):
+    """Server-Sent Events 形式の1イベント分の文字列を作る"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def _sse_response(generator):
+    return Response(generator, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # nginx等のバッファリングを無効化
+    })
+
+def _replay_slides(text):
+    """保存済みスライドをストリームと同じ形式で一括送信する（HTMLは保存時に変換済み）
+
+    DBを読むのでジェネレータにせず、リクエスト中にイベントを組み立てておく。
+    """
+    slides = rendering.split_slides(text)
+    _, html = rendering.render(text, slides=True)
+    db.session.commit()  # この機能より前のログは、ここで初めて変換したものを保存する
+    events = [_sse('slide', {"index": i, "markdown": slide, "html": slide_html}) for i, (slide, slide_html) in enumerate(zip(slides, html))]
+    return events + [_sse('done', {"count": len(slides)})]
+
+def build_lesson_prompt(assignment):
+    # プロンプトは課題のタイトルと説明文だけで決まるので、同じ課題の生徒間で生成結果を共有できる
+    return f"""
     あなたは高専の教員です。以下のテーマについて、高専生向けの講義スライドをMarkdown形式で**5枚**作成してください。
     テーマ: {assignment.title}
     詳細指示: {assignment.description}
-    要件: Markdown形式, 区切りは `---SLIDE_BREAK---`, 数式はLaTeX形式($$ ... $$)
+    要件: Markdown形式, 区切りは `{SLIDE_BREAK}`, 数式はLaTeX形式($$ ... $$)
     """
+
+def _save_lesson_log(assignment_id, user_id, content):
+    """生徒ごとのLessonLogは本文をコピーせず共有キャッシュを参照する"""
+    # スライドのHTMLもここで一度だけ変換し、ログと同じコミットで保存する（同じ本文なら変換済みを使う）
+    rendering.render(content.content, slides=True)
+    log = insert_or_get(LessonLog, {"assignment_id": assignment_id, "student_id": user_id}, content_id=content.id,
+                        on_insert=lambda row: assignment_stats.record_lesson(assignment_id, user_id))
+    _schedule_quiz_pregeneration(assignment_id, user_id)
+    return log
+
+def _prewarm_lesson(app, assignment_id):
+    with app.app_context():
+        try:
+            prompt = build_lesson_prompt(Assignment.query.get(assignment_id))
+            gen_cache.get_or_generate(llm.model_name('pro'), prompt,
+                                      lambda: llm.generate('pro', prompt, priority='batch', allow_fallback=False),
+                                      assignment_id=assignment_id)
+        except Exception as e:
+            print(f"授業の事前生成エラー: {e}")
+
+# --- 授業生成の各段階（同期のルートと asgi.py の非同期ルートで共通） ---
+def _find_lesson(assignment_id, user_id):
+    """保存済みまたは共有キャッシュ済みなら (本文, None)、生成が必要なら (None, プロンプト) を返す"""
+    existing = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=user_id).first()
+    if existing: return existing.slides, None
+    prompt = build_lesson_prompt(Assignment.query.get(assignment_id))
+    cached = gen_cache.lookup(gen_cache.cache_key(llm.model_name('pro'), prompt))
+    if cached:
+        _save_lesson_log(assignment_id, user_id, cached)
+        return cached.content, None
+    return None, prompt
+
+def _join_lesson(assignment_id, user_id, content_id):
+    """共有キャッシュの本文を生徒のログに紐づけ、本文を返す"""
+    content = GeneratedContent.query.get(content_id)
+    _save_lesson_log(assignment_id, user_id, content)
+    return content.content
+
+def _lesson_content_id(key):
+    row = gen_cache.lookup(key)
+    return row.id if row else None
+
+def _store_lesson(key, model_name, text, assignment_id):
+    return gen_cache.store(key, model_name, text, assignment_id).id
+
+def _take_slides(buffer, final=False):
+    """ストリームのバッファから完成したスライドを取り出し、(スライドのリスト, 残りのバッファ) を返す"""
+    *done, rest = buffer.split(SLIDE_BREAK)
+    if final: done, rest = done + [rest], ''
+    return [s.strip() for s in done if s.strip()], rest
+
+def _slide_event(index, slide):
+    return _sse('slide', {"index": index, "markdown": slide, "html": rendering.render_markdown(slide)})
+
+def _stream_lesson(prompt, assignment_id, user_id):
+    """生成中のテキストを区切り文字で分割し、完成したスライドから順に送信する"""
+    model_name = llm.model_name('pro')
+    key = gen_cache.cache_key(model_name, prompt)
+    call, leader = gen_cache.flight.begin(key)
+    if not leader:
+        # 同じ授業を生成中の別リクエストがあれば、その完了を待って結果を共有する
+        try:
+            text = _join_lesson(assignment_id, user_id, call.wait())
+        except Exception as e:
+            db.session.rollback()
+            yield _sse('error', {"error": str(e)})
+            return
+        yield from _replay_slides(text)
+        return
+
+    full_text = []
+    buffer = ''
+    index = 0
     try:
-        res = model_pro.generate_content(prompt)
-        text = res.text
-        db.session.add(LessonLog(assignment_id=assignment_id, student_id=user_id, slides_content=text))
-        db.session.commit()
-        return jsonify({"slides": text})
-    except Exception as e: return jsonify({"error": str(e)}), 500
+        # 共有キャッシュに残るので、pro が不調でも flash への切り替えはしない
+        for text in llm.stream('pro', prompt, allow_fallback=False):
+            full_text.append(text)
+            slides, buffer = _take_slides(buffer + text)
+            for slide in slides:
+                yield _slide_event(index, slide)
+                index += 1
+        for slide in _take_slides(buffer, final=True)[0]:
+            yield _slide_event(index, slide)
+            index += 1
+        # ストリーム完了後に全文を共有キャッシュへ保存し、生徒のログから参照する
+        content_id = _store_lesson(key, model_name, ''.join(full_text), assignment_id)
+        gen_cache.flight.finish(key, call, result=content_id)
+        _join_lesson(assignment_id, user_id, content_id)
+        yield _sse('done', {"count": index})
+    except Exception as e:
+        db.session.rollback()
+        if not call.event.is_set(): gen_cache.flight.finish(key, call, error=e)
+        yield _sse('error', {"error": str(e)})
+    finally:
+        # クライアントが切断して途中で止まった場合(GeneratorExit)も、合流して待っている他のリクエストを解放する
+        if not call.event.is_set(): gen_cache.flight.finish(key, call, error=llm.LLMError("授業の生成が中断されました"))
+
+def _slides_payload(text):
+    _, html = rendering.render(text, slides=True)
+    db.session.commit()
+    return {"slides": text, "html": html}
+
+def _wants_stream(data, accept):
+    # stream=true または Accept: text/event-stream の場合はSSEで1枚ずつ返す
+    return bool(data.get('stream')) or 'text/event-stream' in (accept or '')
 
-@app.route('/api/ask_teacher', methods=['POST'])
+@bp.route('/api/generate_lesson', methods=['POST'])
+def generate_lesson_api():
+    data = request.json
+    assignment_id = data.get('assignment_id')
+    user_id = session.get('user_id')
+    wants_stream = _wants_stream(data, request.headers.get('Accept'))
+    text, prompt = _find_lesson(assignment_id, user_id)
+    if text is not None:
+        if wants_stream: return _sse_response(_replay_slides(text))
+        return jsonify(_slides_payload(text))
+    if wants_stream:
+        return _sse_response(stream_with_context(_stream_lesson(prompt, assignment_id, user_id)))
+    try:
+        content = gen_cache.get_or_generate(llm.model_name('pro'), prompt,
+                                            lambda: llm.generate('pro', prompt, allow_fallback=False),
+                                            assignment_id=assignment_id)
+        return jsonify(_slides_payload(_join_lesson(assignment_id, user_id, content.id)))
+    except Exception as e: return _error_response(e)
+
+def _answer_payload(answer, cached=False):
+    payload = {"answer": answer, "answer_html": rendering.render_html(answer, persist=False)}
+    if cached: payload["cached"] = True
+    return payload
+
+# --- ★TAチャット（生徒×授業ごとの会話） ---
+# 会話は chat_memory.py がDBに保存し、予算内の文脈（スライド構成・現在のスライド・要約・直近のやりとり）を組み立てる。
+# 回答キャッシュは会話の最初の質問にだけ使う（2問目以降は前のやりとり次第で答えが変わるため）。
+def _chat_prepare(assignment_id, user_id, question, slide_index=None, context=''):
+    """モデルを呼ぶ前の準備。cached があればモデルを呼ばずにそれを回答とする"""
+    # 授業に紐づかない質問（文脈だけが送られてきたもの）は会話を保存しない
+    chat = chat_memory.get_session(assignment_id, user_id) if assignment_id is not None else None
+    lesson_log = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=user_id).first() if chat else None
+    slides = rendering.split_slides(lesson_log.slides) if lesson_log else []
+    if not isinstance(slide_index, int) or not 0 <= slide_index < len(slides): slide_index = None
+    # スライド番号が無い古い画面・ベンチマークからは、従来どおり送られてきた文脈を使う
+    slide_text = slides[slide_index] if slide_index is not None else context or ''
+    turns = chat_memory.unsummarized_turns(chat) if chat else []
+    summary = chat.summary if chat else ''
+    first_turn = not turns and not summary
+    prompt, tokens = chat_memory.build_prompt(
+        question, slide_text, slides, slide_index, summary, turns,
+        budget=current_app.config['CHAT_CONTEXT_TOKENS'], max_turns=current_app.config['CHAT_RECENT_TURNS'])
+    cached = answer_cache.cache.get(assignment_id, slide_text, question) if first_turn else None
+    return {"session_id": chat.id if chat else None, "assignment_id": assignment_id, "slide_index": slide_index, "slide_text": slide_text,
+            "question": question, "prompt": prompt, "prompt_tokens": tokens, "first_turn": first_turn, "cached": cached,
+            "pending": len(turns) + 1}
+
+def _chat_finish(chat, answer):
+    """回答を会話に記録し、必要なら古いやりとりの要約をバックグラウンドで更新する"""
+    cached = chat["cached"] is not None
+    if chat["first_turn"] and not cached: answer_cache.cache.put(chat["assignment_id"], chat["slide_text"], chat["question"], answer)
+    turn = chat_memory.add_turn(chat["session_id"], chat["slide_index"], chat["question"], answer) if chat["session_id"] else None
+    db.session.commit()
+    # 直近として残す件数を超えた分は要約に畳み込む
+    if turn and chat["pending"] > current_app.config['CHAT_RECENT_TURNS']:
+        _pool('chat-summary', 'CHAT_SUMMARY_WORKERS').submit(_fold_chat_summary, current_app._get_current_object(), chat["session_id"])
+    payload = _answer_payload(answer, cached=cached)
+    payload.update(turn_id=turn.id if turn else None, prompt_tokens=chat["prompt_tokens"])
+    return payload
+
+def _fold_chat_summary(app, session_id):
+    call, leader = gen_cache.flight.begin(('chat-summary', session_id))
+    if not leader: return  # 同じ会話の要約は実行中のものに任せる（次の質問のあとで続きを畳み込む）
+    with app.app_context():
+        try:
+            generate = lambda prompt: llm.generate('flash', prompt, priority='batch')
+            while chat_memory.fold_summary(session_id, app.config['CHAT_RECENT_TURNS'], app.config['CHAT_SUMMARY_TOKENS'], generate): pass
+        except Exception as e:
+            db.session.rollback()
+            print(f"チャットの要約エラー: {e}")
+        finally:
+            gen_cache.flight.finish(('chat-summary', session_id), call, result=None)
+
+@bp.route('/api/ask_teacher', methods=['POST'])
 def ask_teacher_api():
     data = request.json
-    prompt = f"高専の教員として回答して。\n文脈: {data.get('context','')}\n質問: {data.get('question')}\n数式を用いて解説して。"
+    user_id = session.get('user_id')
+    if user_id is None: return jsonify({"error": "ログインしてください"}), 401
+    chat = _chat_prepare(data.get('assignment_id'), user_id, data.get('question') or '', data.get('slide_index'), data.get('context', ''))
     try:
-        return jsonify({"answer": model_flash.generate_content(prompt).text})
-    except Exception as e: return jsonify({"error": str(e)}), 500
+        answer = chat["cached"] if chat["cached"] is not None else llm.generate('flash', chat["prompt"], priority='interactive')
+        return jsonify(_chat_finish(chat, answer))
+    except Exception as e: return _error_response(e)
 
-@app.route('/quiz_page/<int:assignment_id>')
+@bp.route('/api/chat_session/<int:assignment_id>', methods=['GET', 'DELETE'])
+def chat_session_api(assignment_id):
+    """GET: 画面を開き直したときに会話を復元する / DELETE: 会話をリセットする"""
+    user_id = session.get('user_id')
+    if user_id is None: return jsonify({"error": "ログインしてください"}), 401
+    if request.method == 'DELETE': return jsonify({"deleted": chat_memory.reset(assignment_id, user_id)})
+    return jsonify({"turns": [{"id": t.id, "slide_index": t.slide_index, "question": t.question,
+                               "answer_html": rendering.render_html(t.answer, persist=False)}
+                              for t in chat_memory.history(assignment_id, user_id)]})
+
+@bp.route('/api/answer_cache/clear', methods=['POST'])
+def clear_answer_cache_api():
+    if session.get('role') != 'teacher': return jsonify({"error": "権限がありません"}), 403
+    assignment = Assignment.query.get_or_404((request.json or {}).get('assignment_id'))
+    if assignment.created_by != session['user_id']: return jsonify({"error": "権限がありません"}), 403
+    return jsonify({"cleared": answer_cache.cache.clear(assignment.id)})
+
+@bp.route('/api/answer_cache/stats')
+def answer_cache_stats_api():
+    if session.get('role') != 'teacher': return jsonify({"error": "権限がありません"}), 403
+    return jsonify(answer_cache.cache.stats())
+
+@bp.route('/quiz_page/<int:assignment_id>')
 def quiz_page(assignment_id):
-    if session.get('role') != 'student': return redirect(url_for('index'))
+    if session.get('role') != 'student': return redirect(url_for('.index'))
     assignment = Assignment.query.get_or_404(assignment_id)
     lesson_log = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=session['user_id']).first()
-    slides_content = lesson_log.slides_content if lesson_log else "（授業スライドがまだ生成されていません）"
+    slides_content = lesson_log.slides if lesson_log else "（授業スライドがまだ生成されていません）"
     return render_template('quiz.html', assignment=assignment, slides_content=slides_content)
 
-@app.route('/api/generate_quiz', methods=['POST'])
-def generate_quiz_api():
-    data = request.json
-    assignment_id = data.get('assignment_id')
-    user_id = session['user_id']
+# --- ★確認テストの事前生成 ---
+# 授業(LessonLog)を保存した時点で、その生徒の確認テストをバックグラウンドで低優先度で作っておく。
+# 生徒がテストを開いたときに生成中なら、同じ single-flight に合流して完了を待つ。
+quiz_pregen_counter = metrics.registry.counter('quiz_pregenerate_total', '確認テストの事前生成と利用の件数', ('event',))
+
+def build_quiz_prompt(slides):
+    return f"""
+    以下の講義スライドに基づいて、学生の理解度を確認するための**記述式問題を3問**作成してください。
+    【スライド内容】{slides}
+    【出力】純粋なJSON配列: [{{"q_id": 1, "question": "..."}}, ...]
+    """
+
+def _clean_json(text):
+    return text.replace('```json','').replace('```','').strip()
+
+def _save_quiz(assignment_id, user_id, text, pregenerated=False):
+    json.loads(text) # 不正なJSONは保存しない
+    return insert_or_get(QuizLog, {"assignment_id": assignment_id, "student_id": user_id}, questions=text, pregenerated=pregenerated).id
+
+def _get_or_create_quiz(assignment_id, user_id, slides, priority='normal', pregenerated=False):
+    """確認テストを作って QuizLog のIDを返す。同じ生徒の生成が重なってもモデル呼び出しは1回にまとめる"""
+    def produce():
+        text = _clean_json(llm.generate('pro', build_quiz_prompt(slides), priority=priority))
+        return _save_quiz(assignment_id, user_id, text, pregenerated)
+    return gen_cache.flight.do(('quiz', assignment_id, user_id), produce)
+
+def _schedule_quiz_pregeneration(assignment_id, user_id):
+    if not current_app.config['QUIZ_PREGENERATE']: return
+    _pool('quiz-pregen', 'QUIZ_PREGENERATE_WORKERS').submit(_pregenerate_quiz, current_app._get_current_object(), assignment_id, user_id)
+
+def _pregenerate_quiz(app, assignment_id, user_id):
+    with app.app_context():
+        try:
+            if QuizLog.query.filter_by(assignment_id=assignment_id, student_id=user_id).first(): return
+            lesson_log = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=user_id).first()
+            if not lesson_log: return
+            _get_or_create_quiz(assignment_id, user_id, lesson_log.slides, priority='batch', pregenerated=True)
+            quiz_pregen_counter.inc(event='generated')
+        except Exception as e:
+            db.session.rollback()
+            quiz_pregen_counter.inc(event='failed')
+            print(f"確認テストの事前生成エラー: {e}")
+
+def _mark_quiz_opened(quiz, event):
+    # 事前生成したテストが実際に開かれた回数を数える（2回目以降のアクセスは数えない）
+    if not quiz.pregenerated or quiz.opened_at: return
+    quiz.opened_at = datetime.utcnow()
+    db.session.commit()
+    quiz_pregen_counter.inc(event=event)
+
+def _questions_payload(quiz):
+    """問題文にも採点結果と同じ変換をかけたHTMLを添える"""
+    return [dict(q, question_html=rendering.render_html(q['question'], persist=False)) for q in json.loads(quiz.questions)]
+
+def _find_quiz(assignment_id, user_id):
+    """作成済みなら (応答内容, None)、未作成なら (None, スライド本文)、授業を受けていなければ (None, None)"""
     existing_quiz = QuizLog.query.filter_by(assignment_id=assignment_id, student_id=user_id).first()
     if existing_quiz:
-        return jsonify({
+        _mark_quiz_opened(existing_quiz, 'used_ready')
+        return {
             "quiz_id": existing_quiz.id, 
-            "questions": json.loads(existing_quiz.questions),
+            "questions": _questions_payload(existing_quiz),
             "student_answers": json.loads(existing_quiz.student_answers) if existing_quiz.student_answers else None,
             "grading_result": existing_quiz.grading_result
-        })
+        }, None
     lesson_log = LessonLog.query.filter_by(assignment_id=assignment_id, student_id=user_id).first()
-    if not lesson_log: return jsonify({"error": "先に授業を受けてください"}), 400
-    prompt = f"""
-    以下の講義スライドに基づいて、学生の理解度を確認するための**記述式問題を3問**作成してください。
-    【スライド内容】{lesson_log.slides_content}
-    【出力】純粋なJSON配列: [{{"q_id": 1, "question": "..."}}, ...]
+    return None, lesson_log.slides if lesson_log else None
+
+def _joined_quiz_payload(quiz_id):
+    quiz = QuizLog.query.get(quiz_id)
+    _mark_quiz_opened(quiz, 'used_joined')
+    return {"quiz_id": quiz.id, "questions": _questions_payload(quiz)}
+
+@bp.route('/api/generate_quiz', methods=['POST'])
+def generate_quiz_api():
+    data = request.json
+    assignment_id = data.get('assignment_id')
+    user_id = session['user_id']
+    payload, slides = _find_quiz(assignment_id, user_id)
+    if payload: return jsonify(payload)
+    if slides is None: return jsonify({"error": "先に授業を受けてください"}), 400
+    try:
+        # 事前生成の途中なら、その完了を待つ
+        return jsonify(_joined_quiz_payload(_get_or_create_quiz(assignment_id, user_id, slides)))
+    except Exception as e: return _error_response(e)
+
+@bp.route('/api/quiz_pregenerate/stats')
+def quiz_pregenerate_stats_api():
+    if session.get('role') != 'teacher': return jsonify({"error": "権限がありません"}), 403
+    pregenerated = QuizLog.query.filter_by(pregenerated=True)
+    return jsonify({
+        "enabled": current_app.config['QUIZ_PREGENERATE'],
+        "pregenerated": pregenerated.count(),
+        "used": pregenerated.filter(QuizLog.opened_at.isnot(None)).count(),
+    })
+
+# --- ★確認テストの採点（1問ずつ並行して採点し、点数をJSONで受け取る） ---
+# 全問を1つのプロンプトにまとめず、問題ごとに json_mode で呼び出して並行に待つ。
+# 採点時間は全問の合計ではなく最も遅い1問分になり、QuizLog.score に平均点を保存できる。
+
+def build_quiz_grading_prompt(question, answer):
+    return f"""
+    高専の教員として、確認テストの1問分の回答を採点・解説してください。
+    問題: {question}
+    回答: {answer}
+    【出力】純粋なJSONオブジェクト: {{"score": 0から100の整数, "feedback": "Markdown形式の解説（数式はLaTeX形式）"}}
     """
+
+UNANSWERED = {"score": 0, "feedback": "未回答です。"}
+
+def _parse_question_grade(text, attempt):
+    """採点結果のJSONを {"score", "feedback"} にする。形式が崩れていれば None"""
     try:
-        res = model_pro.generate_content(prompt)
-        text = res.text.replace('```json','').replace('```','').strip()
-        new_quiz = QuizLog(assignment_id=assignment_id, student_id=user_id, questions=text)
-        db.session.add(new_quiz)
-        db.session.commit()
-        return jsonify({"quiz_id": new_quiz.id, "questions": json.loads(text)})
-    except Exception as e: return jsonify({"error": str(e)}), 500
+        result = json.loads(_clean_json(text))
+        return {"score": max(0, min(100, int(result['score']))), "feedback": str(result.get('feedback', ''))}
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"採点結果の形式エラー（{attempt + 1}回目）: {e}")
+        return None
+
+def _grade_quiz_question(question, answer, retries):
+    """1問を採点して {"score", "feedback"} を返す。形式が崩れた応答のときだけこの問題を再採点する"""
+    if not answer or not answer.strip(): return UNANSWERED
+    prompt = build_quiz_grading_prompt(question, answer)
+    for attempt in range(retries + 1):
+        # 上流の一時的なエラーはスケジューラがリトライする
+        result = _parse_question_grade(llm.generate('pro', prompt, json_mode=True), attempt)
+        if result is not None: return result
+    raise _grade_unreadable()
+
+def _grade_unreadable():
+    return llm.LLMError("採点結果を読み取れませんでした。もう一度お試しください。")
+
+def quiz_score(results):
+    """各問の点数の平均（問題が無ければ0点）"""
+    return round(sum(r['score'] for r in results) / len(results)) if results else 0
+
+def format_quiz_grading(results):
+    lines = [f"**合計: {quiz_score(results)}点**\n"]
+    for r in results:
+        lines.append(f"### 問{r['q_id']}（{r['score']}点）\n\n{r['feedback']}\n")
+    return '\n'.join(lines)
+
+def _save_quiz_grading(quiz_id, user_id, answers, results):
+    quiz_log = QuizLog.query.get(quiz_id)
+    result_text = format_quiz_grading(results)
+    previous_score = quiz_log.score if quiz_log.grading_result is not None else None
+    quiz_log.student_answers = json.dumps(answers)
+    quiz_log.grading_result = result_text
+    quiz_log.score = quiz_score(results)
+    # 課題ごとの集計も同じトランザクションで更新する
+    assignment_stats.record_quiz_graded(quiz_log.assignment_id, quiz_log.score, previous_score, quiz_log.student_id)
+    result_html = rendering.render_html(result_text)
+    # ここはテキストのみなので保存OK
+    db.session.add(GradingLog(student_id=user_id, mode='quiz', input_text=f"確認テスト: {quiz_log.assignment.title}", feedback_content=result_text))
+    db.session.commit()
+    return {"result": result_text, "result_html": result_html, "score": quiz_log.score, "questions": results}
 
-@app.route('/api/grade_quiz', methods=['POST'])
+@bp.route('/api/grade_quiz', methods=['POST'])
 def grade_quiz_api():
     data = request.json
     quiz_log = QuizLog.query.get(data.get('quiz_id'))
-    answers = data.get('answers')
+    if quiz_log is None: return jsonify({"error": "テストが見つかりません"}), 404
+    answers = data.get('answers') or {}
     questions = json.loads(quiz_log.questions)
-    prompt = "高専の教員として回答を採点・解説してください。\n\n"
-    for q in questions:
-        prompt += f"問{q['q_id']}: {q['question']}\n回答: {answers.get(str(q['q_id']), '未回答')}\n\n"
+    if not questions: return jsonify({"error": "このテストには問題がありません"}), 400
     try:
-        res = model_pro.generate_content(prompt)
-        quiz_log.student_answers = json.dumps(answers)
-        quiz_log.grading_result = res.text
-        db.session.commit()
-        # ここはテキストのみなので保存OK
-        db.session.add(GradingLog(student_id=session['user_id'], mode='quiz', input_text=f"確認テスト: {quiz_log.assignment.title}", feedback_content=res.text))
-        db.session.commit()
-        return jsonify({"result": res.text})
-    except Exception as e: return jsonify({"error": str(e)}), 500
+        pool, retries = _pool('quiz-grading', 'QUIZ_GRADING_WORKERS'), current_app.config['QUIZ_GRADING_RETRIES']
+        futures = [pool.submit(_grade_quiz_question, q['question'], answers.get(str(q['q_id']), ''), retries) for q in questions]
+        results = [dict(f.result(), q_id=q['q_id']) for q, f in zip(questions, futures)]
+        return jsonify(_save_quiz_grading(quiz_log.id, session['user_id'], answers, results))
+    except Exception as e: return _error_response(e)
 
-@app.route('/tools')
+@bp.route('/tools')
 def tools_page(): return render_template('free_tools.html')
 
 # --- ★マルチパート対応 & Gemini 3 Pro 採点API ---
-@app.route('/api/general_grading', methods=['POST'])
-def general_grading_api():
-    print("--- 採点APIが呼び出されました ---")
+class GradingInputError(ValueError):
+    pass
+
+def _build_grading_contents(form=None, files=None, user_id=None):
+    """form(テキスト)とfiles(ファイル)からGeminiへ送る内容を組み立てる（省略時は request.form / request.files）"""
+    form = request.form if form is None else form
+    files = request.files if files is None else files
+    mode = form.get('mode')
+    log = current_app.logger
+    log.debug("モード: %s, UserID: %s", mode, session.get('user_id') if user_id is None else user_id)
     
-    try:
-        # JSONではなく、request.form(テキスト)とrequest.files(ファイル)で受け取る
-        mode = request.form.get('mode')
-        user_id = session.get('user_id')
-        print(f"モード: {mode}, UserID: {user_id}")
-        
-        contents = []
-        log_input_text = ""
+    contents = []
+    log_input_text = ""
 
-        if mode == 'report':
-            text_content = request.form.get('text_content', '')
-            contents = ["あなたは高専の教員です。以下のレポートを添削してください。", f"レポート本文:\n{text_content}"]
+    if mode == 'report':
+        text_content = form.get('text_content', '')
+        contents = ["あなたは高専の教員です。以下のレポートを添削してください。", f"レポート本文:\n{text_content}"]
+        log_input_text = text_content
+        
+    elif mode == 'problem':
+        system_prompt = """
+        あなたは高専の教員です。以下に「問題（または模範解答）」と「生徒の解答」の画像が提示されます。
+        【指示】
+        1. まず「問題画像」を読み取り、どのような問題が出されているか理解してください。
+        2. 次に「生徒の解答画像」を見て、採点を行ってください。
+        3. 生徒の解答には「問1」「Q2」などの番号が書かれています。**問題画像のどの問題に対応するかを紐づけて**採点してください。
+        4. 模範解答がない場合は、あなたの専門知識に基づいて正誤判定と解説を行ってください。
+        """
+        contents.append(system_prompt)
+        contents.append("\n=== 【A. 問題・模範解答セクション】 ===")
+        
+        model_answer_text = form.get('model_answer', '')
+        if model_answer_text: contents.append(f"補足テキスト: {model_answer_text}")
+        
+        # files.getlist()で複数ファイルを直接リストとして取得
+        problem_files = files.getlist('problem_images')
+        log.debug("問題ファイル数: %d", len(problem_files))
+        
+        if problem_files:
+            contents.append("以下は「問題」または「模範解答」の画像です：")
+            for i, f in enumerate(problem_files):
+                if f.filename == '': continue
+                log.debug("  - 問題画像処理中: %s (%s)", f.filename, f.mimetype)
+                # クラス全員が同じ画像を送るので、内容のハッシュで1つにまとめてリモートに1回だけアップロードする
+                contents.append(f"Problem Image {i+1}")
+                contents.append(upload_cache.cache.spool(f, shared=True))
+
+        contents.append("\n=== 【B. 生徒の解答セクション】 ===")
+        text_content = form.get('text_content', '')
+        if text_content: 
+            contents.append(f"生徒の補足テキスト: {text_content}")
             log_input_text = text_content
-            
-        elif mode == 'problem':
-            system_prompt = """
-            あなたは高専の教員です。以下に「問題（または模範解答）」と「生徒の解答」の画像が提示されます。
-            【指示】
-            1. まず「問題画像」を読み取り、どのような問題が出されているか理解してください。
-            2. 次に「生徒の解答画像」を見て、採点を行ってください。
-            3. 生徒の解答には「問1」「Q2」などの番号が書かれています。**問題画像のどの問題に対応するかを紐づけて**採点してください。
-            4. 模範解答がない場合は、あなたの専門知識に基づいて正誤判定と解説を行ってください。
-            """
-            contents.append(system_prompt)
-            contents.append("\n=== 【A. 問題・模範解答セクション】 ===")
-            
-            model_answer_text = request.form.get('model_answer', '')
-            if model_answer_text: contents.append(f"補足テキスト: {model_answer_text}")
-            
-            # files.getlist()で複数ファイルを直接リストとして取得
-            problem_files = request.files.getlist('problem_images')
-            print(f"問題ファイル数: {len(problem_files)}")
-            
-            if problem_files:
-                contents.append("以下は「問題」または「模範解答」の画像です：")
-                for i, f in enumerate(problem_files):
-                    if f.filename == '': continue
-                    print(f"  - 問題画像処理中: {f.filename} ({f.mimetype})")
-                    file_data = {
-                        "mime_type": f.mimetype or "image/jpeg",
-                        "data": f.read() # バイナリ読み込み
-                    }
-                    contents.append(f"Problem Image {i+1}")
-                    contents.append(file_data)
-
-            contents.append("\n=== 【B. 生徒の解答セクション】 ===")
-            text_content = request.form.get('text_content', '')
-            if text_content: 
-                contents.append(f"生徒の補足テキスト: {text_content}")
-                log_input_text = text_content
-            
-            student_files = request.files.getlist('student_images')
-            print(f"生徒ファイル数: {len(student_files)}")
-            
-            if student_files:
-                contents.append("以下は「生徒が解いた解答」の画像です。問題番号(Q1など)を探して採点してください：")
-                for i, f in enumerate(student_files):
-                    if f.filename == '': continue
-                    print(f"  - 生徒画像処理中: {f.filename} ({f.mimetype})")
-                    file_data = {
-                        "mime_type": f.mimetype or "image/jpeg",
-                        "data": f.read()
-                    }
-                    contents.append(f"Student Answer Image {i+1}")
-                    contents.append(file_data)
-            
-            # バリデーション
-            has_problems = any(f.filename != '' for f in problem_files)
-            has_students = any(f.filename != '' for f in student_files)
-            if not has_problems and not has_students and not text_content:
-                 return jsonify({"error": "画像またはテキストが入力されていません。"}), 400
-
-        print("Geminiへデータを送信します...")
-        # Geminiへのリクエスト (gemini-3-pro-preview を使用)
-        response = model_pro.generate_content(contents)
-        result_text = response.text
-        print("Geminiから応答がありました")
         
-        # ログ保存（画像はDBに保存せず、テキストのみ保存する）
-        db.session.add(GradingLog(
-            student_id=user_id, mode=mode, input_text=log_input_text, 
-            input_image=None, feedback_content=result_text
-        ))
+        student_files = files.getlist('student_images')
+        log.debug("生徒ファイル数: %d", len(student_files))
+        
+        if student_files:
+            contents.append("以下は「生徒が解いた解答」の画像です。問題番号(Q1など)を探して採点してください：")
+            for i, f in enumerate(student_files):
+                if f.filename == '': continue
+                log.debug("  - 生徒画像処理中: %s (%s)", f.filename, f.mimetype)
+                # メモリには読み込まずディスクへ書き出し、モデル呼び出しの直前に読む
+                contents.append(f"Student Answer Image {i+1}")
+                contents.append(upload_cache.cache.spool(f))
+        
+        # バリデーション
+        has_problems = any(f.filename != '' for f in problem_files)
+        has_students = any(f.filename != '' for f in student_files)
+        if not has_problems and not has_students and not text_content:
+            upload_cache.cache.release(contents)
+            raise GradingInputError("画像またはテキストが入力されていません。")
+
+    return mode, contents, log_input_text
+
+def _grade_and_log(user_id, mode, contents, log_input_text, priority='normal'):
+    """Geminiで採点し、GradingLogをセッションに追加して結果テキストを返す（コミットは呼び出し側）"""
+    current_app.logger.debug("Geminiへデータを送信します...")
+    # Geminiへのリクエスト (gemini-3-pro-preview を使用)
+    try:
+        result_text = llm.generate('pro', contents, priority=priority)
+    finally:
+        # 生徒の解答画像はこの採点にしか使わないので、成否にかかわらずすぐ消す
+        upload_cache.cache.release(contents)
+    current_app.logger.debug("Geminiから応答がありました")
+    _add_grading_log(user_id, mode, log_input_text, result_text)
+    return result_text
+
+def _add_grading_log(user_id, mode, log_input_text, result_text):
+    # ログ保存（画像はDBに保存せず、テキストのみ保存する）
+    db.session.add(GradingLog(
+        student_id=user_id, mode=mode, input_text=log_input_text, 
+        input_image=None, feedback_content=result_text
+    ))
+    # 結果画面と先生の詳細表示で使うHTMLもログと同じコミットで保存する
+    rendering.render(result_text)
+
+def _commit_grading_log(user_id, mode, log_input_text, result_text):
+    _add_grading_log(user_id, mode, log_input_text, result_text)
+    db.session.commit()
+    return {"result": result_text, "result_html": rendering.render_html(result_text)}
+
+@bp.route('/api/general_grading', methods=['POST'])
+def general_grading_api():
+    print("--- 採点APIが呼び出されました ---")
+    
+    try:
+        mode, contents, log_input_text = _build_grading_contents()
+        result_text = _grade_and_log(session.get('user_id'), mode, contents, log_input_text)
         db.session.commit()
         
-        return jsonify({"result": result_text})
+        return jsonify({"result": result_text, "result_html": rendering.render_html(result_text)})
 
+    except GradingInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except llm.LLMUnavailable as e:
+        return _error_response(e)
     except Exception as e:
         error_trace = traceback.format_exc()
         print("！！！サーバー内部エラー！！！")
@@ -403,9 +928,56 @@ def general_grading_api():
             "trace": error_trace
         }), 500
 
-@app.route('/switch_role')
+# --- ★非同期採点ジョブAPI（投入するとすぐにジョブIDを返し、結果はポーリングで取得） ---
+@bp.route('/api/grading_jobs', methods=['POST'])
+def submit_grading_job_api():
+    if 'user_id' not in session: return jsonify({"error": "ログインしてください"}), 401
+    user_id = session['user_id']
+    try:
+        mode, contents, log_input_text = _build_grading_contents()
+    except GradingInputError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        job_id = grading_jobs.submit(user_id, mode, _grade_and_log, user_id, mode, contents, log_input_text, 'batch')
+    except QueueFull:
+        upload_cache.cache.release(contents)
+        return jsonify({"error": "採点が混み合っています。しばらくしてから再度送信してください。"}), 503, {'Retry-After': '10'}
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": url_for('.grading_job_status_api', job_id=job_id)}), 202
+
+@bp.route('/api/grading_jobs/<job_id>')
+def grading_job_status_api(job_id):
+    job = grading_jobs.get(job_id)
+    if not job or job.student_id != session.get('user_id'):
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    payload = job_to_dict(job)
+    if job.result is not None: payload["result_html"] = rendering.render_html(job.result, persist=False)
+    return jsonify(payload)
+
+# ★ログのエクスポート（CSV / JSONL をDBから少しずつ読みながらストリーミングで返す）
+@bp.route('/export/<kind>')
+def export_logs(kind):
+    if session.get('role') != 'teacher': return redirect(url_for('.index'))
+    if kind not in log_export.EXPORT_FIELDS: return "", 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'): return jsonify({"error": "format は csv か jsonl を指定してください"}), 400
+    records = log_export.iter_records(kind, session['user_id'], archived=bool(request.args.get('archive')))
+    if fmt == 'csv':
+        body, content_type = log_export.to_csv(records, log_export.EXPORT_FIELDS[kind]), 'text/csv; charset=utf-8'
+    else:
+        body, content_type = log_export.to_jsonl(records), 'application/x-ndjson; charset=utf-8'
+    filename = f"{kind}_{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    return Response(stream_with_context(body), content_type=content_type,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@bp.route('/api/llm_stats')
+def llm_stats_api():
+    # モデルごとの待ち行列の長さ・待ち時間・リトライ回数・ブレーカー状態
+    if session.get('role') != 'teacher': return jsonify({"error": "権限がありません"}), 403
+    return jsonify(llm.stats())
+
+@bp.route('/switch_role')
 def switch_role():
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('.login'))
     cur = User.query.get(session['user_id'])
     target_name = 'gakusei' if cur.role == 'teacher' else 'sensei'
     target = User.query.filter_by(username=target_name).first()
@@ -415,7 +987,12 @@ def switch_role():
         db.session.commit()
     session['user_id'] = target.id
     session['role'] = target.role
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
+
+# gunicorn (app:app) や flask コマンドから使うアプリ
+app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # 開発用サーバーでは起動時にテーブル作成と初期ユーザーの登録も行う
+    with app.app_context(): init_db()
+    app.run(debug=True)
@@ -0,0 +1,261 @@
+# --- ★非同期(ASGI)モード ---
+#   uvicorn asgi:app --workers 2
+#   gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+#
+# 同期の Flask では、モデルの応答を待つ間（数秒〜数十秒）ワーカーのスレッドが1つ塞がるため、
+# 同時に待てる生徒数が「ワーカー数 × スレッド数」で頭打ちになる。このモードではモデルを呼ぶルートだけを
+# async で実装し、llm.agenerate() / llm.astream() を await している間はスレッドを使わない。
+#   - DBアクセスは app.py の同期の関数をそのまま使い、専用のスレッドプールで実行する（イベントループを止めない）
+#   - 上記以外のルート（画面・教員向けAPIなど）は Flask をそのまま WSGI としてマウントする
+#   - ログイン状態は Flask の署名付きセッションCookieを読んで判定する
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import FileStorage, MultiDict
+import app as web
+import gen_cache
+import llm
+import metrics
+import upload_cache
+from models import QuizLog
+
+flask_app = web.app
+_db_pool = ThreadPoolExecutor(max_workers=flask_app.config['ASYNC_DB_THREADS'], thread_name_prefix='async-db')
+
+
+async def run_db(fn, *args):
+    """fn(*args) をアプリケーションコンテキスト付きでDB用スレッドで実行する（セッションは呼び出しごとに片付く）"""
+    def call():
+        with flask_app.app_context():
+            return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(_db_pool, call)
+
+
+def _user_id(request):
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie: return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        data = serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get('user_id')
+
+
+def _error(e):
+    """app._error_response と同じく、一時的に使えない場合は 503 + Retry-After、それ以外は 500"""
+    if isinstance(e, llm.LLMUnavailable):
+        return JSONResponse({"error": str(e)}, 503, headers={'Retry-After': str(e.retry_after)})
+    return JSONResponse({"error": str(e)}, 500)
+
+
+def _sse_response(events):
+    return StreamingResponse(events, media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def route(path, endpoint):
+    """ログイン必須の非同期ルート。メトリクスは Flask 側と同じエンドポイント名で記録する"""
+    def decorator(handler):
+        async def wrapped(request):
+            started = time.perf_counter()
+            user_id = _user_id(request)
+            if user_id is None:
+                response = JSONResponse({"error": "ログインしてください"}, 401)
+            else:
+                response = await handler(request, user_id)
+            # ストリーミング応答は送信開始までの時間になる
+            metrics.http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+            metrics.http_latency.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+            # Flask 側の teardown_request と同じく、他のワーカーから集計できるように書き出す（一定間隔ごと）
+            metrics.registry.flush()
+            return response
+        return Route(path, wrapped, methods=['POST'], name=endpoint)
+    return decorator
+
+
+# --- 授業スライド ---
+async def _astream_lesson(prompt, assignment_id, user_id):
+    """app._stream_lesson の非同期版"""
+    model_name = llm.model_name('pro')
+    key = gen_cache.cache_key(model_name, prompt)
+    call, leader = gen_cache.flight.begin(key)
+    if not leader:
+        try:
+            text = await run_db(web._join_lesson, assignment_id, user_id, await call.wait_async())
+            events = await run_db(web._replay_slides, text)
+        except Exception as e:
+            yield web._sse('error', {"error": str(e)})
+            return
+        for event in events: yield event
+        return
+
+    full_text = []
+    buffer = ''
+    index = 0
+    try:
+        async for text in llm.astream('pro', prompt, allow_fallback=False):
+            full_text.append(text)
+            slides, buffer = web._take_slides(buffer + text)
+            for slide in slides:
+                yield web._slide_event(index, slide)
+                index += 1
+        for slide in web._take_slides(buffer, final=True)[0]:
+            yield web._slide_event(index, slide)
+            index += 1
+        content_id = await run_db(web._store_lesson, key, model_name, ''.join(full_text), assignment_id)
+        gen_cache.flight.finish(key, call, result=content_id)
+        await run_db(web._join_lesson, assignment_id, user_id, content_id)
+        yield web._sse('done', {"count": index})
+    except Exception as e:
+        if not call.event.is_set(): gen_cache.flight.finish(key, call, error=e)
+        yield web._sse('error', {"error": str(e)})
+    finally:
+        # クライアントが切断して途中で止まった場合も、合流して待っている他のリクエストを解放する
+        if not call.event.is_set(): gen_cache.flight.finish(key, call, error=llm.LLMError("授業の生成が中断されました"))
+
+
+async def _agenerate_lesson(prompt, assignment_id, user_id):
+    """gen_cache.get_or_generate の非同期版。生徒のログに紐づけた本文を返す"""
+    model_name = llm.model_name('pro')
+    key = gen_cache.cache_key(model_name, prompt)
+
+    async def produce():
+        content_id = await run_db(web._lesson_content_id, key)
+        if content_id: return content_id
+        text = await llm.agenerate('pro', prompt, allow_fallback=False)
+        return await run_db(web._store_lesson, key, model_name, text, assignment_id)
+
+    content_id = await gen_cache.flight.ado(key, produce)
+    return await run_db(web._join_lesson, assignment_id, user_id, content_id)
+
+
+@route('/api/generate_lesson', 'main.generate_lesson_api')
+async def generate_lesson(request, user_id):
+    data = await request.json()
+    assignment_id = data.get('assignment_id')
+    text, prompt = await run_db(web._find_lesson, assignment_id, user_id)
+    if web._wants_stream(data, request.headers.get('accept')):
+        if text is not None: return _sse_response(await run_db(web._replay_slides, text))
+        return _sse_response(_astream_lesson(prompt, assignment_id, user_id))
+    try:
+        if text is None: text = await _agenerate_lesson(prompt, assignment_id, user_id)
+        return JSONResponse(await run_db(web._slides_payload, text))
+    except Exception as e: return _error(e)
+
+
+# --- TAチャット ---
+@route('/api/ask_teacher', 'main.ask_teacher_api')
+async def ask_teacher(request, user_id):
+    data = await request.json()
+    chat = await run_db(web._chat_prepare, data.get('assignment_id'), user_id, data.get('question') or '',
+                        data.get('slide_index'), data.get('context', ''))
+    try:
+        answer = chat["cached"] if chat["cached"] is not None else await llm.agenerate('flash', chat["prompt"], priority='interactive')
+        return JSONResponse(await run_db(web._chat_finish, chat, answer))
+    except Exception as e: return _error(e)
+
+
+# --- 確認テスト ---
+@route('/api/generate_quiz', 'main.generate_quiz_api')
+async def generate_quiz(request, user_id):
+    data = await request.json()
+    assignment_id = data.get('assignment_id')
+    payload, slides = await run_db(web._find_quiz, assignment_id, user_id)
+    if payload: return JSONResponse(payload)
+    if slides is None: return JSONResponse({"error": "先に授業を受けてください"}, 400)
+
+    async def produce():
+        text = web._clean_json(await llm.agenerate('pro', web.build_quiz_prompt(slides)))
+        return await run_db(web._save_quiz, assignment_id, user_id, text)
+
+    try:
+        # 事前生成（スレッド側）の途中なら、同じ single-flight に合流して完了を待つ
+        quiz_id = await gen_cache.flight.ado(('quiz', assignment_id, user_id), produce)
+        return JSONResponse(await run_db(web._joined_quiz_payload, quiz_id))
+    except Exception as e: return _error(e)
+
+
+async def _agrade_quiz_question(question, answer, retries):
+    """app._grade_quiz_question の非同期版"""
+    if not answer or not answer.strip(): return web.UNANSWERED
+    prompt = web.build_quiz_grading_prompt(question, answer)
+    for attempt in range(retries + 1):
+        result = web._parse_question_grade(await llm.agenerate('pro', prompt, json_mode=True), attempt)
+        if result is not None: return result
+    raise web._grade_unreadable()
+
+
+def _quiz_questions(quiz_id):
+    quiz = QuizLog.query.get(quiz_id)
+    return json.loads(quiz.questions) if quiz else None
+
+
+@route('/api/grade_quiz', 'main.grade_quiz_api')
+async def grade_quiz(request, user_id):
+    data = await request.json()
+    quiz_id, answers = data.get('quiz_id'), data.get('answers') or {}
+    questions = await run_db(_quiz_questions, quiz_id)
+    if questions is None: return JSONResponse({"error": "テストが見つかりません"}, 404)
+    if not questions: return JSONResponse({"error": "このテストには問題がありません"}, 400)
+    retries = flask_app.config['QUIZ_GRADING_RETRIES']
+    try:
+        # 全問をまとめて await するので、スレッドを使わずに並行して採点できる
+        grades = await asyncio.gather(*(_agrade_quiz_question(q['question'], answers.get(str(q['q_id']), ''), retries) for q in questions))
+        results = [dict(g, q_id=q['q_id']) for q, g in zip(questions, grades)]
+        return JSONResponse(await run_db(web._save_quiz_grading, quiz_id, user_id, answers, results))
+    except Exception as e: return _error(e)
+
+
+# --- 自由採点 ---
+def _werkzeug_form(form):
+    """Starlette のフォームを、app._build_grading_contents が扱える werkzeug の形に変換する"""
+    fields, files = MultiDict(), MultiDict()
+    for name, value in form.multi_items():
+        if isinstance(value, UploadFile):
+            files.add(name, FileStorage(stream=value.file, filename=value.filename or '', name=name, content_type=value.content_type))
+        else:
+            fields.add(name, value)
+    return fields, files
+
+
+@route('/api/general_grading', 'main.general_grading_api')
+async def general_grading(request, user_id):
+    if int(request.headers.get('content-length') or 0) > flask_app.config['MAX_CONTENT_LENGTH']:
+        return JSONResponse({"error": "ファイルサイズが大きすぎます"}, 413)
+    async with request.form() as form:
+        fields, files = _werkzeug_form(form)
+        try:
+            mode, contents, log_input_text = await run_db(web._build_grading_contents, fields, files, user_id)
+        except web.GradingInputError as e:
+            return JSONResponse({"error": str(e)}, 400)
+    try:
+        result_text = await llm.agenerate('pro', contents)
+        return JSONResponse(await run_db(web._commit_grading_log, user_id, mode, log_input_text, result_text))
+    except Exception as e: return _error(e)
+    finally:
+        upload_cache.cache.release(contents)
+
+
+@asynccontextmanager
+async def lifespan(_):
+    # Gemini のクライアント生成は重いので、イベントループの外で先に済ませておく
+    await asyncio.to_thread(llm.get_backend)
+    yield
+    _db_pool.shutdown(wait=False)
+
+
+app = Starlette(routes=[
+    generate_lesson, ask_teacher, generate_quiz, grade_quiz, general_grading,
+    Mount('/', app=WSGIMiddleware(flask_app, workers=flask_app.config['ASYNC_WSGI_THREADS'])),
+], lifespan=lifespan)
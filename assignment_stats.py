@@ -0,0 +1,109 @@
+from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from models import db, AssignmentStats, LessonLog, QuizLog, ArchivedLessonLog, ArchivedQuizLog
+
+# --- 課題ごとの集計の差分更新 ---
+# ログの書き込みと同じトランザクションで呼び、コミットは呼び出し側で行う。
+# 加算は「UPDATE ... SET col = col + n」で行うので、同時に書き込まれても数え漏れがない。
+# 集計が食い違ったとき（この機能より前のデータなど）は `flask rebuild-stats` でログから作り直す。
+
+
+def score_bin(score):
+    return min(max(int(score), 0) // 20, len(AssignmentStats.SCORE_BINS) - 1)
+
+
+def _bump(assignment_id, **increments):
+    if assignment_id is None: return
+    columns = AssignmentStats.__table__.c
+    values = {name: columns[name] + n for name, n in increments.items() if n}
+    values['last_activity_at'] = datetime.utcnow()
+    stmt = AssignmentStats.__table__.update().where(columns.assignment_id == assignment_id).values(**values)
+    if db.session.execute(stmt).rowcount: return
+    # 集計行がまだ無ければ作る。同時に作られていたら UPDATE をやり直す
+    try:
+        with db.session.begin_nested():
+            db.session.execute(AssignmentStats.__table__.insert().values(
+                assignment_id=assignment_id, last_activity_at=values['last_activity_at'],
+                **{name: n for name, n in increments.items()}))
+    except IntegrityError:
+        db.session.execute(stmt)
+
+
+def _archived_rows(model, assignment_id, student_id):
+    return (model.query.filter_by(assignment_id=assignment_id, student_id=student_id)
+            .order_by(model.created_at.desc()))
+
+
+def record_lesson(assignment_id, student_id=None):
+    # アーカイブ済みの生徒が授業を開き直して新しい行ができた場合は、すでに数えてあるので加算しない
+    if student_id is not None and _archived_rows(ArchivedLessonLog, assignment_id, student_id).first(): return
+    _bump(assignment_id, lesson_count=1)
+
+
+def record_quiz_graded(assignment_id, score, previous_score=None, student_id=None):
+    """previous_score: 再採点の場合は前回の点数（前回分を差し引いてから加算する）
+
+    student_id を渡すと、アーカイブ済みの確認テストが採点済みならその点数を前回の点数として扱う。
+    """
+    if previous_score is None and student_id is not None:
+        archived = _archived_rows(ArchivedQuizLog, assignment_id, student_id).filter(ArchivedQuizLog.grading_result.isnot(None)).first()
+        if archived: previous_score = archived.score or 0
+    increments = {'score_sum': score, f'score_bin_{score_bin(score)}': 1}
+    if previous_score is None:
+        increments['graded_count'] = 1
+    else:
+        increments['score_sum'] -= previous_score
+        old_bin = f'score_bin_{score_bin(previous_score)}'
+        increments[old_bin] = increments.get(old_bin, 0) - 1
+    _bump(assignment_id, **increments)
+
+
+def rebuild(assignment_id=None):
+    """LessonLog / QuizLog（アーカイブ済みも含む）から集計を作り直す（assignment_id=None なら全課題）。作り直した件数を返す
+
+    アーカイブ後に同じ生徒が授業を開き直すと両方のDBに行があるので、(課題, 生徒) ごとに1人として数える。
+    確認テストも生徒ごとに最新の採点だけを数える。
+    """
+    def scoped(q, model):
+        return q.filter(model.assignment_id == assignment_id) if assignment_id is not None else q
+    lessons = {}  # (課題ID, 生徒ID) -> 最後に授業を受けた日時
+    for model in (ArchivedLessonLog, LessonLog):
+        q = db.session.query(model.assignment_id, model.student_id, func.max(model.created_at)).group_by(model.assignment_id, model.student_id)
+        for aid, sid, last in scoped(q, model):
+            previous = lessons.get((aid, sid))
+            lessons[(aid, sid)] = max(filter(None, (previous, last)), default=None)
+    graded = {}  # (課題ID, 生徒ID) -> (点数, 日時)。アーカイブ側、現在のテーブルの順に新しいもので上書きする
+    for model in (ArchivedQuizLog, QuizLog):
+        q = (db.session.query(model.assignment_id, model.student_id, model.score, model.created_at)
+             .filter(model.grading_result.isnot(None)).order_by(model.created_at))
+        for aid, sid, score, created_at in scoped(q, model):
+            graded[(aid, sid)] = (score, created_at)
+    if assignment_id is not None:
+        AssignmentStats.query.filter_by(assignment_id=assignment_id).delete()
+    else:
+        AssignmentStats.query.delete()
+
+    stats = {}
+    def row(aid):
+        if aid not in stats:
+            stats[aid] = AssignmentStats(assignment_id=aid, lesson_count=0, graded_count=0, score_sum=0,
+                                         **{f'score_bin_{i}': 0 for i in range(len(AssignmentStats.SCORE_BINS))})
+        return stats[aid]
+    for (aid, _), last in lessons.items():
+        if aid is None: continue
+        s = row(aid)
+        s.lesson_count += 1
+        if s.last_activity_at is None or (last and last > s.last_activity_at): s.last_activity_at = last
+    for (aid, _), (score, created_at) in graded.items():
+        if aid is None: continue
+        s = row(aid)
+        score = score or 0
+        s.graded_count += 1
+        s.score_sum += score
+        name = f'score_bin_{score_bin(score)}'
+        setattr(s, name, getattr(s, name) + 1)
+        if s.last_activity_at is None or (created_at and created_at > s.last_activity_at): s.last_activity_at = created_at
+    db.session.add_all(stats.values())
+    db.session.commit()
+    return len(stats)
@@ -0,0 +1,327 @@
+"""Flaskの実ルートに並行アクセスして、エンドポイントごとのスループットとレイテンシを計測する負荷試験ツール
+
+使い方:
+    python benchmark.py --users 20 --iterations 3 --latency 0.5
+    python benchmark.py --users 40 --error-rate 0.05 --json bench_result.json
+    python benchmark.py --startup 10     # import と最初のリクエストまでの時間（ワーカー起動の速さ）
+    python benchmark.py --server async   # 非同期(ASGI)モードで同じシナリオを実行する
+    python benchmark.py --compare 300 --latency 2 --threads 8   # 同時に待つリクエスト数を同期/非同期で比較する
+
+既定ではローカルスタブ (LLM_BACKEND=stub) と一時的なSQLiteファイルを使うので、実APIや kosen.db には触れない。
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Kosen Hub 負荷試験")
+    parser.add_argument('--users', type=int, default=10, help="同時に操作する仮想生徒数")
+    parser.add_argument('--iterations', type=int, default=2, help="仮想生徒1人あたりのシナリオ繰り返し回数")
+    parser.add_argument('--latency', type=float, default=0.2, help="スタブの応答遅延(秒)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="スタブの遅延のゆらぎ(秒)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="スタブが返すエラーの割合(0-1)")
+    parser.add_argument('--response-chars', type=int, default=800, help="スタブの応答文字数")
+    parser.add_argument('--image-kb', type=int, default=200, help="採点リクエストに添付する画像サイズ(KB)")
+    parser.add_argument('--real', action='store_true', help="スタブではなく実際のGemini APIを使う")
+    parser.add_argument('--json', help="結果をJSONで書き出すファイル")
+    parser.add_argument('--startup', type=int, default=0, metavar='N',
+                        help="負荷試験の代わりに、新しいプロセスでの起動時間をN回計測する")
+    parser.add_argument('--server', choices=('sync', 'async'), default='sync',
+                        help="sync: Flask(WSGI) / async: asgi.py を uvicorn で動かす")
+    parser.add_argument('--threads', type=int, default=8,
+                        help="同期サーバーのスレッド数（gunicorn の gthread ワーカー1つ分に相当）")
+    parser.add_argument('--compare', type=int, default=0, metavar='N',
+                        help="負荷試験の代わりに、N件の同時リクエスト（TAチャット）を同期/非同期の両方で計測する")
+    return parser.parse_args()
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.samples[name].append(seconds)
+            if not ok: self.errors[name] += 1
+
+
+def percentile(values, p):
+    """nearest-rank 法によるパーセンタイル"""
+    if not values: return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def timed(recorder, name, session, method, url, **kwargs):
+    start = time.perf_counter()
+    ok = False
+    resp = None
+    try:
+        resp = session.request(method, url, timeout=600, **kwargs)
+        ok = resp.status_code < 400
+    except Exception:
+        pass
+    recorder.record(name, time.perf_counter() - start, ok)
+    return resp
+
+
+def student_scenario(base, username, assignment_id, problem_image, args, recorder):
+    import requests
+    s = requests.Session()
+    # 問題画像はクラス全員で同じ、解答画像は生徒ごとに異なる
+    image = os.urandom(args.image_kb * 1024)
+    for _ in range(args.iterations):
+        timed(recorder, 'POST /login', s, 'POST', f"{base}/login", data={"username": username}, allow_redirects=False)
+        timed(recorder, 'GET /student', s, 'GET', f"{base}/student")
+        timed(recorder, 'POST /api/generate_lesson', s, 'POST', f"{base}/api/generate_lesson", json={"assignment_id": assignment_id})
+        resp = timed(recorder, 'POST /api/generate_quiz', s, 'POST', f"{base}/api/generate_quiz", json={"assignment_id": assignment_id})
+        quiz = resp.json() if resp is not None and resp.ok else None
+        if quiz and quiz.get('quiz_id'):
+            answers = {str(q['q_id']): "ベンチマーク用の回答です。" for q in quiz['questions']}
+            timed(recorder, 'POST /api/grade_quiz', s, 'POST', f"{base}/api/grade_quiz", json={"quiz_id": quiz['quiz_id'], "answers": answers})
+        files = [('problem_images', ('problem_0.jpg', problem_image, 'image/jpeg')),
+                 ('student_images', ('student_0.jpg', image, 'image/jpeg'))]
+        timed(recorder, 'POST /api/general_grading', s, 'POST', f"{base}/api/general_grading",
+              data={"mode": "problem", "text_content": "問1の解答です"}, files=files)
+
+
+def teacher_scenario(base, args, recorder, stop):
+    import requests
+    s = requests.Session()
+    timed(recorder, 'POST /login', s, 'POST', f"{base}/login", data={"username": "bench_teacher"}, allow_redirects=False)
+    while not stop.is_set():
+        timed(recorder, 'GET /teacher', s, 'GET', f"{base}/teacher")
+        stop.wait(0.5)
+
+
+# 新しいインタープリタで app を import し、最初のリクエストに応答するまでを計測する（gunicorn のワーカー起動に相当）
+STARTUP_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.app.test_client().get('/login')
+t2 = time.perf_counter()
+print(json.dumps({"import_s": t1 - t0, "first_request_s": t2 - t1}))
+"""
+
+
+# --- サーバーの起動 ---
+def start_sync_server(app, threads):
+    """gunicorn の gthread ワーカーと同じく、決まった数のスレッドでリクエストを処理するサーバーを起動する"""
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.serving import BaseWSGIServer
+
+    class PooledWSGIServer(BaseWSGIServer):
+        request_queue_size = 1024
+
+        def __init__(self, *a, **kw):
+            super().__init__(*a, **kw)
+            self.pool = ThreadPoolExecutor(max_workers=threads)
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self._handle, request, client_address)
+
+        def _handle(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    server = PooledWSGIServer('127.0.0.1', 0, app)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server.shutdown
+
+
+def start_async_server():
+    import uvicorn
+    import asgi
+    server = uvicorn.Server(uvicorn.Config(asgi.app, host='127.0.0.1', port=0, log_level='warning', backlog=4096))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started: time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    def stop():
+        server.should_exit = True
+    return f"http://127.0.0.1:{port}", stop
+
+
+def start_server(kind, app, args):
+    return start_async_server() if kind == 'async' else start_sync_server(app, args.threads)
+
+
+def concurrency_benchmark(app, assignment_id, args):
+    """同期/非同期それぞれで、N件のTAチャットを同時に送って全件の応答が揃うまでを計測する
+
+    スタブの遅延(--latency)の間、同期モードはスレッドを1つずつ占有するので、全体の時間は
+    おおよそ 遅延 × N / スレッド数 になる。非同期モードでは待機中にスレッドを使わないので遅延1回分に近づく。
+    """
+    import requests
+    results = {}
+    for kind in ('sync', 'async'):
+        base, stop = start_server(kind, app, args)
+        login = requests.Session()
+        login.post(f"{base}/login", data={"username": "bench_student_0"}, allow_redirects=False)
+        cookies = login.cookies.get_dict()
+        recorder = Recorder()
+        barrier = threading.Barrier(args.compare + 1)
+
+        def client(i):
+            s = requests.Session()
+            s.cookies.update(cookies)
+            barrier.wait()
+            # スライド(文脈)を変えて回答キャッシュに当たらないようにする
+            timed(recorder, kind, s, 'POST', f"{base}/api/ask_teacher",
+                  json={"assignment_id": assignment_id, "context": f"{kind}-slide-{i}", "question": "この式の意味は？"})
+
+        clients = [threading.Thread(target=client, args=(i,)) for i in range(args.compare)]
+        for t in clients: t.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for t in clients: t.join()
+        elapsed = time.perf_counter() - started
+        stop()
+        values = recorder.samples[kind]
+        results[kind] = {
+            "elapsed_s": elapsed,
+            "errors": recorder.errors[kind],
+            "throughput_rps": len(values) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "max_ms": max(values) * 1000 if values else 0.0,
+        }
+
+    print(f"\n同時リクエスト {args.compare}件 / スタブ遅延 {args.latency}秒 / 同期サーバーのスレッド数 {args.threads}")
+    print(f"{'mode':<8}{'elapsed(s)':>12}{'errors':>8}{'req/s':>9}{'p50(ms)':>10}{'p95(ms)':>10}{'max(ms)':>10}")
+    for kind, r in results.items():
+        print(f"{kind:<8}{r['elapsed_s']:>12.2f}{r['errors']:>8}{r['throughput_rps']:>9.1f}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['max_ms']:>10.1f}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"concurrency": args.compare, "latency_s": args.latency, "threads": args.threads, "modes": results},
+                      f, ensure_ascii=False, indent=2)
+
+
+def startup_benchmark(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(args.startup):
+        started = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=here, env=os.environ,
+                             capture_output=True, text=True, check=True).stdout
+        sample = json.loads(out.strip().splitlines()[-1])
+        sample["process_s"] = time.perf_counter() - started
+        samples.append(sample)
+
+    report = {}
+    print(f"\n起動時間 {args.startup}回 / バックエンド: {'gemini' if args.real else 'stub'}")
+    print(f"{'phase':<20}{'p50(ms)':>10}{'max(ms)':>10}")
+    for phase, label in (("import_s", "import app"), ("first_request_s", "first request"), ("process_s", "whole process")):
+        values = [s[phase] for s in samples]
+        report[phase] = {"p50_ms": percentile(values, 50) * 1000, "max_ms": max(values) * 1000}
+        print(f"{label:<20}{report[phase]['p50_ms']:>10.1f}{report[phase]['max_ms']:>10.1f}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"runs": args.startup, "startup": report}, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='kosen_bench_')
+    os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.environ.setdefault('ARCHIVE_DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'bench_archive.db')}")
+    os.environ.setdefault('UPLOAD_CACHE_DIR', os.path.join(workdir, 'upload_cache'))
+    if args.compare:
+        # 比較したいのはサーバーの同時処理数なので、スケジューラのレート制限・同時実行数では絞らない
+        for key, value in (('LLM_FLASH_RPM', 600000), ('LLM_FLASH_BURST', args.compare * 2), ('LLM_FLASH_MAX_INFLIGHT', args.compare * 2)):
+            os.environ.setdefault(key, str(value))
+    if not args.real:
+        os.environ['LLM_BACKEND'] = 'stub'
+        os.environ['LLM_STUB_LATENCY'] = str(args.latency)
+        os.environ['LLM_STUB_JITTER'] = str(args.jitter)
+        os.environ['LLM_STUB_ERROR_RATE'] = str(args.error_rate)
+        os.environ['LLM_STUB_RESPONSE_CHARS'] = str(args.response_chars)
+
+    from app import app, init_db
+    from models import db, User, Assignment
+
+    with app.app_context():
+        init_db()
+    if args.startup:
+        startup_benchmark(args)
+        return
+
+    with app.app_context():
+        teacher = User.query.filter_by(username='bench_teacher').first()
+        if not teacher:
+            teacher = User(username='bench_teacher', role='teacher')
+            db.session.add(teacher)
+        for i in range(args.users):
+            name = f"bench_student_{i}"
+            if not User.query.filter_by(username=name).first():
+                db.session.add(User(username=name, role='student'))
+        db.session.commit()
+        assignment = Assignment(title="ベンチマーク課題", description="固有値と固有ベクトル", created_by=teacher.id)
+        db.session.add(assignment)
+        db.session.commit()
+        assignment_id = assignment.id
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if args.compare:
+        concurrency_benchmark(app, assignment_id, args)
+        return
+    base, stop_server = start_server(args.server, app, args)
+
+    recorder = Recorder()
+    problem_image = os.urandom(args.image_kb * 1024)
+    stop = threading.Event()
+    teacher_thread = threading.Thread(target=teacher_scenario, args=(base, args, recorder, stop))
+    students = [threading.Thread(target=student_scenario, args=(base, f"bench_student_{i}", assignment_id, problem_image, args, recorder))
+                for i in range(args.users)]
+
+    started = time.perf_counter()
+    teacher_thread.start()
+    for t in students: t.start()
+    for t in students: t.join()
+    stop.set()
+    teacher_thread.join()
+    elapsed = time.perf_counter() - started
+    stop_server()
+
+    report = []
+    for name in sorted(recorder.samples):
+        values = recorder.samples[name]
+        report.append({
+            "endpoint": name,
+            "count": len(values),
+            "errors": recorder.errors[name],
+            "throughput_rps": len(values) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        })
+
+    print(f"\n仮想生徒 {args.users}人 x {args.iterations}回 / 所要時間 {elapsed:.1f}秒 / バックエンド: {'gemini' if args.real else 'stub'} / サーバー: {args.server}")
+    print(f"{'endpoint':<30}{'count':>7}{'errors':>8}{'req/s':>9}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for r in report:
+        print(f"{r['endpoint']:<30}{r['count']:>7}{r['errors']:>8}{r['throughput_rps']:>9.2f}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"elapsed_s": elapsed, "users": args.users, "iterations": args.iterations, "endpoints": report}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from models import db, insert_or_get, CalendarSyncEntry, CalendarSyncStatus
+
+# --- Google Classroom → Google カレンダーの差分同期 ---
+#   - 課題ID → 予定ID の対応表を保存し、内容が変わっていない課題はスキップ、変わった課題は patch する
+#   - 予定の追加・更新はバッチリクエストでまとめて送る
+#   - 一覧取得は nextPageToken でページをたどる
+#   - コースごとの課題一覧は固定数のスレッドで並行して取得する
+#   - カレンダー側で消された予定(404 / 410)は対応表から外して追加し直す
+# Classroom / Calendar のクライアントは引数で受け取るので、google_fakes のフェイクに差し替えて動かせる。
+
+CALENDAR_BATCH_LIMIT = 50  # Calendar API の1バッチあたりの上限
+STALE_AFTER = timedelta(minutes=10)  # プロセスが落ちて 'running' のまま残った状態はこれを過ぎたら無視する
+
+
+def list_all(method, key, **params):
+    """nextPageToken をたどって全ページの項目を返す"""
+    items = []
+    token = None
+    while True:
+        if token: params['pageToken'] = token
+        resp = method(**params).execute()
+        items.extend(resp.get(key, []))
+        token = resp.get('nextPageToken')
+        if not token: return items
+
+
+def event_body(course, work):
+    d = work['dueDate']
+    dt = f"{d['year']}-{d['month']:02d}-{d['day']:02d}"
+    return {
+        'summary': f"【課題】{work['title']} ({course['name']})",
+        'description': f"リンク: {work['alternateLink']}\n{work.get('description','')}",
+        'start': {'date': dt}, 'end': {'date': dt}
+    }
+
+
+def is_gone(exception):
+    """利用者がカレンダーで予定を消していた（googleapiclient の HttpError の 404 / 410）"""
+    status = getattr(getattr(exception, 'resp', None), 'status', None) or getattr(exception, 'status_code', None)
+    return str(status) in ('404', '410')
+
+
+def fingerprint(body):
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class SyncResult:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+
+
+class CalendarSyncEngine:
+    def __init__(self, classroom_factory, calendar, max_workers=4, cutoff_days=7, calendar_id='primary'):
+        """classroom_factory: Classroom のクライアントを返す関数。
+
+        googleapiclient のクライアントはスレッドセーフではないので、並行取得ではスレッドごとに作る。
+        """
+        self.classroom_factory = classroom_factory
+        self.calendar = calendar
+        self.max_workers = max_workers
+        self.cutoff = date.today() - timedelta(days=cutoff_days)
+        self.calendar_id = calendar_id
+        self._local = threading.local()
+
+    def _classroom(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.classroom_factory()
+        return self._local.client
+
+    def _course_events(self, course):
+        """1コース分の {課題ID: 予定の本文}"""
+        works = list_all(self._classroom().courses().courseWork().list, 'courseWork', courseId=course['id'])
+        events = {}
+        for w in works:
+            d = w.get('dueDate')
+            if not d or not (d.get('year') and d.get('month') and d.get('day')): continue
+            if date(d['year'], d['month'], d['day']) < self.cutoff: continue
+            events[w['id']] = event_body(course, w)
+        return events
+
+    def collect(self):
+        courses = list_all(self._classroom().courses().list, 'courses', studentId='me', courseStates=['ACTIVE'])
+        desired = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='classroom') as pool:
+            for events in pool.map(self._course_events, courses):
+                desired.update(events)
+        return desired
+
+    def run(self, user_id):
+        result = SyncResult()
+        desired = self.collect()
+        existing = {e.coursework_id: e for e in CalendarSyncEntry.query.filter_by(user_id=user_id)}
+
+        requests = []  # (課題ID, リクエスト, 本文のハッシュ)
+        for work_id, body in desired.items():
+            fp = fingerprint(body)
+            entry = existing.get(work_id)
+            if entry is None:
+                requests.append((work_id, self.calendar.events().insert(calendarId=self.calendar_id, body=body), fp))
+            elif entry.fingerprint != fp:
+                requests.append((work_id, self.calendar.events().patch(calendarId=self.calendar_id, eventId=entry.event_id, body=body), fp))
+            else:
+                result.skipped += 1
+
+        fingerprints = {work_id: fp for work_id, _, fp in requests}
+        gone = []
+
+        def on_response(work_id, response, exception):
+            if exception is not None and work_id in existing and is_gone(exception):
+                # 消された予定は対応表から外し、すべてのバッチのあとで追加し直す
+                db.session.delete(existing.pop(work_id))
+                gone.append(work_id)
+                return
+            if exception is not None:
+                result.failed += 1
+                result.errors.append(f"{work_id}: {exception}")
+                return
+            entry = existing.get(work_id)
+            if entry is None:
+                entry = CalendarSyncEntry(user_id=user_id, coursework_id=work_id, event_id=response['id'], fingerprint=fingerprints[work_id])
+                db.session.add(entry)
+                existing[work_id] = entry
+                result.inserted += 1
+            else:
+                entry.event_id = response.get('id', entry.event_id)
+                entry.fingerprint = fingerprints[work_id]
+                result.updated += 1
+
+        self._send(requests, on_response)
+        if gone:
+            # 削除はコミット済みなので、同じ課題の対応表を作り直しても一意インデックスに当たらない
+            self._send([(work_id, self.calendar.events().insert(calendarId=self.calendar_id, body=desired[work_id]), None)
+                        for work_id in gone], on_response)
+        return result
+
+    def _send(self, requests, on_response):
+        for i in range(0, len(requests), CALENDAR_BATCH_LIMIT):
+            batch = self.calendar.new_batch_http_request(callback=on_response)
+            for work_id, req, _ in requests[i:i + CALENDAR_BATCH_LIMIT]:
+                batch.add(req, request_id=work_id)
+            batch.execute()
+            # バッチごとにコミットし、途中で失敗しても送信済みの分は二重登録しない
+            db.session.commit()
+
+
+def claim_sync(user_id, stale_after=STALE_AFTER):
+    """同期を始めてよければ状態を 'running' にして True を返す
+
+    実行中かどうかの確認と 'running' への更新を1つの UPDATE で行うので、同時に押されても始まるのは1つだけ。
+    """
+    if CalendarSyncStatus.query.get(user_id) is None:
+        insert_or_get(CalendarSyncStatus, {"user_id": user_id})
+    now = datetime.utcnow()
+    claimed = CalendarSyncStatus.query.filter(
+        CalendarSyncStatus.user_id == user_id,
+        db.or_(CalendarSyncStatus.status != 'running', CalendarSyncStatus.started_at.is_(None),
+               CalendarSyncStatus.started_at < now - stale_after),
+    ).update({"status": 'running', "message": None, "started_at": now, "finished_at": None}, synchronize_session=False)
+    db.session.commit()
+    return bool(claimed)
+
+
+def run_sync(user_id, make_engine, claimed=False):
+    """make_engine() で作ったエンジンで同期を実行し、CalendarSyncStatus に結果を記録する（app_context 内で呼ぶ）
+
+    claimed=False なら先に claim_sync() し、別の同期が実行中なら何もせずに None を返す。
+    """
+    if not claimed and not claim_sync(user_id): return None
+    status = CalendarSyncStatus.query.get(user_id)
+    try:
+        result = make_engine().run(user_id)
+        status.status = 'done' if not result.failed else 'error'
+        status.inserted, status.updated, status.skipped, status.failed = result.inserted, result.updated, result.skipped, result.failed
+        status.message = '\n'.join(result.errors[:10]) or None
+    except Exception as e:
+        db.session.rollback()
+        traceback.print_exc()
+        status = CalendarSyncStatus.query.get(user_id)
+        status.status, status.message = 'error', str(e)
+    status.finished_at = datetime.utcnow()
+    db.session.commit()
+    return status
+
+
+def status_to_dict(status):
+    if status is None: return {"status": "idle"}
+    return {
+        "status": status.status,
+        "inserted": status.inserted, "updated": status.updated,
+        "skipped": status.skipped, "failed": status.failed,
+        "message": status.message,
+        "finished_at": status.finished_at.isoformat() if status.finished_at else None,
+    }
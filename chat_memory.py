@@ -0,0 +1,159 @@
+from models import db, insert_or_get, ChatSession, ChatTurn
+import metrics
+
+# --- TAチャットの会話メモリ ---
+# 生徒×授業ごとに会話をDBに保存し、質問のたびに「予算内に収まる文脈」を組み立ててモデルに渡す。
+#   - 直近のやりとりはそのまま（新しい順に予算が尽きるまで）
+#   - それより古いやりとりは要約(ChatSession.summary)に畳み込む。要約は回答後にバックグラウンドで差分更新する
+#   - スライドは全文を送らず、全体の見出し一覧と、いま見ている1枚だけを送る
+# 会話がどれだけ長くなってもプロンプトの大きさは CHAT_CONTEXT_TOKENS 程度で頭打ちになる。
+
+# 予算の配分（全体に対する割合）
+QUESTION_SHARE = 0.2
+SLIDE_SHARE = 0.35
+OUTLINE_SHARE = 0.1
+TURN_SHARE = 0.2     # 直近のやりとり1件あたりの上限
+MIN_TURN_TOKENS = 40  # 残りがこれ未満なら直近のやりとりはそこで打ち切る
+TITLE_CHARS = 24
+FOLD_BATCH = 8       # 1回の要約で畳み込む件数の上限（要約のプロンプトも大きくしない）
+
+prompt_tokens = metrics.registry.histogram('chat_prompt_tokens', 'TAチャットのプロンプトの推定トークン数',
+                                           buckets=(250, 500, 1000, 2000, 4000, 8000))
+
+
+def estimate_tokens(text):
+    """トークナイザーを使わない概算: 日本語などの非ASCII文字は1文字1トークン、ASCIIは4文字で1トークン"""
+    if not text: return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
+
+def truncate_to_tokens(text, budget):
+    """推定トークン数が budget に収まるように末尾を切る"""
+    text = text or ''
+    if estimate_tokens(text) <= budget: return text
+    cost = 0.0
+    for i, ch in enumerate(text):
+        cost += 1 if ord(ch) >= 128 else 0.25
+        if cost > budget - 1: return text[:i].rstrip() + '…'
+    return text
+
+
+def slide_title(slide):
+    """スライドの最初の見出し（なければ最初の行）"""
+    lines = [line.strip() for line in slide.splitlines() if line.strip()]
+    if not lines: return ''
+    title = next((line for line in lines if line.startswith('#')), lines[0]).lstrip('#').strip()
+    return title[:TITLE_CHARS]
+
+
+def slide_outline(slides, current):
+    return ' / '.join(f"{'▶' if i == current else ''}{i + 1}.{slide_title(s)}" for i, s in enumerate(slides))
+
+
+def _turn_text(turn):
+    where = f"(スライド{turn.slide_index + 1})" if turn.slide_index is not None else ''
+    return f"生徒{where}: {turn.question}\n先生: {turn.answer}"
+
+
+def _assemble(question, slide_text, outline, location, summary, recent):
+    """プロンプト本文を組み立てる。outline / summary が None の節は入れない"""
+    sections = ["高専の教員として、授業スライドについての生徒の質問に回答して。数式を用いて解説して。"]
+    if summary is not None or recent:
+        sections[0] += "\nこれまでの会話を踏まえ、既に説明した内容は繰り返さず、質問された点に絞って簡潔に答えて。"
+    if outline is not None: sections.append(f"【スライド構成】{outline}")
+    sections.append(f"【現在のスライド{location}】\n{slide_text}")
+    if summary is not None: sections.append(f"【これまでの会話の要約】\n{summary}")
+    if recent: sections.append("【直近のやりとり】\n" + "\n".join(recent))
+    sections.append(f"【質問】{question}")
+    return "\n\n".join(sections)
+
+
+def build_prompt(question, slide_text, slides=(), slide_index=None, summary='', turns=(), budget=2000, max_turns=4):
+    """(プロンプト, 推定トークン数) を返す。turns は要約に畳み込まれていないやりとり（古い順）"""
+    turns = list(turns)[-max_turns:] if max_turns else []
+    question = truncate_to_tokens(question, int(budget * QUESTION_SHARE))
+    slide_text = truncate_to_tokens(slide_text, int(budget * SLIDE_SHARE))
+    outline = truncate_to_tokens(slide_outline(slides, slide_index), int(budget * OUTLINE_SHARE)) if slides else None
+    location = f"（{slide_index + 1}枚目）" if slides and slide_index is not None else ''
+    summary = summary or None
+    # 指示文や見出しなどの固定部分も予算に含める
+    fixed = estimate_tokens(_assemble('', '', '' if outline is not None else None, location,
+                                      '' if summary is not None else None, [''] if turns else []))
+    remaining = budget - fixed - sum(estimate_tokens(t) for t in (question, slide_text, outline))
+    # 要約は CHAT_SUMMARY_TOKENS 以内のはずだが、予算が小さい設定でも溢れないように残りに収める
+    if summary is not None: summary = truncate_to_tokens(summary, remaining)
+    remaining -= estimate_tokens(summary)
+
+    # 直近のやりとりを新しい順に、予算が尽きるか max_turns 件になるまで入れる（1件ごとに区切りの改行の分も引く）
+    recent = []
+    for turn in reversed(turns):
+        if remaining < MIN_TURN_TOKENS: break
+        text = truncate_to_tokens(_turn_text(turn), min(remaining - 1, int(budget * TURN_SHARE)))
+        recent.insert(0, text)
+        remaining -= estimate_tokens(text) + 1
+
+    prompt = _assemble(question, slide_text, outline, location, summary, recent)
+    tokens = estimate_tokens(prompt)
+    prompt_tokens.observe(tokens)
+    return prompt, tokens
+
+
+def build_summary_prompt(summary, turns, limit):
+    conversation = "\n".join(truncate_to_tokens(_turn_text(t), limit) for t in turns)
+    return f"""以下は授業中の生徒とTA（先生）の会話です。これまでの要約に新しいやりとりを統合し、{limit}字以内の日本語で要約してください。
+生徒が理解した点・つまずいている点・既に説明した内容がわかるように書き、要約文だけを出力してください。
+【これまでの要約】{summary or 'なし'}
+【新しいやりとり】
+{conversation}"""
+
+
+# --- DB 操作（コミットは get_session / fold_summary 以外は呼び出し側） ---
+def get_session(assignment_id, user_id):
+    return insert_or_get(ChatSession, {"assignment_id": assignment_id, "student_id": user_id})
+
+
+def unsummarized_turns(chat):
+    """要約にまだ畳み込まれていないやりとり（古い順）"""
+    return ChatTurn.query.filter(ChatTurn.session_id == chat.id, ChatTurn.id > chat.summary_turn_id).order_by(ChatTurn.id).all()
+
+
+def add_turn(session_id, slide_index, question, answer):
+    turn = ChatTurn(session_id=session_id, slide_index=slide_index, question=question, answer=answer)
+    db.session.add(turn)
+    db.session.flush()
+    return turn
+
+
+def history(assignment_id, user_id, limit=50):
+    """画面の再表示用に、直近のやりとりを古い順で返す"""
+    chat = ChatSession.query.filter_by(assignment_id=assignment_id, student_id=user_id).first()
+    if chat is None: return []
+    turns = ChatTurn.query.filter_by(session_id=chat.id).order_by(ChatTurn.id.desc()).limit(limit).all()
+    return turns[::-1]
+
+
+def reset(assignment_id, user_id):
+    chat = ChatSession.query.filter_by(assignment_id=assignment_id, student_id=user_id).first()
+    if chat is None: return 0
+    count = ChatTurn.query.filter_by(session_id=chat.id).delete()
+    db.session.delete(chat)
+    db.session.commit()
+    return count
+
+
+def fold_summary(session_id, keep_recent, limit, generate):
+    """直近 keep_recent 件より古い未要約のやりとりを FOLD_BATCH 件まで要約に畳み込む。畳み込んだら True
+
+    generate(prompt) はモデルを呼んで文字列を返す関数。同時に別のプロセスが更新していたら何もしない。
+    """
+    chat = ChatSession.query.get(session_id)
+    if chat is None: return False
+    pending = unsummarized_turns(chat)
+    fold = pending[:len(pending) - keep_recent][:FOLD_BATCH]
+    if not fold: return False
+    summary = truncate_to_tokens(generate(build_summary_prompt(chat.summary, fold, limit)).strip(), limit)
+    updated = ChatSession.query.filter_by(id=chat.id, summary_turn_id=chat.summary_turn_id).update(
+        {"summary": summary, "summary_turn_id": fold[-1].id}, synchronize_session=False)
+    db.session.commit()
+    return bool(updated)
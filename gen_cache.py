@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import threading
+import time
+from sqlalchemy.exc import IntegrityError
+from models import db, GeneratedContent
+
+# --- 生成結果の共有キャッシュ ---
+# プロンプトとモデル名のハッシュをキーにするので、同じ課題を開く生徒全員で1回の生成結果を共有できる。
+# 課題のタイトルや説明文が変わればプロンプトも変わるため、古い結果が返ることはない。
+
+def cache_key(model_name, prompt):
+    return hashlib.sha256(f"{model_name}\0{prompt}".encode('utf-8')).hexdigest()
+
+def lookup(key):
+    return GeneratedContent.query.filter_by(cache_key=key).first()
+
+def store(key, model_name, text, assignment_id=None):
+    row = GeneratedContent(cache_key=key, model_name=model_name, content=text, assignment_id=assignment_id)
+    db.session.add(row)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 別プロセスが同じキーを先に保存した場合はそちらを使う
+        db.session.rollback()
+        row = lookup(key)
+    return row
+
+
+# 合流した呼び出しが待つ上限（秒）。実行役が応答しないまま止まっても、待っている全員が道連れにならないようにする。
+# これより古い実行中の処理は放棄されたものとみなし、次の呼び出しが新たに実行役になる。
+WAIT_TIMEOUT = 600
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.started = time.monotonic()
+        self.result = None
+        self.error = None
+
+    def _result(self):
+        if not self.event.is_set(): raise TimeoutError("同じ内容の生成の完了を待ちきれませんでした")
+        if self.error is not None: raise self.error
+        return self.result
+
+    def wait(self, timeout=None):
+        self.event.wait(WAIT_TIMEOUT if timeout is None else timeout)
+        return self._result()
+
+    async def wait_async(self, poll=0.05, timeout=None):
+        # 実処理はスレッド側で動いていることもあるので、threading.Event を短い間隔で確認して待つ
+        deadline = time.monotonic() + (WAIT_TIMEOUT if timeout is None else timeout)
+        while not self.event.is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(poll)
+        return self._result()
+
+    def stale(self):
+        return time.monotonic() - self.started > WAIT_TIMEOUT
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら、新たに実行せず完了を待って結果を共有する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def begin(self, key):
+        """(call, is_leader) を返す。is_leader が True の呼び出し元だけが実処理を行い finish() する"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and not call.stale(): return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def finish(self, key, call, result=None, error=None):
+        call.result, call.error = result, error
+        with self._lock:
+            # 放棄扱いになった後で終わった場合、新しい実行役の分は消さない
+            if self._calls.get(key) is call: del self._calls[key]
+        call.event.set()
+
+    def in_flight(self, key):
+        with self._lock:
+            return self._calls.get(key)
+
+    def do(self, key, fn):
+        call, leader = self.begin(key)
+        if not leader: return call.wait()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result=result)
+        return result
+
+    async def ado(self, key, afn):
+        """do() の非同期版。同期の呼び出しとも同じキーで合流する"""
+        call, leader = self.begin(key)
+        if not leader: return await call.wait_async()
+        try:
+            result = await afn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result=result)
+        return result
+
+
+flight = SingleFlight()
+
+def get_or_generate(model_name, prompt, generate, assignment_id=None):
+    """キャッシュ済みならそれを、なければ generate() を1回だけ呼んで保存した GeneratedContent を返す"""
+    key = cache_key(model_name, prompt)
+    row = lookup(key)
+    if row: return row
+
+    def produce():
+        # 待っている間に他のワーカーが保存しているかもしれない
+        row = lookup(key)
+        if row: return row.id
+        return store(key, model_name, generate(), assignment_id).id
+
+    # スレッド間ではセッションに紐づくオブジェクトではなくIDを受け渡す
+    return GeneratedContent.query.get(flight.do(key, produce))
@@ -0,0 +1,123 @@
+import itertools
+import threading
+
+# --- Google Classroom / Calendar API のローカルフェイク ---
+# googleapiclient と同じ「.courses().list(...).execute()」形式の呼び出しに応答する。
+# CalendarSyncEngine を実APIなしで動かすためのもので、呼び出し回数も記録する。
+#
+#   classroom = FakeClassroom({'c1': {'name': '数学', 'courseWork': [...]}}, page_size=2)
+#   calendar = FakeCalendar()
+#   CalendarSyncEngine(lambda: classroom, calendar).run(user_id)
+
+
+class FakeHttpError(Exception):
+    """googleapiclient.errors.HttpError と同じく resp.status でHTTPステータスを持つ"""
+
+    def __init__(self, status, message=''):
+        super().__init__(f"<HttpError {status}: {message}>")
+        self.resp = type('Response', (), {'status': status})()
+
+
+class _Request:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self):
+        return self._fn()
+
+
+def _page(items, key, page_size, page_token):
+    start = int(page_token or 0)
+    resp = {key: items[start:start + page_size]}
+    if start + page_size < len(items):
+        resp['nextPageToken'] = str(start + page_size)
+    return resp
+
+
+class FakeClassroom:
+    def __init__(self, courses, page_size=20):
+        """courses: {コースID: {'name': ..., 'courseWork': [課題のdict, ...]}}"""
+        self.courses_data = courses
+        self.page_size = page_size
+        self.calls = {'courses.list': 0, 'courseWork.list': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def courses(self):
+        return self
+
+    def courseWork(self):
+        return _FakeCourseWork(self)
+
+    def list(self, studentId=None, courseStates=None, pageToken=None):
+        def run():
+            self._count('courses.list')
+            items = [{'id': cid, 'name': c['name']} for cid, c in self.courses_data.items()]
+            return _page(items, 'courses', self.page_size, pageToken)
+        return _Request(run)
+
+
+class _FakeCourseWork:
+    def __init__(self, classroom):
+        self.classroom = classroom
+
+    def list(self, courseId, pageToken=None):
+        def run():
+            self.classroom._count('courseWork.list')
+            items = self.classroom.courses_data[courseId].get('courseWork', [])
+            return _page(items, 'courseWork', self.classroom.page_size, pageToken)
+        return _Request(run)
+
+
+class FakeCalendar:
+    def __init__(self, fail_ids=()):
+        """fail_ids: 失敗させたい本文の summary（エラー処理の確認用）"""
+        self.events_data = {}
+        self.fail_ids = set(fail_ids)
+        self.calls = {'insert': 0, 'patch': 0, 'batch': 0}
+        self._ids = itertools.count(1)
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId, body):
+        def run():
+            self.calls['insert'] += 1
+            if body.get('summary') in self.fail_ids: raise RuntimeError("fake: insert failed")
+            event_id = f"evt{next(self._ids)}"
+            self.events_data[event_id] = dict(body, id=event_id)
+            return self.events_data[event_id]
+        return _Request(run)
+
+    def patch(self, calendarId, eventId, body):
+        def run():
+            self.calls['patch'] += 1
+            if eventId not in self.events_data: raise FakeHttpError(404, "Not Found")
+            self.events_data[eventId].update(body)
+            return self.events_data[eventId]
+        return _Request(run)
+
+    def new_batch_http_request(self, callback=None):
+        return _FakeBatch(self, callback)
+
+
+class _FakeBatch:
+    def __init__(self, calendar, callback):
+        self.calendar = calendar
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        self.calendar.calls['batch'] += 1
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.execute(), None
+            except Exception as e:
+                response, exception = None, e
+            if callback: callback(request_id, response, exception)
@@ -0,0 +1,64 @@
+import json
+import threading
+
+# --- Google API クライアントの遅延初期化 ---
+# google-auth / googleapiclient の import は重いので、Google連携を使うリクエストが来るまで読み込まない。
+# build() は呼び出しのたびにディスカバリー文書（数百KBのJSON）を読み込み・解析し直すため、
+# 解析済みの文書を API・バージョンごとに保持し、build_from_document() でサービスを組み立てる。
+# サービスオブジェクト自体は認証情報ごと・スレッドごとに別物が必要なので共有しない。
+
+CLIENT_SECRETS_FILE = "client_secret.json"
+SCOPES = [
+    'openid',
+    'https://www.googleapis.com/auth/userinfo.email',
+    'https://www.googleapis.com/auth/userinfo.profile',
+    'https://www.googleapis.com/auth/classroom.courses.readonly',
+    'https://www.googleapis.com/auth/classroom.coursework.me.readonly',
+    'https://www.googleapis.com/auth/calendar'
+]
+
+_documents = {}   # (api, version) -> 解析済みのディスカバリー文書
+_lock = threading.Lock()
+
+
+def discovery_document(api, version):
+    """ライブラリ同梱のディスカバリー文書を解析して返す（同梱されていなければ None）"""
+    key = (api, version)
+    with _lock:
+        if key in _documents: return _documents[key]
+    from googleapiclient.discovery_cache import get_static_doc
+    text = get_static_doc(api, version)
+    document = json.loads(text) if text else None
+    with _lock:
+        _documents[key] = document
+    return document
+
+
+def build_service(api, version, credentials):
+    from googleapiclient.discovery import build, build_from_document
+    document = discovery_document(api, version)
+    if document is None: return build(api, version, credentials=credentials)
+    return build_from_document(document, credentials=credentials)
+
+
+def load_credentials(credentials_json):
+    """保存済みの認証情報を読み込み、期限切れなら更新する。(認証情報, 更新したか) を返す"""
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+    creds = Credentials.from_authorized_user_info(json.loads(credentials_json), SCOPES)
+    if creds.expired and creds.refresh_token:
+        creds.refresh(Request())
+        return creds, True
+    return creds, False
+
+
+def oauth_flow(redirect_uri, state=None):
+    from google_auth_oauthlib.flow import Flow
+    return Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, state=state, redirect_uri=redirect_uri)
+
+
+def warm_up(apis=(('classroom', 'v1'), ('calendar', 'v3'), ('oauth2', 'v2'))):
+    """ワーカー起動前（gunicorn の preload 時など）にライブラリとディスカバリー文書を読み込んでおく"""
+    import googleapiclient.discovery, google.oauth2.credentials, google_auth_oauthlib.flow  # noqa: F401
+    for api, version in apis:
+        discovery_document(api, version)
@@ -0,0 +1,48 @@
+# gunicorn -c gunicorn.conf.py app:app
+# ★非同期モード: GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py asgi:app
+import glob
+import multiprocessing
+import os
+import tempfile
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', min(4, multiprocessing.cpu_count() * 2 + 1)))
+# 各ワーカーはスレッドでリクエストを処理する（LLM待ちの間も他のリクエストを受けられる）
+# 非同期モードではモデルの応答待ちにスレッドを使わないので、1ワーカーで数百件の待機を抱えられる（threads は使われない）
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 180
+# アプリの import は親プロセスで1回だけ行い、ワーカーはフォークで起動する（起動・再起動が速い）
+# Gemini のクライアントはフォーク後の最初の呼び出しで各ワーカーが作る
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+# メトリクスを全ワーカー分まとめて /metrics に出すための共有ディレクトリ
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f"kosen-metrics-{bind.rsplit(':', 1)[-1]}"))
+
+
+def on_starting(server):
+    # 前回起動時のスナップショットを消してからワーカーを起動する
+    # preload_app ではこの時点でアプリが読み込み済みでディレクトリも作られているので、ディレクトリごとは消さない
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], 'metrics-*.json*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def when_ready(server):
+    # Google API のライブラリとディスカバリー文書も親プロセスで読み込んでおき、ワーカーへ引き継ぐ
+    if not preload_app: return
+    try:
+        import google_services
+        google_services.warm_up()
+    except Exception as e:
+        server.log.warning(f"Google API の事前読み込みに失敗しました: {e}")
+
+
+def post_fork(server, worker):
+    # preload_app 時に親プロセスで作られたDB接続をワーカー間で共有しないよう、フォーク後に作り直す
+    from app import app
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
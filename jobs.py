@@ -0,0 +1,158 @@
+import os
+import socket
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from models import db, GradingJob
+
+# --- 採点ジョブキュー ---
+# 重いマルチモーダル採点をリクエスト処理から切り離し、固定数のバックグラウンドワーカーで実行する。
+# ジョブの状態と結果は GradingJob テーブルに保存するので、どのワーカープロセスからでも参照できる。
+
+_token = (None, None)  # (PID, 起動トークン)。フォーク後は PID が変わるので作り直す
+
+
+def _start_time(pid):
+    """プロセスの起動時刻（/proc/<pid>/stat の starttime）。読めない環境では None"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rpartition(')')[2].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def _boot_token():
+    # 同じ PID が再利用されても別のプロセスと区別できるように、起動時刻（なければ乱数）を添える
+    global _token
+    pid = os.getpid()
+    if _token[0] != pid: _token = (pid, _start_time(pid) or uuid.uuid4().hex[:12])
+    return _token[1]
+
+
+def current_owner():
+    """このプロセスを表す "ホスト名:PID:起動トークン"。preload_app でフォークした各ワーカーで別の値になるよう、呼ぶたびに求める"""
+    return f"{socket.gethostname()}:{os.getpid()}:{_boot_token()}"
+
+class QueueFull(Exception):
+    pass
+
+
+def _owner_alive(owner):
+    host, pid, token = ((owner or '').split(':') + ['', ''])[:3]
+    if host != socket.gethostname() or not pid.isdigit(): return True # 他ホストのジョブは判断できないので触らない
+    pid = int(pid)
+    # 再起動後に同じ PID が割り当てられていても、起動トークンが違えば前のプロセスのジョブ
+    if pid == os.getpid(): return not token or token == _boot_token()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    started = _start_time(pid)
+    return not token or started is None or started == token
+
+
+def _mark_interrupted(job):
+    job.status = 'error'
+    job.error = 'サーバー再起動により採点が中断されました。もう一度送信してください。'
+    job.finished_at = datetime.utcnow()
+
+
+class GradingJobQueue:
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._slots = None
+        if app is not None: self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        workers = app.config.get('GRADING_WORKERS', 4)
+        pending = app.config.get('GRADING_MAX_PENDING', 32)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='grading')
+        # 実行中 + 待機中の上限。超えたら投入を断る（メモリ上に画像を抱え込みすぎないため）
+        self._slots = threading.BoundedSemaphore(workers + pending)
+        # 中断されたジョブの片付けは起動時ではなく最初のリクエストで行う（テーブル作成前でも起動できるように）
+        self._recovered = False
+        self._recover_lock = threading.Lock()
+        app.before_request(self._recover_once)
+
+    def _recover_once(self):
+        if self._recovered: return
+        with self._recover_lock:
+            if self._recovered: return
+            self._recovered = True
+            try:
+                self.recover()
+            except Exception as e:
+                db.session.rollback()
+                print(f"採点ジョブの復旧に失敗しました: {e}")
+
+    def recover(self):
+        """プロセスが落ちて完了しなかったジョブを中断扱いにする（app_context内で呼ぶ）"""
+        stale = GradingJob.query.filter(GradingJob.status.in_(['queued', 'running'])).all()
+        for job in stale:
+            if not _owner_alive(job.owner): _mark_interrupted(job)
+        db.session.commit()
+
+    def submit(self, student_id, mode, fn, *args):
+        """fn(*args) をワーカーで実行するジョブを作成し、ジョブIDを返す。
+
+        fn は結果テキストを返す。fn が session に追加した行はジョブの完了と同じトランザクションでコミットされる。
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull()
+        job = GradingJob(id=uuid.uuid4().hex, student_id=student_id, mode=mode, status='queued', owner=current_owner())
+        db.session.add(job)
+        db.session.commit()
+        try:
+            self._executor.submit(self._run, job.id, fn, args)
+        except Exception:
+            self._slots.release()
+            raise
+        return job.id
+
+    def _run(self, job_id, fn, args):
+        try:
+            with self.app.app_context():
+                job = GradingJob.query.get(job_id)
+                job.status = 'running'
+                job.started_at = datetime.utcnow()
+                db.session.commit()
+                try:
+                    result = fn(*args)
+                    job.status = 'done'
+                    job.result = result
+                except Exception as e:
+                    db.session.rollback()
+                    job = GradingJob.query.get(job_id)
+                    traceback.print_exc()
+                    job.status = 'error'
+                    job.error = str(e)
+                job.finished_at = datetime.utcnow()
+                db.session.commit()
+        finally:
+            self._slots.release()
+
+    def get(self, job_id):
+        job = GradingJob.query.get(job_id)
+        # 実行していたワーカーが落ちた・タイムアウトで再起動されたジョブは、ポーリングのたびに確認して中断扱いにする
+        if job and job.status in ('queued', 'running') and not _owner_alive(job.owner):
+            _mark_interrupted(job)
+            db.session.commit()
+        return job
+
+
+def job_to_dict(job):
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "mode": job.mode,
+        "result": job.result,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
@@ -0,0 +1,389 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from scheduler import LLMScheduler, LLMUnavailable
+import metrics
+import upload_cache
+
+# --- LLMバックエンド ---
+# ルートはモデルオブジェクトを直接触らず、このモジュールの generate() / stream() を通して呼び出す。
+# 'pro' は採点・スライド生成用の高精度モデル、'flash' はチャット・即答用の高速モデル。
+# 呼び出しはすべて LLMScheduler を通り、レート制限・優先度・リトライ・サーキットブレーカーが適用される。
+# LLM_BACKEND=stub にすると実APIを使わないローカルスタブで動作する（負荷試験・ベンチマーク用）。
+# ★非同期モード(asgi.py)では agenerate() / astream() を await し、待っている間はスレッドを使わない。
+
+TIERS = ('pro', 'flash')
+
+
+class LLMError(Exception):
+    pass
+
+
+def _chunk_text(chunk):
+    # ストリームの途中には本文を持たないチャンク(安全性情報のみ等)が混ざることがある
+    try:
+        return chunk.text
+    except (ValueError, AttributeError):
+        return ''
+
+
+class LLMBackend:
+    """generate / ストリーミング / マルチモーダル入力の共通インターフェース
+
+    contents は文字列、または文字列と {"mime_type": ..., "data": bytes} の混在したリスト。
+    """
+
+    # ファイルストアに一度アップロードし、以降はハンドルで参照できるか
+    supports_file_upload = False
+
+    def upload_file(self, path, mime_type):
+        """ファイルをアップロードし、contents に入れられるハンドルを返す"""
+        raise NotImplementedError
+
+    def model_name(self, tier):
+        raise NotImplementedError
+
+    def generate(self, tier, contents, json_mode=False):
+        """応答テキストを返す。json_mode=True ならJSONのみを返すよう指示する"""
+        raise NotImplementedError
+
+    def stream(self, tier, contents):
+        """応答テキストを生成された順に断片ごとに返すイテレータ"""
+        yield self.generate(tier, contents)
+
+    async def agenerate(self, tier, contents, json_mode=False):
+        """generate() の非同期版（非同期APIを持たないバックエンドはスレッドで実行する）"""
+        return await asyncio.to_thread(self.generate, tier, contents, json_mode)
+
+    async def astream(self, tier, contents):
+        yield await self.agenerate(tier, contents)
+
+
+class GeminiBackend(LLMBackend):
+    MODEL_NAMES = {'pro': 'gemini-3-pro-preview', 'flash': 'gemini-3-flash-preview'}
+    FALLBACK_NAMES = {'pro': 'gemini-1.5-pro', 'flash': 'gemini-1.5-flash'}
+
+    def __init__(self, api_key=None, model_names=None):
+        import google.generativeai as genai
+        self._genai = genai
+        api_key = api_key or os.environ.get("GOOGLE_API_KEY")
+        if api_key:
+            genai.configure(api_key=api_key)
+        else:
+            print("エラー: GOOGLE_API_KEYが設定されていません。")
+        names = dict(self.MODEL_NAMES, **(model_names or {}))
+        try:
+            self._models = {tier: genai.GenerativeModel(names[tier]) for tier in TIERS}
+        except Exception as e:
+            print(f"モデル初期化エラー: {e}")
+            # フォールバック（万が一Gemini 3が使えない場合）
+            self._models = {tier: genai.GenerativeModel(self.FALLBACK_NAMES[tier]) for tier in TIERS}
+
+    supports_file_upload = True
+
+    def model_name(self, tier):
+        return self._models[tier].model_name
+
+    def upload_file(self, path, mime_type):
+        return self._genai.upload_file(path=path, mime_type=mime_type)
+
+    def generate(self, tier, contents, json_mode=False):
+        kwargs = {}
+        if json_mode: kwargs['generation_config'] = {"response_mime_type": "application/json"}
+        response = self._models[tier].generate_content(contents, **kwargs)
+        self._record_usage(tier, response)
+        return response.text
+
+    def stream(self, tier, contents):
+        response = self._models[tier].generate_content(contents, stream=True)
+        for chunk in response:
+            text = _chunk_text(chunk)
+            if text: yield text
+        self._record_usage(tier, response)
+
+    async def agenerate(self, tier, contents, json_mode=False):
+        kwargs = {}
+        if json_mode: kwargs['generation_config'] = {"response_mime_type": "application/json"}
+        response = await self._models[tier].generate_content_async(contents, **kwargs)
+        self._record_usage(tier, response)
+        return response.text
+
+    async def astream(self, tier, contents):
+        response = await self._models[tier].generate_content_async(contents, stream=True)
+        async for chunk in response:
+            text = _chunk_text(chunk)
+            if text: yield text
+        self._record_usage(tier, response)
+
+    def _record_usage(self, tier, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None: return
+        metrics.record_tokens(self.model_name(tier), getattr(usage, 'prompt_token_count', 0) or 0,
+                              getattr(usage, 'candidates_token_count', 0) or 0)
+
+
+class StubFile:
+    """スタブのファイルストアに置いたファイルのハンドル"""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+class StubError(LLMError):
+    """スタブが注入する擬似的な上流エラー"""
+
+
+class StubBackend(LLMBackend):
+    """実APIを呼ばない決定的なスタブ。遅延・エラー率・応答サイズを設定できる"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, response_chars=800, stream_chunks=8, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.response_chars = response_chars
+        self.stream_chunks = max(1, stream_chunks)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    supports_file_upload = True
+
+    def model_name(self, tier):
+        return f"stub-{tier}"
+
+    def upload_file(self, path, mime_type):
+        time.sleep(self.latency / 2)
+        return StubFile(f"files/{os.path.basename(path)[:16]}", os.path.getsize(path))
+
+    def _draw(self):
+        with self._lock:
+            return self._rng.random(), self._rng.random()
+
+    def _prompt_text(self, contents):
+        if isinstance(contents, str): return contents
+        parts = []
+        for c in contents:
+            if isinstance(c, str): parts.append(c)
+            elif isinstance(c, dict): parts.append(f"<{c.get('mime_type')}:{len(c.get('data') or b'')}>")
+            elif isinstance(c, StubFile): parts.append(f"<{c.name}>")
+            else: parts.append(f"<{type(c).__name__}>")
+        return '\n'.join(parts)
+
+    def _filler(self, seed_text, n):
+        digest = hashlib.sha256(seed_text.encode('utf-8')).hexdigest()
+        body = f"スタブ応答 {digest[:12]}。$E = mc^2$ を例に解説します。"
+        return (body * (n // len(body) + 1))[:n]
+
+    def _respond(self, tier, contents, json_mode):
+        fail, jitter = self._draw()
+        time.sleep(self.latency + self.jitter * jitter)
+        return self._answer(tier, contents, json_mode, fail)
+
+    async def _arespond(self, tier, contents, json_mode):
+        fail, jitter = self._draw()
+        await asyncio.sleep(self.latency + self.jitter * jitter)
+        return self._answer(tier, contents, json_mode, fail)
+
+    def _answer(self, tier, contents, json_mode, fail):
+        prompt = self._prompt_text(contents)
+        if fail < self.error_rate:
+            raise StubError("stub: injected upstream error")
+        # ルートが期待する形式（スライド区切り・JSON）に合わせた応答を返す
+        if 'JSON配列' in prompt:
+            return json.dumps([{"q_id": i, "question": f"問題{i}: {self._filler(prompt + str(i), 40)}"} for i in (1, 2, 3)], ensure_ascii=False)
+        if '---SLIDE_BREAK---' in prompt:
+            per = max(1, self.response_chars // 5)
+            return '\n---SLIDE_BREAK---\n'.join(f"# スライド {i+1}\n\n{self._filler(prompt + str(i), per)}" for i in range(5))
+        if json_mode:
+            return json.dumps({"score": int(hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 16) % 101,
+                               "feedback": self._filler(prompt, min(self.response_chars, 200))}, ensure_ascii=False)
+        return self._filler(f"{tier}:{prompt}", self.response_chars)
+
+    def _record_usage(self, tier, contents, text):
+        # 実際のトークナイザーは使わず、日本語でおおよそ1文字1トークンとして数える
+        metrics.record_tokens(self.model_name(tier), len(self._prompt_text(contents)), len(text))
+
+    def generate(self, tier, contents, json_mode=False):
+        text = self._respond(tier, contents, json_mode)
+        self._record_usage(tier, contents, text)
+        return text
+
+    def stream(self, tier, contents):
+        text = self._respond(tier, contents, False)
+        self._record_usage(tier, contents, text)
+        step = max(1, len(text) // self.stream_chunks)
+        for i in range(0, len(text), step):
+            yield text[i:i + step]
+
+    async def agenerate(self, tier, contents, json_mode=False):
+        text = await self._arespond(tier, contents, json_mode)
+        self._record_usage(tier, contents, text)
+        return text
+
+    async def astream(self, tier, contents):
+        text = await self._arespond(tier, contents, False)
+        self._record_usage(tier, contents, text)
+        step = max(1, len(text) // self.stream_chunks)
+        for i in range(0, len(text), step):
+            yield text[i:i + step]
+
+
+def create_backend(config):
+    kind = config.get('LLM_BACKEND', 'gemini')
+    if kind == 'stub':
+        return StubBackend(
+            latency=float(config.get('LLM_STUB_LATENCY', 0.0)),
+            jitter=float(config.get('LLM_STUB_JITTER', 0.0)),
+            error_rate=float(config.get('LLM_STUB_ERROR_RATE', 0.0)),
+            response_chars=int(config.get('LLM_STUB_RESPONSE_CHARS', 800)),
+            seed=int(config.get('LLM_STUB_SEED', 0)),
+        )
+    if kind == 'gemini':
+        return GeminiBackend()
+    raise ValueError(f"不明なLLM_BACKENDです: {kind}")
+
+
+def create_scheduler(config):
+    limits = {
+        'pro': {"rpm": int(config.get('LLM_PRO_RPM', 60)), "burst": int(config.get('LLM_PRO_BURST', 10)),
+                "max_inflight": int(config.get('LLM_PRO_MAX_INFLIGHT', 8))},
+        'flash': {"rpm": int(config.get('LLM_FLASH_RPM', 300)), "burst": int(config.get('LLM_FLASH_BURST', 30)),
+                  "max_inflight": int(config.get('LLM_FLASH_MAX_INFLIGHT', 32))},
+    }
+    return LLMScheduler(
+        limits,
+        fallbacks={'pro': 'flash'},  # pro が不調なときは flash で代替する
+        max_retries=int(config.get('LLM_MAX_RETRIES', 3)),
+        queue_timeout=float(config.get('LLM_QUEUE_TIMEOUT', 60)),
+        breaker_threshold=int(config.get('LLM_BREAKER_THRESHOLD', 5)),
+        breaker_reset=float(config.get('LLM_BREAKER_RESET', 30)),
+    )
+
+
+_backend = None
+_scheduler = None
+_config = {}
+_backend_lock = threading.Lock()
+
+def init_app(app):
+    """バックエンドは最初に使うときに作る（Gemini のクライアント生成は重く、フォーク前に作るべきでもないため）"""
+    global _scheduler, _config
+    _config = app.config
+    set_backend(None)
+    _scheduler = create_scheduler(app.config)
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if not _config: raise LLMError("LLMバックエンドが初期化されていません")
+                _backend = create_backend(_config)
+    return _backend
+
+def model_name(tier):
+    return get_backend().model_name(tier)
+
+def _timed_generate(backend, tier, contents, json_mode):
+    model = backend.model_name(tier)
+    start = time.perf_counter()
+    try:
+        result = backend.generate(tier, contents, json_mode=json_mode)
+    except Exception as e:
+        metrics.record_llm_call(model, 'generate', time.perf_counter() - start, e)
+        raise
+    metrics.record_llm_call(model, 'generate', time.perf_counter() - start)
+    return result
+
+def _timed_stream(backend, tier, contents):
+    model = backend.model_name(tier)
+    start = time.perf_counter()
+    first = True
+    try:
+        for piece in backend.stream(tier, contents):
+            if first:
+                metrics.llm_first_chunk.observe(time.perf_counter() - start, model=model)
+                first = False
+            yield piece
+    except Exception as e:
+        metrics.record_llm_call(model, 'stream', time.perf_counter() - start, e)
+        raise
+    metrics.record_llm_call(model, 'stream', time.perf_counter() - start)
+
+async def _atimed_generate(backend, tier, contents, json_mode):
+    model = backend.model_name(tier)
+    start = time.perf_counter()
+    try:
+        result = await backend.agenerate(tier, contents, json_mode=json_mode)
+    except Exception as e:
+        metrics.record_llm_call(model, 'generate', time.perf_counter() - start, e)
+        raise
+    metrics.record_llm_call(model, 'generate', time.perf_counter() - start)
+    return result
+
+async def _atimed_stream(backend, tier, contents):
+    model = backend.model_name(tier)
+    start = time.perf_counter()
+    first = True
+    try:
+        async for piece in backend.astream(tier, contents):
+            if first:
+                metrics.llm_first_chunk.observe(time.perf_counter() - start, model=model)
+                first = False
+            yield piece
+    except Exception as e:
+        metrics.record_llm_call(model, 'stream', time.perf_counter() - start, e)
+        raise
+    metrics.record_llm_call(model, 'stream', time.perf_counter() - start)
+
+def generate(tier, contents, json_mode=False, priority='normal', allow_fallback=True):
+    """priority: 'interactive'(チャット) / 'normal' / 'batch'(採点・事前生成)"""
+    backend = get_backend()
+    # ディスクにキャッシュした画像は、呼び出し直前にファイルハンドルかバイト列へ変換する
+    contents = upload_cache.cache.resolve(contents, backend)
+    return _scheduler.call(tier, lambda use: _timed_generate(backend, use, contents, json_mode),
+                           priority=priority, allow_fallback=allow_fallback)
+
+def stream(tier, contents, priority='normal', allow_fallback=True):
+    backend = get_backend()
+    contents = upload_cache.cache.resolve(contents, backend)
+    return _scheduler.stream(tier, lambda use: _timed_stream(backend, use, contents),
+                             priority=priority, allow_fallback=allow_fallback)
+
+async def _aresolve(contents, backend):
+    # 画像を含む場合だけアップロード・ファイル読み込みをスレッドで行う
+    if isinstance(contents, str) or not any(isinstance(c, upload_cache.CachedImage) for c in contents): return contents
+    return await asyncio.to_thread(upload_cache.cache.resolve, contents, backend)
+
+async def agenerate(tier, contents, json_mode=False, priority='normal', allow_fallback=True):
+    """generate() の非同期版"""
+    backend = get_backend()
+    contents = await _aresolve(contents, backend)
+    return await _scheduler.acall(tier, lambda use: _atimed_generate(backend, use, contents, json_mode),
+                                  priority=priority, allow_fallback=allow_fallback)
+
+async def astream(tier, contents, priority='normal', allow_fallback=True):
+    """stream() の非同期版（非同期イテレータ）"""
+    backend = get_backend()
+    contents = await _aresolve(contents, backend)
+    async for piece in _scheduler.astream(tier, lambda use: _atimed_stream(backend, use, contents),
+                                          priority=priority, allow_fallback=allow_fallback):
+        yield piece
+
+def stats():
+    return _scheduler.stats()
+
+
+# 待ち行列の長さと実行中の呼び出し数を /metrics に出す
+metrics.registry.gauge('llm_queue_depth', 'モデルごとの待ち行列の長さ', ('tier',),
+                       fn=lambda: {(tier,): s['queue_depth'] for tier, s in stats().items()})
+metrics.registry.gauge('llm_inflight', 'モデルごとの実行中の呼び出し数', ('tier',),
+                       fn=lambda: {(tier,): s['inflight'] for tier, s in stats().items()})
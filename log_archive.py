@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+from sqlalchemy import func, text
+from sqlalchemy.orm import joinedload
+from models import (db, CompressedText, LessonLog, QuizLog, GradingLog, GeneratedContent,
+                    ArchivedLessonLog, ArchivedQuizLog, ArchivedGradingLog)
+
+# --- 古いログのアーカイブと、既存の行の圧縮 ---
+# アーカイブは別のデータベースファイルへ行を移す（flask archive-logs）。
+# 2つのDBをまたぐトランザクションは使えないので、アーカイブ側に書いてコミットしてから元の行を削除する。
+# 途中で止まっても、アーカイブ側は元と同じIDで merge するのでやり直せば重複しない。
+
+def _lesson_row(log):
+    return dict(id=log.id, assignment_id=log.assignment_id, student_id=log.student_id,
+                slides_content=log.slides, created_at=log.created_at)
+
+def _quiz_row(log):
+    return dict(id=log.id, assignment_id=log.assignment_id, student_id=log.student_id, questions=log.questions,
+                student_answers=log.student_answers, grading_result=log.grading_result, score=log.score,
+                created_at=log.created_at)
+
+def _grading_row(log):
+    return dict(id=log.id, student_id=log.student_id, mode=log.mode, input_text=log.input_text,
+                feedback_content=log.feedback_content, created_at=log.created_at)
+
+ARCHIVE_PLAN = [
+    (LessonLog, ArchivedLessonLog, _lesson_row, [joinedload(LessonLog.content)]),
+    (QuizLog, ArchivedQuizLog, _quiz_row, []),
+    (GradingLog, ArchivedGradingLog, _grading_row, []),
+]
+
+
+def archive_logs(days, batch_size=500):
+    """created_at が days 日より前のログをアーカイブDBへ移し、テーブルごとの件数を返す"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved = {}
+    for model, archived, to_row, options in ARCHIVE_PLAN:
+        count = 0
+        while True:
+            rows = model.query.options(*options).filter(model.created_at < cutoff).order_by(model.id).limit(batch_size).all()
+            if not rows: break
+            for row in rows:
+                db.session.merge(archived(**to_row(row)))
+            db.session.commit()
+            model.query.filter(model.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+            db.session.commit()
+            db.session.expunge_all()
+            count += len(rows)
+        moved[model.__tablename__] = count
+    return moved
+
+
+# 圧縮列を導入する前に保存された（平文のままの）行を圧縮し直す
+COMPRESSED_COLUMNS = [
+    (GeneratedContent, 'content'),
+    (LessonLog, 'slides_content'),
+    (QuizLog, 'grading_result'),
+    (GradingLog, 'input_text'),
+    (GradingLog, 'feedback_content'),
+]
+
+def compress_existing(batch_size=500):
+    """平文のまま残っている長い値を圧縮して書き直し、書き直した件数を返す（SQLiteのみ）"""
+    if db.engine.dialect.name != 'sqlite': return 0
+    total = 0
+    for model, name in COMPRESSED_COLUMNS:
+        table = model.__table__
+        column = table.c[name]
+        last_id = 0
+        while True:
+            # typeof() が 'text' の行だけが未圧縮（圧縮済みは 'blob'）
+            rows = db.session.execute(
+                db.select(table.c.id, column)
+                .where(table.c.id > last_id, func.typeof(column) == 'text',
+                       func.length(db.cast(column, db.LargeBinary)) >= CompressedText.MIN_SIZE)
+                .order_by(table.c.id).limit(batch_size)).all()
+            if not rows: break
+            for row_id, value in rows:
+                db.session.execute(table.update().where(table.c.id == row_id).values({name: value}))
+            db.session.commit()
+            last_id = rows[-1][0]
+            total += len(rows)
+    return total
+
+
+def vacuum(bind_key=None):
+    """削除・圧縮で空いた領域を解放してファイルを小さくする"""
+    engine = db.engines[bind_key]
+    if engine.dialect.name != 'sqlite': return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text('VACUUM'))
@@ -0,0 +1,99 @@
+import csv
+import io
+import json
+from datetime import datetime
+from models import (db, User, Assignment, LessonLog, QuizLog, GradingLog, GeneratedContent,
+                    ArchivedLessonLog, ArchivedQuizLog, ArchivedGradingLog)
+
+# --- ログのエクスポート（CSV / JSONL） ---
+# 1学期分のログでもメモリを一定に保てるよう、DBから yield_per で少しずつ読みながら1行ずつ書き出す。
+# 生徒名は行ごとに JOIN せず、最初にユーザー一覧（小さい表）を辞書にして引く。
+
+BATCH_SIZE = 500
+
+EXPORT_FIELDS = {
+    'lessons': ['id', 'assignment_id', 'assignment_title', 'student', 'slides', 'created_at'],
+    'quizzes': ['id', 'assignment_id', 'assignment_title', 'student', 'score', 'questions', 'student_answers', 'grading_result', 'created_at'],
+    'grading': ['id', 'student', 'mode', 'input_text', 'feedback_content', 'created_at'],
+}
+
+
+def _stream(query):
+    return query.execution_options(yield_per=BATCH_SIZE)
+
+
+def _lessons(assignments, archived):
+    ids = list(assignments)
+    if archived:
+        yield from db.session.execute(_stream(db.select(
+            ArchivedLessonLog.id, ArchivedLessonLog.assignment_id, ArchivedLessonLog.student_id,
+            ArchivedLessonLog.slides_content, ArchivedLessonLog.created_at)
+            .where(ArchivedLessonLog.assignment_id.in_(ids)).order_by(ArchivedLessonLog.id)))
+    # 共有キャッシュを参照している行は、キャッシュ側の本文を出力する
+    for row_id, aid, sid, own, shared, created_at in db.session.execute(_stream(db.select(
+            LessonLog.id, LessonLog.assignment_id, LessonLog.student_id,
+            LessonLog.slides_content, GeneratedContent.content, LessonLog.created_at)
+            .outerjoin(GeneratedContent, LessonLog.content_id == GeneratedContent.id)
+            .where(LessonLog.assignment_id.in_(ids)).order_by(LessonLog.id))):
+        yield row_id, aid, sid, shared if shared is not None else own, created_at
+
+
+def _quizzes(assignments, archived):
+    ids = list(assignments)
+    models = ([ArchivedQuizLog] if archived else []) + [QuizLog]
+    for model in models:
+        yield from db.session.execute(_stream(db.select(
+            model.id, model.assignment_id, model.student_id, model.score, model.questions,
+            model.student_answers, model.grading_result, model.created_at)
+            .where(model.assignment_id.in_(ids)).order_by(model.id)))
+
+
+def _grading(archived):
+    models = ([ArchivedGradingLog] if archived else []) + [GradingLog]
+    for model in models:
+        yield from db.session.execute(_stream(db.select(
+            model.id, model.student_id, model.mode, model.input_text, model.feedback_content, model.created_at)
+            .order_by(model.id)))
+
+
+def iter_records(kind, teacher_id, archived=False):
+    """エクスポートする行を dict で1件ずつ返す。授業・確認テストは先生自身の課題のものだけ"""
+    users = dict(db.session.query(User.id, User.username))
+    if kind == 'grading':
+        for row_id, sid, mode, input_text, feedback, created_at in _grading(archived):
+            yield {'id': row_id, 'student': users.get(sid), 'mode': mode, 'input_text': input_text,
+                   'feedback_content': feedback, 'created_at': created_at}
+        return
+    assignments = dict(db.session.query(Assignment.id, Assignment.title).filter_by(created_by=teacher_id))
+    if kind == 'lessons':
+        for row_id, aid, sid, slides, created_at in _lessons(assignments, archived):
+            yield {'id': row_id, 'assignment_id': aid, 'assignment_title': assignments.get(aid),
+                   'student': users.get(sid), 'slides': slides, 'created_at': created_at}
+    elif kind == 'quizzes':
+        for row_id, aid, sid, score, questions, answers, result, created_at in _quizzes(assignments, archived):
+            yield {'id': row_id, 'assignment_id': aid, 'assignment_title': assignments.get(aid),
+                   'student': users.get(sid), 'score': score, 'questions': questions,
+                   'student_answers': answers, 'grading_result': result, 'created_at': created_at}
+
+
+def _value(v):
+    return v.isoformat() if isinstance(v, datetime) else v
+
+
+def to_csv(records, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # Excel で開いても文字化けしないよう BOM を付ける
+    buffer.write('\ufeff')
+    writer.writerow(fields)
+    for record in records:
+        writer.writerow([_value(record.get(f)) for f in fields])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def to_jsonl(records):
+    for record in records:
+        yield json.dumps({k: _value(v) for k, v in record.items()}, ensure_ascii=False) + '\n'
@@ -0,0 +1,333 @@
+import glob
+import json
+import os
+import threading
+import time
+from flask import g, has_request_context, request, Response, abort
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# --- メトリクスとリクエストごとの内訳 ---
+#   - ルートごとのリクエスト処理時間（ヒストグラム）
+#   - モデルごとの呼び出し時間・エラー数・トークン使用量
+#   - リクエストごとのDBクエリ数・クエリ時間、テンプレート描画時間
+# /metrics で Prometheus のテキスト形式で公開する。SERVER_TIMING=1 なら各レスポンスに
+# Server-Timing ヘッダー（db / llm / tpl / app の内訳）を付け、ブラウザの開発者ツールで確認できる。
+#
+# gunicorn の複数ワーカーでは値がプロセスごとに分かれるので、METRICS_DIR を設定すると
+# 各プロセスが定期的にスナップショットを書き出し、/metrics は全プロセス分を合算して返す。
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _fmt(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), v] for k, v in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def merge(self, merged, values):
+        for key, v in values:
+            merged[tuple(key)] = merged.get(tuple(key), 0) + v
+
+    def lines(self, values):
+        return [f"{self.name}{_labels_text(self.labels, k)} {_fmt(v)}" for k, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]  # バケットごとの件数, 合計件数, 合計値
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), [list(s[0]), s[1], s[2]]] for k, s in self._values.items()]
+
+    def merge(self, merged, values):
+        for key, (counts, n, total) in values:
+            state = merged.setdefault(tuple(key), [[0] * len(self.buckets), 0, 0.0])
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += n
+            state[2] += total
+
+    def lines(self, values):
+        out = []
+        for k, (counts, n, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                out.append(f"{self.name}_bucket{_labels_text(self.labels, k, [('le', _fmt(bound))])} {cumulative}")
+            out.append(f"{self.name}_bucket{_labels_text(self.labels, k, [('le', '+Inf')])} {n}")
+            out.append(f"{self.name}_sum{_labels_text(self.labels, k)} {_fmt(total)}")
+            out.append(f"{self.name}_count{_labels_text(self.labels, k)} {n}")
+        return out
+
+
+class Gauge(_Metric):
+    """取得時に fn() を呼んで {ラベル値のタプル: 値} を得る（待ち行列の長さなど）"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), fn=None):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
+
+    def snapshot(self):
+        try:
+            return [[list(map(str, k)), v] for k, v in (self.fn() if self.fn else {}).items()]
+        except Exception:
+            return []
+
+    def merge(self, merged, values):
+        for key, v in values:
+            merged[tuple(key)] = merged.get(tuple(key), 0) + v
+
+    lines = Counter.lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self.flush_interval = 5.0
+        self._flushed_at = 0.0
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def snapshot(self):
+        return {m.name: m.snapshot() for m in self.metrics}
+
+    # --- 複数プロセスの合算 ---
+    def _path(self, pid):
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def flush(self, force=False):
+        if not self.directory: return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < self.flush_interval: return
+        self._flushed_at = now
+        path = self._path(os.getpid())
+        tmp = f"{path}.tmp"
+        try:
+            # 起動後にディレクトリが消されていても作り直す。書き込めなくてもリクエストは失敗させない
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"メトリクスの書き出しに失敗しました: {e}")
+
+    def _snapshots(self):
+        if not self.directory: return [self.snapshot()]
+        self.flush(force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # 終了したワーカーの累計値は残し、その時点の値（ゲージ）は捨てる
+            if not _alive(pid):
+                data = {name: v for name, v in data.items() if not isinstance(self._by_name(name), Gauge)}
+            snapshots.append(data)
+        return snapshots
+
+    def _by_name(self, name):
+        return next((m for m in self.metrics if m.name == name), None)
+
+    def render(self):
+        snapshots = self._snapshots()
+        out = []
+        for m in self.metrics:
+            merged = {}
+            for data in snapshots:
+                m.merge(merged, data.get(m.name, []))
+            out.append(f"# HELP {m.name} {m.help}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(m.lines(merged))
+        return '\n'.join(out) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+
+http_requests = registry.counter('http_requests_total', 'HTTPリクエスト数', ('endpoint', 'method', 'status'))
+http_latency = registry.histogram('http_request_duration_seconds', 'リクエストの処理時間（ストリーミングは送信完了まで）', ('endpoint', 'method'))
+db_queries = registry.histogram('http_request_db_queries', '1リクエストあたりのDBクエリ数', ('endpoint',), buckets=COUNT_BUCKETS)
+db_time = registry.histogram('http_request_db_seconds', '1リクエストあたりのDBクエリ時間', ('endpoint',))
+template_time = registry.histogram('http_request_template_seconds', '1リクエストあたりのテンプレート描画時間', ('endpoint',))
+llm_latency = registry.histogram('llm_call_duration_seconds', 'モデル呼び出しの時間（ストリーミングは最後の断片まで）', ('model', 'kind'))
+llm_first_chunk = registry.histogram('llm_stream_first_chunk_seconds', 'ストリーミングで最初の断片が届くまでの時間', ('model',))
+llm_errors = registry.counter('llm_call_errors_total', 'モデル呼び出しのエラー数', ('model', 'error'))
+llm_tokens = registry.counter('llm_tokens_total', 'モデルのトークン使用量', ('model', 'direction'))
+
+
+# --- 記録用の関数（リクエスト外のワーカースレッドから呼ばれても動く） ---
+def _request_timings():
+    if not has_request_context(): return None
+    return g.setdefault('_timings', {"db": 0.0, "db_count": 0, "llm": 0.0, "llm_count": 0, "tpl": 0.0})
+
+def record_llm_call(model, kind, seconds, error=None):
+    llm_latency.observe(seconds, model=model, kind=kind)
+    if error is not None: llm_errors.inc(model=model, error=type(error).__name__)
+    timings = _request_timings()
+    if timings is not None:
+        timings["llm"] += seconds
+        timings["llm_count"] += 1
+
+def record_tokens(model, prompt_tokens, output_tokens):
+    if prompt_tokens: llm_tokens.inc(prompt_tokens, model=model, direction='prompt')
+    if output_tokens: llm_tokens.inc(output_tokens, model=model, direction='output')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    _record_query(conn.info['_query_started'].pop())
+
+@event.listens_for(Engine, 'handle_error')
+def _query_failed(context):
+    # 失敗したクエリは after_cursor_execute が呼ばれないので、ここで開始時刻を取り除く
+    # （接続プールで使い回される接続に溜まり続けないように）
+    conn = context.connection
+    started = conn.info.get('_query_started') if conn is not None else None
+    if started: _record_query(started.pop())
+
+def _record_query(started):
+    timings = _request_timings()
+    if timings is not None:
+        timings["db"] += time.perf_counter() - started
+        timings["db_count"] += 1
+
+
+def _before_render(sender, template, context, **extra):
+    g._template_started = time.perf_counter()
+
+def _after_render(sender, template, context, **extra):
+    started = g.pop('_template_started', None)
+    if started is not None: _request_timings()["tpl"] += time.perf_counter() - started
+
+
+# --- Flask への組み込み ---
+def init_app(app):
+    registry.directory = app.config.get('METRICS_DIR') or None
+    if registry.directory: os.makedirs(registry.directory, exist_ok=True)
+    server_timing = bool(app.config.get('SERVER_TIMING'))
+    token = app.config.get('METRICS_TOKEN')
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def _start_timer():
+        g._request_started = time.perf_counter()
+        _request_timings()
+
+    @app.after_request
+    def _server_timing(response):
+        if server_timing and '_request_started' in g:
+            t = g._timings
+            total = (time.perf_counter() - g._request_started) * 1000
+            response.headers['Server-Timing'] = ', '.join([
+                f'db;dur={t["db"] * 1000:.1f};desc="{t["db_count"]} queries"',
+                f'llm;dur={t["llm"] * 1000:.1f};desc="{t["llm_count"]} calls"',
+                f'tpl;dur={t["tpl"] * 1000:.1f}',
+                f'app;dur={total:.1f}',
+            ])
+        g._status = response.status_code
+        return response
+
+    # ストリーミング応答では teardown は送信完了後に呼ばれるので、全体の時間を記録できる
+    @app.teardown_request
+    def _record_request(exc):
+        if '_request_started' not in g: return
+        endpoint = request.endpoint or 'unknown'
+        if endpoint == 'metrics_endpoint': return
+        t = g._timings
+        status = g.get('_status', 500)
+        http_requests.inc(endpoint=endpoint, method=request.method, status=status)
+        http_latency.observe(time.perf_counter() - g._request_started, endpoint=endpoint, method=request.method)
+        db_queries.observe(t["db_count"], endpoint=endpoint)
+        db_time.observe(t["db"], endpoint=endpoint)
+        template_time.observe(t["tpl"], endpoint=endpoint)
+        registry.flush()
+
+    @app.route('/metrics', endpoint='metrics_endpoint')
+    def metrics_endpoint():
+        # METRICS_TOKEN を設定した場合は Authorization: Bearer <token> が必要
+        if token and request.headers.get('Authorization') != f"Bearer {token}": abort(401)
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
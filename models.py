@@ -1,8 +1,35 @@
+import zlib
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.types import TypeDecorator, Text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 
 db = SQLAlchemy()
 
+
+# ★長いテキスト列の圧縮保存
+# SQLite では zlib で圧縮したバイト列(BLOB)をそのまま TEXT 列に保存できるので、スキーマを変えずに導入できる。
+# 読み出し時は、バイト列なら展開し、文字列（圧縮導入前の行・短い値）ならそのまま返す。
+# SQLite 以外のDBでは型が合わないため圧縮せずに保存する。
+class CompressedText(TypeDecorator):
+    impl = Text
+    cache_ok = True
+
+    MIN_SIZE = 256  # これより短い値は圧縮しても小さくならないのでそのまま保存する
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name != 'sqlite': return value
+        data = value.encode('utf-8')
+        if len(data) < self.MIN_SIZE: return value
+        return zlib.compress(data, 6)
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, (bytes, memoryview)): return zlib.decompress(value).decode('utf-8')
+        return value
+
+
 # ユーザー
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -16,12 +43,40 @@ class Assignment(db.Model):
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=True)
     # created_by が先生なら「課題」、生徒なら「自主学習」と判断する
-    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # リレーション
     creator = db.relationship('User', backref='assignments')
 
+# ★課題ごとの集計（先生のダッシュボード用）
+# LessonLog / QuizLog の書き込みと同じトランザクションで assignment_stats.py が加算していくので、
+# ダッシュボードはログのテーブルを走査せずにこの1行を読むだけで済む。
+class AssignmentStats(db.Model):
+    assignment_id = db.Column(db.Integer, db.ForeignKey('assignment.id'), primary_key=True)
+    lesson_count = db.Column(db.Integer, nullable=False, default=0)  # 授業を受けた生徒数
+    graded_count = db.Column(db.Integer, nullable=False, default=0)  # 確認テストを採点済みの生徒数
+    score_sum = db.Column(db.Integer, nullable=False, default=0)
+    # 点数の分布（0-19, 20-39, 40-59, 60-79, 80-100点）
+    score_bin_0 = db.Column(db.Integer, nullable=False, default=0)
+    score_bin_1 = db.Column(db.Integer, nullable=False, default=0)
+    score_bin_2 = db.Column(db.Integer, nullable=False, default=0)
+    score_bin_3 = db.Column(db.Integer, nullable=False, default=0)
+    score_bin_4 = db.Column(db.Integer, nullable=False, default=0)
+    last_activity_at = db.Column(db.DateTime, nullable=True)
+
+    assignment = db.relationship('Assignment', backref=db.backref('stats', uselist=False))
+
+    SCORE_BINS = ('0-19', '20-39', '40-59', '60-79', '80-100')
+
+    @property
+    def score_mean(self):
+        return self.score_sum / self.graded_count if self.graded_count else None
+
+    @property
+    def score_histogram(self):
+        return [getattr(self, f'score_bin_{i}') for i in range(len(self.SCORE_BINS))]
+
 # レポート（自由学習ツール用として残す）
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -30,26 +85,71 @@ class Report(db.Model):
     feedback = db.Column(db.Text)
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+# ★生成結果の共有キャッシュ（プロンプト+モデル名のハッシュがキー）
+class GeneratedContent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)
+    model_name = db.Column(db.String(100), nullable=False)
+    content = db.Column(CompressedText, nullable=False)
+    assignment_id = db.Column(db.Integer, db.ForeignKey('assignment.id'), nullable=True) # 生成元の課題（参考情報）
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# ★TAチャットの回答キャッシュ（全ワーカーで共有する。question は正規化した質問）
+class CachedAnswer(db.Model):
+    __table_args__ = (db.Index('ux_cached_answer_slide_question', 'assignment_id', 'slide_hash', 'question', unique=True),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    assignment_id = db.Column(db.Integer, nullable=True)
+    slide_hash = db.Column(db.String(64), nullable=False)
+    question = db.Column(db.Text, nullable=False)
+    answer = db.Column(CompressedText, nullable=False)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# ★Markdown(+数式)をサーバー側でHTMLにした結果のキャッシュ（キーは描画方式のバージョンと本文のハッシュ）
+class RenderedContent(db.Model):
+    key = db.Column(db.String(64), primary_key=True)
+    html = db.Column(CompressedText, nullable=False)  # HTML断片のJSON配列（スライドなら1枚ずつ）
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # 授業スライドの保存用
 class LessonLog(db.Model):
+    # 1人の生徒につき1課題1行（同時クリックによる重複生成を防ぐ）
+    __table_args__ = (db.Index('ux_lesson_log_assignment_student', 'assignment_id', 'student_id', unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     assignment_id = db.Column(db.Integer, db.ForeignKey('assignment.id'))
-    student_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    slides_content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    slides_content = db.Column(CompressedText, nullable=False, default='') # 共有キャッシュを参照する場合は空
+    content_id = db.Column(db.Integer, db.ForeignKey('generated_content.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    content = db.relationship('GeneratedContent')
+
+    @property
+    def slides(self):
+        """共有キャッシュを参照していればその本文、なければ自身に保存された本文"""
+        return self.content.content if self.content_id else self.slides_content
 
 # ★新規追加: 確認テストの記録用
 class QuizLog(db.Model):
+    __table_args__ = (db.Index('ux_quiz_log_assignment_student', 'assignment_id', 'student_id', unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     assignment_id = db.Column(db.Integer, db.ForeignKey('assignment.id'))
-    student_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     
     questions = db.Column(db.Text, nullable=False)      # AIが作った問題文(JSON文字列)
     student_answers = db.Column(db.Text, nullable=True) # 生徒の回答(JSON文字列)
-    grading_result = db.Column(db.Text, nullable=True)  # AIの採点結果
+    grading_result = db.Column(CompressedText, nullable=True)  # AIの採点結果
     score = db.Column(db.Integer, default=0)            # 点数（100点満点など）
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # ★授業の生成直後にバックグラウンドで事前生成したか、生徒が最初に開いた日時（事前生成の利用率の集計用）
+    pregenerated = db.Column(db.Boolean, default=False)
+    opened_at = db.Column(db.DateTime, nullable=True)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # リレーション
     student = db.relationship('User', backref='quiz_logs')
@@ -58,11 +158,174 @@ class QuizLog(db.Model):
 # 自由学習ツール・画像採点の履歴
 class GradingLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    student_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     mode = db.Column(db.String(20)) 
-    input_text = db.Column(db.Text, nullable=True)
+    input_text = db.Column(CompressedText, nullable=True)
     input_image = db.Column(db.Text, nullable=True)
-    feedback_content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    feedback_content = db.Column(CompressedText, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
-    student = db.relationship('User', backref='grading_logs', lazy=True)
\ No newline at end of file
+    student = db.relationship('User', backref='grading_logs', lazy=True)
+
+# ★TAチャットの会話（生徒×授業ごとに1行）。古いやりとりは summary に畳み込み、summary_turn_id までが要約済み
+class ChatSession(db.Model):
+    __table_args__ = (db.Index('ux_chat_session_assignment_student', 'assignment_id', 'student_id', unique=True),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    assignment_id = db.Column(db.Integer, db.ForeignKey('assignment.id'))
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    summary = db.Column(db.Text, nullable=False, default='')
+    summary_turn_id = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# ★TAチャットの1往復（質問と回答）
+class ChatTurn(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), index=True)
+    slide_index = db.Column(db.Integer, nullable=True)  # 質問したときに見ていたスライド（0始まり）
+    question = db.Column(db.Text, nullable=False)
+    answer = db.Column(CompressedText, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# ★採点ジョブ（非同期採点の状態と結果。再起動後も結果を参照できるようDBに保存）
+class GradingJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)      # uuid4().hex
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    mode = db.Column(db.String(20))
+    status = db.Column(db.String(10), nullable=False, default='queued', index=True) # 'queued' / 'running' / 'done' / 'error'
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    owner = db.Column(db.String(100), nullable=True)     # 実行中のワーカー "ホスト名:PID:起動トークン"
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# ★Classroom → カレンダー同期の対応表（同期済みの課題は変更がなければスキップ、変更があれば更新する）
+class CalendarSyncEntry(db.Model):
+    __table_args__ = (db.Index('ux_calendar_sync_user_coursework', 'user_id', 'coursework_id', unique=True),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    coursework_id = db.Column(db.String(64), nullable=False)
+    event_id = db.Column(db.String(256), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False) # 予定の内容のハッシュ
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# ★カレンダー同期の実行状況（バックグラウンド同期の進捗をダッシュボードに表示する）
+class CalendarSyncStatus(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    status = db.Column(db.String(10), nullable=False, default='idle') # 'running' / 'done' / 'error'
+    inserted = db.Column(db.Integer, default=0)
+    updated = db.Column(db.Integer, default=0)
+    skipped = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    message = db.Column(db.Text, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# ★古いログのアーカイブ先（別のデータベースファイル。SQLALCHEMY_BINDS の 'archive'）
+# 元の行と同じIDで保存するので、アーカイブ処理が途中で止まってもやり直せば重複しない。
+# 別ファイルなので外部キーは張らず、授業スライドは共有キャッシュを参照せず本文をコピーして保存する。
+class ArchivedLessonLog(db.Model):
+    __bind_key__ = 'archive'
+    id = db.Column(db.Integer, primary_key=True)
+    assignment_id = db.Column(db.Integer, index=True)
+    student_id = db.Column(db.Integer, index=True)
+    slides_content = db.Column(CompressedText, nullable=False, default='')
+    created_at = db.Column(db.DateTime, index=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArchivedQuizLog(db.Model):
+    __bind_key__ = 'archive'
+    id = db.Column(db.Integer, primary_key=True)
+    assignment_id = db.Column(db.Integer, index=True)
+    student_id = db.Column(db.Integer, index=True)
+    questions = db.Column(db.Text, nullable=False)
+    student_answers = db.Column(db.Text, nullable=True)
+    grading_result = db.Column(CompressedText, nullable=True)
+    score = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, index=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArchivedGradingLog(db.Model):
+    __bind_key__ = 'archive'
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, index=True)
+    mode = db.Column(db.String(20))
+    input_text = db.Column(CompressedText, nullable=True)
+    feedback_content = db.Column(CompressedText, nullable=False)
+    created_at = db.Column(db.DateTime, index=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# --- SQLite の同時アクセス向け設定 ---
+# WAL: 読み取りと書き込みが互いをブロックしない / busy_timeout: ロック中は即エラーにせず待つ
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',     # WALではNORMALでもコミット済みデータは失われない
+    'busy_timeout': 15000,       # ミリ秒
+    'cache_size': -20000,        # 負の値はKB単位（約20MB）
+    'temp_store': 'MEMORY',
+    'mmap_size': 128 * 1024 * 1024,
+}
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if type(dbapi_connection).__module__.split('.')[0] not in ('sqlite3', 'pysqlite2'): return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+SQLITE_ENGINE_OPTIONS = {
+    'connect_args': {'timeout': 15, 'check_same_thread': False},
+    'pool_pre_ping': True,
+}
+
+
+def insert_or_get(model, keys, on_insert=None, **values):
+    """一意キー(keys)で1行だけ作成する。同時リクエストが先に作成していればその行を返す
+
+    on_insert(row) は実際に作成できたときだけ、同じトランザクション内（コミット前）で呼ばれる。
+    """
+    row = model(**keys, **values)
+    db.session.add(row)
+    try:
+        db.session.flush()
+        if on_insert: on_insert(row)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        row = model.query.filter_by(**keys).first()
+    return row
+
+
+# 一意インデックスを張る前に、重複している古い行を片付ける（アプリは常に最初の行を使っていたのでそれを残す）
+_DEDUPE_BEFORE_UNIQUE = {
+    'ux_lesson_log_assignment_student': 'DELETE FROM lesson_log WHERE id NOT IN (SELECT MIN(id) FROM lesson_log GROUP BY assignment_id, student_id)',
+    'ux_quiz_log_assignment_student': 'DELETE FROM quiz_log WHERE id NOT IN (SELECT MIN(id) FROM quiz_log GROUP BY assignment_id, student_id)',
+}
+
+def ensure_schema():
+    """既存の kosen.db を現在のモデル定義に合わせる（何度実行しても安全）
+
+    create_all() は既存テーブルに列やインデックスを追加しないため、
+    不足している列を ALTER TABLE で、不足しているインデックスを CREATE INDEX で追加する。
+    """
+    inspector = inspect(db.engine)
+    existing_tables = inspector.get_table_names()
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables: continue
+            existing_cols = {c['name'] for c in inspector.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing_cols: continue
+                col_type = col.type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{col.name}" {col_type}'))
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes: continue
+                if index.name in _DEDUPE_BEFORE_UNIQUE:
+                    conn.execute(text(_DEDUPE_BEFORE_UNIQUE[index.name]))
+                index.create(conn)
@@ -0,0 +1,28 @@
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+# --- キーセットページネーション ---
+# OFFSET はページが進むほど読み飛ばす行が増えるので、(created_at, id) の位置を次ページのカーソルとして渡す。
+# カーソルは "ISO日時_ID" 形式の文字列。
+
+def encode_cursor(row):
+    return f"{row.created_at.isoformat()}_{row.id}"
+
+def decode_cursor(cursor):
+    try:
+        ts, _, row_id = cursor.rpartition('_')
+        return datetime.fromisoformat(ts), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+def keyset_page(query, model, cursor=None, per_page=20):
+    """created_at の新しい順に per_page 件を取り出し、(items, 次ページのカーソル or None) を返す"""
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        created_at, row_id = position
+        query = query.filter(or_(model.created_at < created_at,
+                                 and_(model.created_at == created_at, model.id < row_id)))
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(per_page + 1).all()
+    items = rows[:per_page]
+    next_cursor = encode_cursor(items[-1]) if len(rows) > per_page else None
+    return items, next_cursor
@@ -0,0 +1,168 @@
+import hashlib
+import html
+import json
+import re
+import secrets
+import threading
+from collections import OrderedDict
+from markupsafe import Markup
+from sqlalchemy.exc import IntegrityError
+from models import db, RenderedContent
+
+# --- Markdown + 数式のサーバー側レンダリング ---
+# 授業スライドや採点結果は、これまで表示のたびにブラウザで marked と KaTeX が変換していた。
+# 同じ本文は全員に同じHTMLになるので、保存時に一度だけ HTML（数式は MathML）へ変換し、
+# 描画方式のバージョンと本文のハッシュをキーにしてDBとメモリに保存しておく。
+# 数式が MathML に変換できなかった場合だけ TeX のまま残し、ブラウザ側で KaTeX を読み込んで描画する。
+# 生の HTML はエスケープするので、モデルの出力に含まれるタグやスクリプトはそのまま実行されない。
+# リンクと画像の URL は文字参照を戻してから判定し、http / https / mailto と相対 URL 以外は "#" にする。
+
+RENDER_VERSION = 2   # 変換方法を変えたら上げる（古いキャッシュは参照されなくなる）
+SLIDE_BREAK = '---SLIDE_BREAK---'
+MEMORY_SIZE = 512    # プロセス内に保持する件数
+
+_CODE = re.compile(r'(^```.*?^```[^\n]*$|`[^`\n]+`)', re.M | re.S)
+_MATH = re.compile(r'\$\$(.+?)\$\$|\\\[(.+?)\\\]|\\\((.+?)\\\)|(?<![\\$])\$(?![\s$])([^$\n]+?)(?<![\s\\])\$', re.S)
+_TAG = re.compile(r'<[a-zA-Z][^>]*>')
+_URL_ATTR = re.compile(r'\b(href|src)="([^"]*)"', re.I)
+_SCHEME = re.compile(r'^([a-z][a-z0-9+.\-]*):')
+_IGNORED_IN_URL = re.compile(r'[\x00-\x20\x7f]')  # ブラウザはスキームの中の空白・制御文字を無視する
+SAFE_SCHEMES = {'http', 'https', 'mailto'}
+
+
+def split_slides(text):
+    return [s.strip() for s in (text or '').split(SLIDE_BREAK) if s.strip()]
+
+
+def _math_html(tex, display):
+    from latex2mathml.converter import convert
+    try:
+        return convert(tex.strip(), display='block' if display else 'inline')
+    except Exception:
+        # 変換できない記法はそのまま残し、ブラウザの KaTeX に任せる
+        left, right = ('\\[', '\\]') if display else ('\\(', '\\)')
+        return f'<span class="math-tex">{html.escape(left + tex.strip() + right)}</span>'
+
+
+def _safe_url(value):
+    """属性値の URL が許可したスキームか相対 URL なら True（&#106; などの文字参照も戻してから判定する）"""
+    url = _IGNORED_IN_URL.sub('', html.unescape(value)).lower()
+    scheme = _SCHEME.match(url)
+    return scheme is None or scheme.group(1) in SAFE_SCHEMES
+
+
+def _sanitize_urls(body):
+    def attr(m):
+        return m.group(0) if _safe_url(m.group(2)) else f'{m.group(1)}="#"'
+    return _TAG.sub(lambda tag: _URL_ATTR.sub(attr, tag.group(0)), body)
+
+
+def _protect_math(text, formulas, nonce):
+    """数式を置き換え文字列に退避する（Markdown の \\ や _ の解釈で式が壊れないように）。コード部分は対象外"""
+    def replace(m):
+        display = m.group(1) is not None or m.group(2) is not None
+        tex = next(g for g in m.groups() if g is not None)
+        formulas.append(_math_html(tex, display))
+        placeholder = f'MATH{nonce}PH{len(formulas) - 1}END'
+        return f'\n\n{placeholder}\n\n' if display else placeholder
+    parts = _CODE.split(text)
+    return ''.join(part if i % 2 else _MATH.sub(replace, part) for i, part in enumerate(parts))
+
+
+_local = threading.local()
+
+def _markdown():
+    # Markdown インスタンスはスレッドセーフではないのでスレッドごとに作って使い回す
+    md = getattr(_local, 'md', None)
+    if md is None:
+        import markdown
+        md = _local.md = markdown.Markdown(extensions=['fenced_code', 'tables', 'sane_lists'])
+        md.preprocessors.deregister('html_block')
+        md.inlinePatterns.deregister('html')
+    return md.reset()
+
+
+def render_markdown(text):
+    """Markdown(+数式)を HTML 断片にする（キャッシュなし）"""
+    formulas = []
+    # 置き換え文字列には呼び出しごとの乱数を入れ、本文にもともと書かれた文字列と取り違えないようにする
+    nonce = secrets.token_hex(8)
+    body = _markdown().convert(_protect_math(text or '', formulas, nonce))
+    body = re.sub(rf'<p>\s*(MATH{nonce}PH\d+END)\s*</p>', r'\1', body)
+    body = re.sub(rf'MATH{nonce}PH(\d+)END', lambda m: formulas[int(m.group(1))], body)
+    return _sanitize_urls(body)
+
+
+def render_key(text, slides=False):
+    return hashlib.sha256(f"{RENDER_VERSION}\0{int(slides)}\0{text}".encode('utf-8')).hexdigest()
+
+
+class _Memory:
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            parts = self._items.get(key)
+            if parts is not None: self._items.move_to_end(key)
+            return parts
+
+    def put(self, key, parts):
+        with self._lock:
+            self._items[key] = parts
+            self._items.move_to_end(key)
+            while len(self._items) > self.size: self._items.popitem(last=False)
+
+
+memory = _Memory(MEMORY_SIZE)
+
+
+def lookup(key):
+    """キャッシュ済みの HTML 断片のリスト（なければ None）"""
+    parts = memory.get(key)
+    if parts is not None: return parts
+    row = RenderedContent.query.get(key)
+    if row is None: return None
+    parts = json.loads(row.html)
+    memory.put(key, parts)
+    return parts
+
+
+def preload(texts, slides=False):
+    """一覧表示の前に、メモリにない変換結果をDBから1回のクエリでまとめて読み込む（1行ずつ引かないように）"""
+    keys = {render_key(t, slides) for t in texts if t}
+    keys = [k for k in keys if memory.get(k) is None]
+    if not keys: return
+    for row in RenderedContent.query.filter(RenderedContent.key.in_(keys)):
+        memory.put(row.key, json.loads(row.html))
+
+
+def render(text, slides=False, persist=True):
+    """(キー, HTML断片のリスト) を返す。slides=True ならスライド1枚ごとの断片になる
+
+    persist=True なら新たに変換した結果をDBにも保存する（同じトランザクションで、コミットは呼び出し側）。
+    False ならプロセス内にだけ保持する（一度しか表示しないチャットの回答など）。
+    """
+    key = render_key(text, slides)
+    parts = lookup(key)
+    if parts is not None: return key, parts
+    parts = [render_markdown(s) for s in split_slides(text)] if slides else [render_markdown(text)]
+    memory.put(key, parts)
+    if persist:
+        try:
+            with db.session.begin_nested():
+                db.session.add(RenderedContent(key=key, html=json.dumps(parts, ensure_ascii=False)))
+        except IntegrityError:
+            pass  # 同時に別のリクエストが保存した
+    return key, parts
+
+
+def render_html(text, persist=True):
+    return render(text, persist=persist)[1][0]
+
+
+def markdown_filter(text):
+    """テンプレート用フィルタ: {{ log.feedback_content | markdown }}（保存時に変換済みならキャッシュから返す）"""
+    return Markup(render_html(text, persist=False)) if text else ''
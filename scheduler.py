@@ -0,0 +1,358 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import deque
+
+# --- LLM呼び出しスケジューラ ---
+# すべてのモデル呼び出しをここに通し、モデル(tier)ごとに以下を行う。
+#   - トークンバケットによる呼び出しレート制限と、同時実行数の上限
+#   - 優先度レーン（チャットなどの対話的な呼び出しを一括採点より先に通す）
+#   - リトライ可能なエラーに対するジッター付き指数バックオフ
+#   - 上流が不調なときに即座に失敗する（または pro から flash へ切り替える）サーキットブレーカー
+#   - 待ち行列の長さと待ち時間の統計
+# ★非同期モード(asgi.py)のイベントループからは acall() / astream() を使う。待ち行列と実行枠は
+#   同期の呼び出しと共有し、枠が空くのを待つ間もスレッドを止めずに短い間隔で確認する。
+
+PRIORITIES = {'interactive': 0, 'normal': 1, 'batch': 2}
+ASYNC_POLL_INTERVAL = 0.05  # 非同期の待機者が実行枠を確認する間隔(秒)
+
+# google.api_core.exceptions などのクラス名で判定する（ライブラリを直接importしないため）
+RETRYABLE_ERRORS = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'DeadlineExceeded',
+    'InternalServerError', 'GatewayTimeout', 'BadGateway', 'StubError',
+    'ConnectionError', 'TimeoutError',
+}
+
+
+class LLMUnavailable(Exception):
+    """上流のモデルが一時的に使えない（混雑・障害）。呼び出し側は 503 として扱う"""
+
+    def __init__(self, message, retry_after=10):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(LLMUnavailable):
+    pass
+
+
+class QueueTimeout(LLMUnavailable):
+    pass
+
+
+def is_retryable(error):
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec, capacity):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_take(self):
+        """トークンを1つ取れたら 0 を、取れなければ次のトークンまでの秒数を返す（ロックは呼び出し側で取る）"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class CircuitBreaker:
+    """連続失敗が閾値を超えたら一定時間 open にし、その後1件だけ試行(half_open)して復旧を判断する"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed': return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+    def cancel_probe(self):
+        # 試行枠を取ったが呼び出しまで到達しなかった場合に枠を戻す
+        with self._lock:
+            self._probing = False
+
+    def retry_after(self):
+        return max(1, int(self.reset_timeout - (time.monotonic() - self.opened_at)))
+
+
+class _Lane:
+    """1つのモデル(tier)の待ち行列と実行枠"""
+
+    def __init__(self, rpm, burst, max_inflight):
+        self.bucket = TokenBucket(rpm / 60.0, burst)
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.waiters = []   # (priority, seq) のヒープ
+        self.cond = threading.Condition()
+        self.wait_times = deque(maxlen=1000)
+        self.counters = {"calls": 0, "retries": 0, "failures": 0, "fallbacks": 0, "rejected": 0, "timeouts": 0}
+
+
+class LLMScheduler:
+    def __init__(self, limits, fallbacks=None, max_retries=3, base_delay=0.5, max_delay=8.0,
+                 queue_timeout=60.0, breaker_threshold=5, breaker_reset=30.0):
+        """limits: {tier: {"rpm": ..., "burst": ..., "max_inflight": ...}}"""
+        self.lanes = {tier: _Lane(**cfg) for tier, cfg in limits.items()}
+        self.breakers = {tier: CircuitBreaker(breaker_threshold, breaker_reset) for tier in limits}
+        self.fallbacks = fallbacks or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue_timeout = queue_timeout
+        self._seq = itertools.count()
+
+    # --- 実行枠の確保と解放 ---
+    def _enqueue(self, tier, priority):
+        lane = self.lanes[tier]
+        ticket = (PRIORITIES.get(priority, PRIORITIES['normal']), next(self._seq))
+        start = time.monotonic()
+        with lane.cond:
+            heapq.heappush(lane.waiters, ticket)
+        return lane, ticket, start, start + self.queue_timeout
+
+    def _poll(self, lane, ticket, start, deadline):
+        """(lane.cond を取った状態で) 実行枠を取れたら None を、取れなければ次に確認するまでの秒数を返す"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            lane.counters["timeouts"] += 1
+            raise QueueTimeout("AIへのリクエストが混み合っています。しばらくしてから再度お試しください。")
+        if lane.waiters[0] != ticket or lane.inflight >= lane.max_inflight: return remaining
+        wait = lane.bucket.try_take()
+        if wait: return min(wait, remaining)
+        heapq.heappop(lane.waiters)
+        lane.inflight += 1
+        lane.counters["calls"] += 1
+        lane.wait_times.append(time.monotonic() - start)
+        # 先頭が入れ替わったので次の待機者を起こす
+        lane.cond.notify_all()
+        return None
+
+    def _withdraw(self, lane, ticket):
+        with lane.cond:
+            lane.waiters.remove(ticket)
+            heapq.heapify(lane.waiters)
+            lane.cond.notify_all()
+
+    def _acquire(self, tier, priority):
+        lane, ticket, start, deadline = self._enqueue(tier, priority)
+        try:
+            with lane.cond:
+                while (wait := self._poll(lane, ticket, start, deadline)) is not None:
+                    lane.cond.wait(wait)
+        except BaseException:
+            self._withdraw(lane, ticket)
+            raise
+
+    async def _aacquire(self, tier, priority):
+        lane, ticket, start, deadline = self._enqueue(tier, priority)
+        try:
+            while True:
+                with lane.cond:
+                    wait = self._poll(lane, ticket, start, deadline)
+                if wait is None: return
+                await asyncio.sleep(min(wait, ASYNC_POLL_INTERVAL))
+        except BaseException:
+            self._withdraw(lane, ticket)
+            raise
+
+    def _admit(self, tier, priority):
+        try:
+            self._acquire(tier, priority)
+        except BaseException:
+            self.breakers[tier].cancel_probe()
+            raise
+
+    async def _aadmit(self, tier, priority):
+        try:
+            await self._aacquire(tier, priority)
+        except BaseException:
+            self.breakers[tier].cancel_probe()
+            raise
+
+    def _release(self, tier):
+        lane = self.lanes[tier]
+        with lane.cond:
+            lane.inflight -= 1
+            lane.cond.notify_all()
+
+    def _choose_tier(self, tier, allow_fallback):
+        if self.breakers[tier].allow(): return tier
+        fallback = self.fallbacks.get(tier) if allow_fallback else None
+        if fallback and self.breakers[fallback].allow():
+            self.lanes[tier].counters["fallbacks"] += 1
+            return fallback
+        self.lanes[tier].counters["rejected"] += 1
+        raise CircuitOpen("AIサービスが一時的に利用できません。しばらくしてから再度お試しください。",
+                          retry_after=self.breakers[tier].retry_after())
+
+    def _backoff(self, attempt):
+        # full jitter: 0 〜 base * 2^attempt の一様乱数
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _on_error(self, tier, error, attempt):
+        """リトライするならバックオフの秒数を返す。リトライしないならそのまま例外を投げる"""
+        lane = self.lanes[tier]
+        if not is_retryable(error):
+            # 上流は応答している（入力エラーなど）ので障害とはみなさない
+            self.breakers[tier].record_success()
+            raise error
+        self.breakers[tier].record_failure()
+        with lane.cond:
+            lane.counters["failures"] += 1
+        if attempt >= self.max_retries:
+            raise LLMUnavailable("AIサービスが混み合っています。しばらくしてから再度お試しください。") from error
+        with lane.cond:
+            lane.counters["retries"] += 1
+        return self._backoff(attempt)
+
+    def _settle_abandoned(self, tier, started):
+        # 断片が届いていれば上流は応答している。届く前なら成否はわからないので試行枠を戻すだけにする
+        if started: self.breakers[tier].record_success()
+        else: self.breakers[tier].cancel_probe()
+
+    # --- 公開API ---
+    def call(self, tier, fn, priority='normal', allow_fallback=True):
+        """fn(実際に使うtier) を実行して結果を返す"""
+        for attempt in range(self.max_retries + 1):
+            use = self._choose_tier(tier, allow_fallback)
+            self._admit(use, priority)
+            try:
+                result = fn(use)
+            except Exception as e:
+                delay = self._on_error(use, e, attempt)
+            except BaseException:
+                # 中断された場合は上流の成否がわからないので、試行枠を戻すだけにする
+                self.breakers[use].cancel_probe()
+                raise
+            else:
+                self.breakers[use].record_success()
+                return result
+            finally:
+                self._release(use)
+            time.sleep(delay)
+
+    def stream(self, tier, fn, priority='normal', allow_fallback=True):
+        """fn(実際に使うtier) が返すイテレータを中継する。最初の断片を受け取る前の失敗だけリトライする"""
+        for attempt in range(self.max_retries + 1):
+            use = self._choose_tier(tier, allow_fallback)
+            self._admit(use, priority)
+            started = False
+            error = None
+            try:
+                for piece in fn(use):
+                    started = True
+                    yield piece
+            except Exception as e:
+                error = e
+            except BaseException:
+                # 受け取る側が途中でやめた（接続が切れた）。half_open の試行を締めないと二度と試行できなくなる
+                self._settle_abandoned(use, started)
+                raise
+            finally:
+                self._release(use)
+            if error is None:
+                self.breakers[use].record_success()
+                return
+            if started:
+                # 送信済みの断片は取り消せないのでリトライせずに失敗させる
+                if is_retryable(error): self.breakers[use].record_failure()
+                raise error
+            time.sleep(self._on_error(use, error, attempt))
+
+    async def acall(self, tier, afn, priority='normal', allow_fallback=True):
+        """call() の非同期版。await afn(実際に使うtier) の結果を返す"""
+        for attempt in range(self.max_retries + 1):
+            use = self._choose_tier(tier, allow_fallback)
+            await self._aadmit(use, priority)
+            try:
+                result = await afn(use)
+            except Exception as e:
+                delay = self._on_error(use, e, attempt)
+            except BaseException:
+                # キャンセルされた場合は上流の成否がわからないので、試行枠を戻すだけにする
+                self.breakers[use].cancel_probe()
+                raise
+            else:
+                self.breakers[use].record_success()
+                return result
+            finally:
+                self._release(use)
+            await asyncio.sleep(delay)
+
+    async def astream(self, tier, afn, priority='normal', allow_fallback=True):
+        """stream() の非同期版。afn(実際に使うtier) が返す非同期イテレータを中継する"""
+        for attempt in range(self.max_retries + 1):
+            use = self._choose_tier(tier, allow_fallback)
+            await self._aadmit(use, priority)
+            started = False
+            error = None
+            try:
+                async for piece in afn(use):
+                    started = True
+                    yield piece
+            except Exception as e:
+                error = e
+            except BaseException:
+                self._settle_abandoned(use, started)
+                raise
+            finally:
+                self._release(use)
+            if error is None:
+                self.breakers[use].record_success()
+                return
+            if started:
+                if is_retryable(error): self.breakers[use].record_failure()
+                raise error
+            await asyncio.sleep(self._on_error(use, error, attempt))
+
+    def stats(self):
+        result = {}
+        for tier, lane in self.lanes.items():
+            with lane.cond:
+                waits = sorted(lane.wait_times)
+                result[tier] = dict(lane.counters,
+                    queue_depth=len(lane.waiters),
+                    inflight=lane.inflight,
+                    max_inflight=lane.max_inflight,
+                    breaker=self.breakers[tier].state,
+                    wait_avg_ms=(sum(waits) / len(waits) * 1000) if waits else 0.0,
+                    wait_p95_ms=waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000 if waits else 0.0,
+                    wait_max_ms=waits[-1] * 1000 if waits else 0.0,
+                )
+        return result
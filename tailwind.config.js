@@ -0,0 +1,8 @@
+// 事前ビルド用の Tailwind 設定（STATIC_CSS / static/css/app.css）
+//   npx tailwindcss -i static/css/tailwind.input.css -o static/css/app.css --minify
+// テンプレート内の JavaScript で組み立てるクラス名も含め、templates/ 以下から使用クラスを拾う
+module.exports = {
+  content: ['./templates/**/*.html'],
+  theme: { extend: {} },
+  plugins: [],
+};
@@ -0,0 +1,45 @@
+import os
+import sys
+import tempfile
+
+# app.py はインポート時に既定の設定でアプリを作るので、その前に作業用の場所とスタブのモデルを指定しておく
+_tmp = tempfile.mkdtemp(prefix='kosen-test-')
+os.environ['DATABASE_URL'] = f"sqlite:///{_tmp}/import.db"
+os.environ['ARCHIVE_DATABASE_URL'] = f"sqlite:///{_tmp}/import_archive.db"
+os.environ['UPLOAD_CACHE_DIR'] = os.path.join(_tmp, 'upload_cache')
+os.environ['LLM_BACKEND'] = 'stub'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import app as web
+import llm
+from models import db, User
+
+
+@pytest.fixture
+def app(tmp_path):
+    application = web.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/test.db",
+        'ARCHIVE_DATABASE_URL': f"sqlite:///{tmp_path}/archive.db",
+        'UPLOAD_CACHE_DIR': str(tmp_path / 'upload_cache'),
+        'LLM_BACKEND': 'stub',
+    })
+    with application.app_context():
+        web.init_db()
+        yield application
+        db.session.remove()
+    llm.set_backend(None)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def user_id(username):
+    return User.query.filter_by(username=username).first().id
+
+
+def login(client, username='gakusei'):
+    client.post('/login', data={'username': username})
+    return user_id(username)
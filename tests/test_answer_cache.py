@@ -0,0 +1,51 @@
+from answer_cache import AnswerCache, normalize_question
+from models import db, CachedAnswer
+
+
+def test_exact_and_similar_questions_hit(app):
+    cache = AnswerCache()
+    cache.put(1, 'slide', 'この式の意味は？', '答え')
+    db.session.commit()
+    assert cache.get(1, 'slide', 'この 式の意味は') == '答え'
+    assert cache.get(1, 'slide', 'この式の意味はなに？') == '答え'
+    assert cache.get(1, 'other slide', 'この式の意味は？') is None
+    assert cache.counters == {"hits": 1, "similar_hits": 1, "misses": 1}
+    assert cache.stats()['stored_hits'] == 2
+
+
+def test_numbered_questions_are_not_mixed_up(app):
+    cache = AnswerCache()
+    cache.put(1, 'slide', '問1の答えは？', '1の答え')
+    db.session.commit()
+    assert cache.get(1, 'slide', '問2の答えは？') is None
+
+
+def test_clear_applies_to_every_worker(app):
+    # ワーカーごとに別々のインスタンスでも、保存先のDBは共有される
+    worker_a, worker_b = AnswerCache(), AnswerCache()
+    worker_a.put(1, 'slide', '質問', '古い答え')
+    worker_a.put(2, 'slide', '質問', '別の課題')
+    db.session.commit()
+    assert worker_b.get(1, 'slide', '質問') == '古い答え'
+    assert worker_b.clear(1) == 1
+    assert worker_a.get(1, 'slide', '質問') is None
+    assert worker_a.get(2, 'slide', '質問') == '別の課題'
+
+
+def test_expired_and_excess_entries_are_dropped(app):
+    cache = AnswerCache(max_entries=2, ttl=-1)
+    cache.put(1, 'slide', '期限切れ', 'x')
+    db.session.commit()
+    assert cache.get(1, 'slide', '期限切れ') is None
+
+    cache.ttl = 3600
+    for i in range(3):
+        cache.put(1, 'slide', f'質問{i}', f'答え{i}')
+        db.session.commit()
+    assert CachedAnswer.query.count() == 2
+    assert cache.get(1, 'slide', '質問0') is None
+    assert cache.get(1, 'slide', '質問2') == '答え2'
+
+
+def test_normalize_question():
+    assert normalize_question('ベクトル　とは？') == normalize_question('べくとるとは')
@@ -0,0 +1,78 @@
+import importlib.util
+import json
+import os
+import pytest
+import app as web
+import jobs
+import llm
+import metrics
+from models import db, User
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_gunicorn_conf():
+    spec = importlib.util.spec_from_file_location('gunicorn_conf', os.path.join(ROOT, 'gunicorn.conf.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_each_app_gets_its_own_config_and_database(tmp_path, monkeypatch):
+    monkeypatch.setenv('LLM_PRO_RPM', '7')
+    first = web.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/a.db", 'LLM_BACKEND': 'stub'})
+    second = web.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/b.db", 'LLM_BACKEND': 'stub',
+                             'CHAT_RECENT_TURNS': 2})
+    assert first.config['LLM_PRO_RPM'] == '7'
+    assert (first.config['CHAT_RECENT_TURNS'], second.config['CHAT_RECENT_TURNS']) == (4, 2)
+    # モデルのクライアントは作成時には作らず、最初の呼び出しで作る
+    assert llm._backend is None
+
+    with first.app_context():
+        web.init_db()
+        assert User.query.count() == 2
+    with second.app_context():
+        db.create_all()
+        assert User.query.count() == 0
+        assert llm.model_name('pro') == 'stub-pro'
+    llm.set_backend(None)
+
+
+def test_on_starting_keeps_the_metrics_directory(tmp_path, monkeypatch):
+    directory = tmp_path / 'metrics'
+    monkeypatch.setenv('METRICS_DIR', str(directory))
+    conf = load_gunicorn_conf()
+    assert conf.preload_app
+
+    # preload_app では on_starting より前にアプリが読み込まれ、レジストリはこのディレクトリを使っている
+    registry = metrics.Registry()
+    registry.directory = str(directory)
+    directory.mkdir()
+    for name in ('metrics-1.json', 'metrics-2.json.tmp', 'notes.txt'):
+        (directory / name).write_text('{}')
+
+    conf.on_starting(None)
+    assert sorted(os.listdir(directory)) == ['notes.txt']
+    registry.flush(force=True)
+    assert os.path.exists(directory / f"metrics-{os.getpid()}.json")
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='fork が使えない環境')
+def test_forked_workers_record_their_own_job_owner():
+    # preload_app ではワーカーは親プロセスのフォーク。import 時の値を引き継がないことを確かめる
+    parent = jobs.current_owner()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.write(write, json.dumps(jobs.current_owner()).encode())
+        finally:
+            os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        child = json.loads(f.read())
+    os.waitpid(pid, 0)
+    assert child != parent
+    assert child.split(':')[1] == str(pid)
+    # フォーク元の親は生きているので、親のジョブは中断扱いにしない
+    assert jobs._owner_alive(parent)
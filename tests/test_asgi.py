@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import threading
+import pytest
+from starlette.testclient import TestClient
+import asgi
+import llm
+import metrics
+import upload_cache
+from conftest import login, user_id
+from models import db, Assignment, GradingLog, QuizLog
+
+
+@pytest.fixture
+def async_app(app, monkeypatch):
+    # 非同期ルートは asgi.flask_app の設定・DB・セッション鍵を使うので、テスト用のアプリに差し替える
+    monkeypatch.setattr(asgi, 'flask_app', app)
+    return app
+
+
+def async_client(app, client=None, username='gakusei'):
+    """Flask 側でログインして、その署名付きセッションCookieで非同期ルートを呼ぶクライアントを返す"""
+    cookies = {}
+    if client is not None:
+        login(client, username)
+        name = app.config['SESSION_COOKIE_NAME']
+        cookies[name] = client.get_cookie(name).value
+    return TestClient(asgi.app, cookies=cookies)
+
+
+def make_quiz(questions):
+    assignment = Assignment(title='線形代数', description='d', created_by=user_id('sensei'))
+    db.session.add(assignment)
+    db.session.flush()
+    quiz = QuizLog(assignment_id=assignment.id, student_id=user_id('gakusei'), questions=json.dumps(questions))
+    db.session.add(quiz)
+    db.session.commit()
+    return quiz.id
+
+
+def test_requests_without_a_valid_session_are_rejected(async_app):
+    client = async_client(async_app)
+    assert client.post('/api/grade_quiz', json={'quiz_id': 1}).status_code == 401
+    name = async_app.config['SESSION_COOKIE_NAME']
+    client.cookies.set(name, 'eyJ1c2VyX2lkIjoxfQ.forged.signature')
+    assert client.post('/api/grade_quiz', json={'quiz_id': 1}).status_code == 401
+
+
+def test_session_cookie_from_flask_identifies_the_user(async_app, client):
+    quiz_id = make_quiz([])
+    response = async_client(async_app, client).post('/api/grade_quiz', json={'quiz_id': quiz_id})
+    # ログイン済みとして扱われ、ハンドラまで届いている
+    assert response.status_code == 400
+    assert response.json() == {"error": "このテストには問題がありません"}
+
+
+def test_run_db_uses_the_db_threads_with_an_app_context(async_app):
+    def lookup(username):
+        return threading.current_thread().name, user_id(username)
+
+    thread_name, found = asyncio.run(asgi.run_db(lookup, 'gakusei'))
+    assert thread_name.startswith('async-db')
+    assert found == user_id('gakusei')
+
+
+def test_quiz_questions_are_graded_concurrently(async_app, client, monkeypatch):
+    quiz_id = make_quiz([{'q_id': n, 'question': f'問{n}'} for n in (1, 2, 3, 4)])
+    active = {"now": 0, "max": 0}
+
+    async def agenerate(tier, contents, json_mode=False, **kwargs):
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        await asyncio.sleep(0.05)
+        active["now"] -= 1
+        return json.dumps({"score": 90, "feedback": "よくできています"})
+
+    monkeypatch.setattr(llm, 'agenerate', agenerate)
+    answers = {'1': '固有値', '2': '固有ベクトル', '3': '対角化', '4': ''}
+    response = async_client(async_app, client).post('/api/grade_quiz', json={'quiz_id': quiz_id, 'answers': answers})
+    assert response.status_code == 200, response.json()
+    # 未回答の問題はモデルを呼ばず、残りの3問は同時に採点される
+    assert active["max"] == 3
+    assert [q['score'] for q in response.json()['questions']] == [90, 90, 90, 0]
+    assert response.json()['score'] == 68
+    db.session.expire_all()
+    assert db.session.get(QuizLog, quiz_id).grading_result.startswith('**合計: 68点**')
+
+
+def test_grading_form_is_converted_for_the_shared_builder(async_app, client, monkeypatch):
+    received = []
+
+    async def agenerate(tier, contents, json_mode=False, **kwargs):
+        received.extend(c.read() if isinstance(c, upload_cache.CachedImage) else c for c in contents)
+        return '採点結果です'
+
+    monkeypatch.setattr(llm, 'agenerate', agenerate)
+    response = async_client(async_app, client).post('/api/general_grading', data={
+        'mode': 'problem', 'text_content': '途中式も書きました',
+    }, files=[
+        ('problem_images', ('problem.png', b'problem-bytes', 'image/png')),
+        ('student_images', ('answer1.png', b'answer-1', 'image/png')),
+        ('student_images', ('answer2.png', b'answer-2', 'image/png')),
+    ])
+    assert response.status_code == 200, response.json()
+    assert response.json()['result'] == '採点結果です'
+    # 同じ名前のファイルが複数あっても、順番どおりにすべて渡る
+    assert [c for c in received if isinstance(c, bytes)] == [b'problem-bytes', b'answer-1', b'answer-2']
+    assert '生徒の補足テキスト: 途中式も書きました' in received
+    log = GradingLog.query.filter_by(student_id=user_id('gakusei')).one()
+    assert (log.mode, log.input_text) == ('problem', '途中式も書きました')
+
+    response = async_client(async_app, client).post('/api/general_grading', data={'mode': 'problem'})
+    assert response.status_code == 400
+
+
+def test_async_routes_flush_metrics(async_app, tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics.registry, 'directory', str(tmp_path / 'metrics'))
+    monkeypatch.setattr(metrics.registry, 'flush_interval', 0)
+    async_client(async_app).post('/api/grade_quiz', json={'quiz_id': 1})
+    with open(tmp_path / 'metrics' / f"metrics-{os.getpid()}.json") as f:
+        assert 'main.grade_quiz_api' in f.read()
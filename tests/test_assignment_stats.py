@@ -0,0 +1,64 @@
+import json
+from datetime import datetime, timedelta
+import app as web
+import assignment_stats
+import gen_cache
+import log_archive
+from conftest import user_id
+from models import db, Assignment, AssignmentStats, GeneratedContent, LessonLog, QuizLog
+
+
+def setup_assignment(app):
+    app.config['QUIZ_PREGENERATE'] = False
+    assignment = Assignment(title='t', description='d', created_by=user_id('sensei'))
+    db.session.add(assignment)
+    db.session.commit()
+    content = gen_cache.store('key', 'stub-pro', '# スライド', assignment.id)
+    return assignment.id, content
+
+
+def archive_everything():
+    for model in (LessonLog, QuizLog):
+        model.query.update({"created_at": datetime.utcnow() - timedelta(days=400)})
+    db.session.commit()
+    log_archive.archive_logs(days=180)
+
+
+def stats(assignment_id):
+    db.session.expire_all()
+    return db.session.get(AssignmentStats, assignment_id)
+
+
+def test_reopened_lesson_after_archive_is_counted_once(app):
+    assignment_id, content = setup_assignment(app)
+    student = user_id('gakusei')
+    web._save_lesson_log(assignment_id, student, content)
+    content_id = content.id
+    archive_everything()
+    assert LessonLog.query.count() == 0
+
+    # アーカイブ後に開き直すと新しい行ができるが、同じ生徒なので数え直さない
+    web._save_lesson_log(assignment_id, student, db.session.get(GeneratedContent, content_id))
+    assert LessonLog.query.count() == 1
+    assert stats(assignment_id).lesson_count == 1
+    assignment_stats.rebuild()
+    assert stats(assignment_id).lesson_count == 1
+
+
+def test_regraded_quiz_after_archive_replaces_the_old_score(app):
+    assignment_id, _ = setup_assignment(app)
+    student = user_id('gakusei')
+    questions = json.dumps([{'q_id': 1, 'question': 'q'}])
+
+    def grade(score):
+        quiz = web.insert_or_get(QuizLog, {"assignment_id": assignment_id, "student_id": student}, questions=questions)
+        web._save_quiz_grading(quiz.id, student, {}, [{'q_id': 1, 'score': score, 'feedback': 'f'}])
+
+    grade(30)
+    archive_everything()
+    grade(90)
+    live = stats(assignment_id)
+    assert (live.graded_count, live.score_sum, live.score_histogram) == (1, 90, [0, 0, 0, 0, 1])
+    assignment_stats.rebuild()
+    rebuilt = stats(assignment_id)
+    assert (rebuilt.graded_count, rebuilt.score_sum, rebuilt.score_histogram) == (1, 90, [0, 0, 0, 0, 1])
@@ -0,0 +1,99 @@
+import threading
+from datetime import date, timedelta
+from calendar_sync import CalendarSyncEngine, CALENDAR_BATCH_LIMIT, claim_sync, run_sync
+from conftest import user_id
+from google_fakes import FakeClassroom, FakeCalendar
+from models import CalendarSyncEntry
+
+
+def course_work(course_id, count, due=None):
+    due = due or date.today() + timedelta(days=3)
+    return [{'id': f"{course_id}-w{i}", 'title': f"課題{i}", 'alternateLink': f"https://example.com/{course_id}/{i}",
+             'dueDate': {'year': due.year, 'month': due.month, 'day': due.day}} for i in range(count)]
+
+
+def make_classroom(page_size=7):
+    courses = {f"c{n}": {'name': f"コース{n}", 'courseWork': course_work(f"c{n}", 40)} for n in range(3)}
+    return FakeClassroom(courses, page_size=page_size)
+
+
+def test_first_sync_pages_through_and_batches_inserts(app):
+    classroom, calendar = make_classroom(), FakeCalendar()
+    result = CalendarSyncEngine(lambda: classroom, calendar).run(user_id('gakusei'))
+    assert (result.inserted, result.updated, result.skipped, result.failed) == (120, 0, 0, 0)
+    # 40件の課題を7件ずつのページでたどる（1コース6ページ）
+    assert classroom.calls == {'courses.list': 1, 'courseWork.list': 18}
+    assert calendar.calls['insert'] == 120
+    assert calendar.calls['batch'] == -(-120 // CALENDAR_BATCH_LIMIT)
+    assert CalendarSyncEntry.query.count() == 120
+
+
+def test_resync_only_patches_changed_work(app):
+    uid = user_id('gakusei')
+    classroom, calendar = make_classroom(), FakeCalendar()
+    CalendarSyncEngine(lambda: classroom, calendar).run(uid)
+
+    classroom.courses_data['c1']['courseWork'][5]['title'] = '課題5（改訂）'
+    result = CalendarSyncEngine(lambda: classroom, calendar).run(uid)
+    assert (result.inserted, result.updated, result.skipped) == (0, 1, 119)
+    assert calendar.calls['insert'] == 120 and calendar.calls['patch'] == 1
+    assert len(calendar.events_data) == 120
+    assert any(e['summary'].startswith('【課題】課題5（改訂）') for e in calendar.events_data.values())
+
+
+def test_failed_inserts_are_retried_and_old_work_is_skipped(app):
+    uid = user_id('gakusei')
+    classroom = make_classroom()
+    classroom.courses_data['c0']['courseWork'] += course_work('old', 2, due=date.today() - timedelta(days=30))
+    broken = FakeCalendar(fail_ids={'【課題】課題0 (コース2)'})
+    status = run_sync(uid, lambda: CalendarSyncEngine(lambda: classroom, broken))
+    assert (status.status, status.inserted, status.failed) == ('error', 119, 1)
+
+    result = CalendarSyncEngine(lambda: classroom, FakeCalendar()).run(uid)
+    assert (result.inserted, result.skipped) == (1, 119)
+
+
+def test_events_deleted_in_calendar_are_inserted_again(app):
+    uid = user_id('gakusei')
+    classroom, calendar = make_classroom(), FakeCalendar()
+    CalendarSyncEngine(lambda: classroom, calendar).run(uid)
+    entry = CalendarSyncEntry.query.filter_by(user_id=uid, coursework_id='c1-w5').first()
+    deleted_event = entry.event_id
+    del calendar.events_data[deleted_event]
+
+    classroom.courses_data['c1']['courseWork'][5]['title'] = '課題5（改訂）'
+    result = CalendarSyncEngine(lambda: classroom, calendar).run(uid)
+    assert (result.inserted, result.failed) == (1, 0)
+    entry = CalendarSyncEntry.query.filter_by(user_id=uid, coursework_id='c1-w5').first()
+    assert entry.event_id != deleted_event
+    assert calendar.events_data[entry.event_id]['summary'].startswith('【課題】課題5（改訂）')
+    # 次の同期では変更なしとしてスキップされる
+    assert CalendarSyncEngine(lambda: classroom, calendar).run(uid).skipped == 120
+
+
+def test_only_one_sync_can_be_claimed_at_a_time(app):
+    uid = user_id('gakusei')
+    assert claim_sync(uid)
+    assert not claim_sync(uid)
+    assert run_sync(uid, lambda: CalendarSyncEngine(lambda: make_classroom(), FakeCalendar())) is None
+    # プロセスが落ちて 'running' のまま残った状態は、一定時間を過ぎたら取り直せる
+    assert claim_sync(uid, stale_after=timedelta(0))
+    status = run_sync(uid, lambda: CalendarSyncEngine(lambda: make_classroom(), FakeCalendar()), claimed=True)
+    assert (status.status, status.inserted) == ('done', 120)
+    assert claim_sync(uid)
+
+
+def test_concurrent_triggers_start_one_sync(app):
+    uid = user_id('gakusei')
+    barrier = threading.Barrier(4)
+    results = []
+
+    def trigger():
+        with app.app_context():
+            barrier.wait()
+            results.append(claim_sync(uid))
+
+    threads = [threading.Thread(target=trigger) for _ in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join(5)
+    assert sorted(results) == [False, False, False, True]
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+import chat_memory
+from conftest import login, user_id
+from models import db, Assignment, ChatSession, ChatTurn
+
+
+def ask(client, question, **body):
+    response = client.post('/api/ask_teacher', json=dict(body, question=question))
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_questions_reuse_one_session_per_lesson(client):
+    student = login(client)
+    assignment = Assignment(title='授業', description='d', created_by=user_id('sensei'))
+    db.session.add(assignment)
+    db.session.commit()
+    for i in range(3):
+        ask(client, f"質問{i}", assignment_id=assignment.id, context='スライド')
+    assert ChatSession.query.filter_by(assignment_id=assignment.id, student_id=student).count() == 1
+    assert ChatTurn.query.count() == 3
+
+
+def test_context_only_questions_are_not_stored(client):
+    login(client)
+    for i in range(3):
+        assert ask(client, f"質問{i}", context='スライド')['turn_id'] is None
+    assert ChatSession.query.count() == 0
+    assert ChatTurn.query.count() == 0
+
+
+def test_prompt_stays_within_budget_in_long_conversations():
+    turn = SimpleNamespace(slide_index=0, question='この式の意味は？' * 20, answer='説明です。' * 200)
+    slides = ['# 見出し\n' + '本文' * 500] * 30
+    for budget in (500, 2000):
+        prompt, tokens = chat_memory.build_prompt('質問' * 500, slides[0], slides, 0, '要約' * 100, [turn] * 50, budget=budget)
+        assert tokens <= budget
+    assert '【直近のやりとり】' in prompt
@@ -0,0 +1,97 @@
+import threading
+import pytest
+import app as web
+import gen_cache
+import llm
+from conftest import user_id
+from models import db, Assignment, LessonLog
+
+
+class SlideBackend(llm.StubBackend):
+    """区切り文字付きのスライドを1枚ずつ返すスタブ"""
+    def stream(self, tier, contents):
+        for i in range(3):
+            yield f"# スライド{i}\n本文{web.SLIDE_BREAK}"
+
+
+def test_do_runs_once_for_concurrent_callers():
+    flight = gen_cache.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def produce():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'done'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('k', produce)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(flight.do('k', produce)))
+    follower.start()
+    release.set()
+    leader.join(5); follower.join(5)
+    assert results == ['done', 'done']
+    assert len(calls) == 1
+    assert flight.in_flight('k') is None
+
+
+class Interrupted(BaseException):
+    """KeyboardInterrupt や SystemExit のように Exception ではない中断"""
+
+
+def test_do_releases_followers_when_the_leader_is_interrupted():
+    flight = gen_cache.SingleFlight()
+    waiters = []
+
+    def produce():
+        waiters.append(flight.begin('k')[0])
+        raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        flight.do('k', produce)
+    assert flight.in_flight('k') is None
+    with pytest.raises(Interrupted):
+        waiters[0].wait(timeout=0)
+
+
+def test_stream_disconnect_releases_waiters(app):
+    llm.set_backend(SlideBackend())
+    assignment = Assignment(title='t', description='d', created_by=user_id('sensei'))
+    db.session.add(assignment)
+    db.session.commit()
+    prompt = 'disconnect-test'
+    key = gen_cache.cache_key(llm.model_name('pro'), prompt)
+
+    events = web._stream_lesson(prompt, assignment.id, user_id('gakusei'))
+    assert next(events).startswith('event: slide')
+    waiter, leader = gen_cache.flight.begin(key)
+    assert not leader
+    # クライアントの切断で、ジェネレーターは GeneratorExit で閉じられる
+    events.close()
+
+    assert gen_cache.flight.in_flight(key) is None
+    with pytest.raises(llm.LLMError):
+        waiter.wait(timeout=1)
+    # 次のリクエストは待たされずに生成をやり直せる
+    replay = list(web._stream_lesson(prompt, assignment.id, user_id('gakusei')))
+    assert replay[-1].startswith('event: done')
+    assert LessonLog.query.filter_by(assignment_id=assignment.id).count() == 1
+
+
+def test_wait_times_out_and_stale_call_is_replaced(monkeypatch):
+    flight = gen_cache.SingleFlight()
+    stuck, _ = flight.begin('k')
+    with pytest.raises(TimeoutError):
+        stuck.wait(timeout=0.01)
+
+    monkeypatch.setattr(gen_cache, 'WAIT_TIMEOUT', 0)
+    fresh, leader = flight.begin('k')
+    assert leader and fresh is not stuck
+    # 放棄扱いの実行役が後から終わっても、新しい実行役の分は残る
+    flight.finish('k', stuck, result='late')
+    assert flight.in_flight('k') is fresh
+    flight.finish('k', fresh, result='ok')
+    assert fresh.wait(timeout=0) == 'ok'
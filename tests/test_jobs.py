@@ -0,0 +1,54 @@
+import os
+import socket
+import time
+import jobs
+from conftest import login
+from models import db, GradingJob, GradingLog
+
+
+def test_owner_is_the_current_process(monkeypatch):
+    owner = jobs.current_owner()
+    assert owner.startswith(f"{socket.gethostname()}:{os.getpid()}:")
+    assert jobs.current_owner() == owner
+    monkeypatch.setattr(os, 'getpid', lambda: 4242)
+    assert jobs.current_owner().startswith(f"{socket.gethostname()}:4242:")
+
+
+def test_jobs_of_dead_workers_are_interrupted_on_poll(app):
+    queue = jobs.GradingJobQueue()
+    db.session.add(GradingJob(id='orphan', mode='general', status='running', owner=f"{socket.gethostname()}:999999999"))
+    db.session.add(GradingJob(id='alive', mode='general', status='running', owner=jobs.current_owner()))
+    db.session.commit()
+
+    assert queue.get('orphan').status == 'error'
+    assert queue.get('alive').status == 'running'
+
+
+def test_restarted_worker_with_the_same_pid_recovers_old_jobs(app):
+    # コンテナの再起動で前のワーカーと同じ PID になっても、起動トークンが違えば中断扱いにする
+    db.session.add(GradingJob(id='previous', mode='general', status='queued',
+                              owner=f"{socket.gethostname()}:{os.getpid()}:previous-boot"))
+    db.session.commit()
+    jobs.GradingJobQueue().recover()
+    job = db.session.get(GradingJob, 'previous')
+    assert job.status == 'error'
+    assert '再起動' in job.error
+
+
+def test_submit_and_poll_until_done(client):
+    student = login(client)
+    response = client.post('/api/grading_jobs', data={'mode': 'report', 'text_content': 'レポート本文'})
+    assert response.status_code == 202
+    status_url = response.get_json()['status_url']
+
+    deadline = time.monotonic() + 5
+    while (payload := client.get(status_url).get_json())['status'] in ('queued', 'running'):
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+    assert payload['status'] == 'done'
+    assert payload['result'] and payload['result_html']
+    assert GradingLog.query.filter_by(student_id=student, input_text='レポート本文').count() == 1
+
+    # 他の生徒からはジョブが見えない
+    login(client, 'sensei')
+    assert client.get(status_url).status_code == 404
@@ -0,0 +1,52 @@
+import json
+import app as web
+import llm
+from conftest import login, user_id
+from models import db, Assignment, LessonLog
+
+SLIDES = [f"# スライド{i}\n本文 $x_{i}$" for i in range(3)]
+
+
+class ChunkedBackend(llm.StubBackend):
+    """区切り文字が断片の境目をまたぐように、本文を7文字ずつ返すスタブ"""
+    def stream(self, tier, contents):
+        text = web.SLIDE_BREAK.join(SLIDES)
+        for i in range(0, len(text), 7):
+            yield text[i:i + 7]
+
+
+def parse_sse(body):
+    events = []
+    for block in body.split('\n\n'):
+        if not block: continue
+        event, data = block.split('\n')
+        assert event.startswith('event: ') and data.startswith('data: ')
+        events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+def generate(client, assignment_id):
+    response = client.post('/api/generate_lesson', json={"assignment_id": assignment_id, "stream": True})
+    assert response.mimetype == 'text/event-stream'
+    return parse_sse(response.get_data(as_text=True))
+
+
+def test_slides_stream_one_event_each_and_replay_from_the_log(client):
+    llm.set_backend(ChunkedBackend())
+    student = login(client)
+    assignment = Assignment(title='ストリーム', description='d', created_by=user_id('sensei'))
+    db.session.add(assignment)
+    db.session.commit()
+
+    events = generate(client, assignment.id)
+    assert [name for name, _ in events] == ['slide'] * 3 + ['done']
+    assert [data['markdown'] for _, data in events[:-1]] == SLIDES
+    assert [data['index'] for _, data in events[:-1]] == [0, 1, 2]
+    assert all('<math' in data['html'] for _, data in events[:-1])
+    assert events[-1][1] == {"count": 3}
+    assert LessonLog.query.filter_by(assignment_id=assignment.id, student_id=student).count() == 1
+
+    # 保存済みの授業は同じ形式のイベントで一括して送り直す
+    assert generate(client, assignment.id) == events
+    plain = client.post('/api/generate_lesson', json={"assignment_id": assignment.id}).get_json()
+    assert plain['slides'] == web.SLIDE_BREAK.join(SLIDES)
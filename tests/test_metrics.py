@@ -0,0 +1,38 @@
+import os
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+import metrics
+from models import db
+
+
+def test_failed_queries_do_not_leak_start_times(app):
+    with db.engine.connect() as conn:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                conn.execute(text('SELECT * FROM no_such_table'))
+            conn.rollback()
+        conn.execute(text('SELECT 1'))
+        assert conn.info.get('_query_started') == []
+
+
+def test_request_records_db_time(client):
+    response = client.get('/login')
+    assert response.status_code == 200
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_db_queries' in body
+
+
+def test_flush_recreates_removed_directory(tmp_path):
+    registry = metrics.Registry()
+    registry.directory = str(tmp_path / 'metrics')
+    registry.flush(force=True)
+    assert os.listdir(registry.directory) == [f"metrics-{os.getpid()}.json"]
+
+
+def test_flush_does_not_raise_when_unwritable(tmp_path):
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    registry = metrics.Registry()
+    registry.directory = str(blocker / 'metrics')
+    registry.flush(force=True)
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+import app as web
+from conftest import login, user_id
+from models import db, Assignment
+from pagination import keyset_page, encode_cursor, decode_cursor
+
+
+def add_assignments(count, created_by, same_time_every=3):
+    base = datetime(2025, 4, 1)
+    for i in range(count):
+        # 同じ作成日時の行を混ぜ、id で順序が決まることを確かめる
+        db.session.add(Assignment(title=f"課題{i}", description='d', created_by=created_by,
+                                  created_at=base + timedelta(minutes=i // same_time_every)))
+    db.session.commit()
+
+
+def test_pages_cover_every_row_once_in_order(app):
+    add_assignments(25, user_id('sensei'))
+    query = Assignment.query
+    seen, cursor, pages = [], None, 0
+    while True:
+        items, cursor = keyset_page(query, Assignment, cursor, per_page=10)
+        seen += items
+        pages += 1
+        if cursor is None: break
+    assert pages == 3
+    assert len(seen) == len({a.id for a in seen}) == 25
+    keys = [(a.created_at, a.id) for a in seen]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_cursor_round_trip_and_bad_cursor(app):
+    add_assignments(5, user_id('sensei'))
+    first, _ = keyset_page(Assignment.query, Assignment, per_page=5)
+    assert decode_cursor(encode_cursor(first[0])) == (first[0].created_at, first[0].id)
+    assert decode_cursor('garbage') is None
+    # 壊れたカーソルは先頭ページとして扱う
+    assert keyset_page(Assignment.query, Assignment, 'garbage', per_page=5)[0] == first
+
+
+def test_load_more_endpoint_returns_next_cursor(client):
+    teacher = login(client, 'sensei')
+    add_assignments(web.DASHBOARD_PAGE_SIZE + 2, teacher)
+    first = client.get('/dashboard/more/my_assignments')
+    assert first.status_code == 200
+    cursor = first.headers['X-Next-Cursor']
+    rest = client.get('/dashboard/more/my_assignments', query_string={'cursor': cursor})
+    assert 'X-Next-Cursor' not in rest.headers
+    # 最も古い課題は2ページ目にだけ出る
+    assert '課題0' not in first.get_data(as_text=True)
+    assert '課題0' in rest.get_data(as_text=True)
+    # 生徒には教員用のセクションを見せない
+    login(client, 'gakusei')
+    assert client.get('/dashboard/more/my_assignments').status_code == 403
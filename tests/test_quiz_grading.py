@@ -0,0 +1,38 @@
+import json
+import app as web
+from conftest import login, user_id
+from models import db, Assignment, QuizLog
+
+
+def make_quiz(questions):
+    assignment = Assignment(title='線形代数', description='d', created_by=user_id('sensei'))
+    db.session.add(assignment)
+    db.session.flush()
+    quiz = QuizLog(assignment_id=assignment.id, student_id=user_id('gakusei'), questions=json.dumps(questions))
+    db.session.add(quiz)
+    db.session.commit()
+    return quiz.id
+
+
+def test_quiz_score_handles_empty_results():
+    assert web.quiz_score([]) == 0
+    assert web.quiz_score([{'score': 100}, {'score': 51}]) == 76
+    assert '合計: 0点' in web.format_quiz_grading([])
+
+
+def test_grading_a_quiz_without_questions_is_rejected(client):
+    login(client)
+    quiz_id = make_quiz([])
+    response = client.post('/api/grade_quiz', json={'quiz_id': quiz_id, 'answers': {}})
+    assert response.status_code == 400
+    assert client.post('/api/grade_quiz', json={'quiz_id': 9999}).status_code == 404
+
+
+def test_grading_records_score(client):
+    login(client)
+    quiz_id = make_quiz([{'q_id': 1, 'question': '固有値とは？'}, {'q_id': 2, 'question': '固有ベクトルとは？'}])
+    response = client.post('/api/grade_quiz', json={'quiz_id': quiz_id, 'answers': {'1': '', '2': ''}})
+    assert response.status_code == 200, response.json
+    # 未回答は0点
+    assert response.json['score'] == 0
+    assert db.session.get(QuizLog, quiz_id).grading_result.startswith('**合計: 0点**')
@@ -0,0 +1,80 @@
+import threading
+import time
+import app as web
+import gen_cache
+import llm
+from conftest import login, user_id
+from models import db, Assignment, LessonLog, QuizLog
+
+
+class GatedBackend(llm.StubBackend):
+    """確認テストの生成を release が立つまで止めておくスタブ"""
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.quiz_calls = 0
+
+    def generate(self, tier, contents, json_mode=False):
+        if 'JSON配列' in self._prompt_text(contents):
+            self.quiz_calls += 1
+            self.release.wait(5)
+        return super().generate(tier, contents, json_mode)
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def make_assignment():
+    assignment = Assignment(title='微分', description='d', created_by=user_id('sensei'))
+    db.session.add(assignment)
+    db.session.commit()
+    return assignment.id
+
+
+def test_saving_a_lesson_pregenerates_the_quiz(app, client):
+    student = login(client)
+    assignment_id = make_assignment()
+    assert client.post('/api/generate_lesson', json={"assignment_id": assignment_id}).status_code == 200
+
+    def pregenerated():
+        db.session.remove()
+        return QuizLog.query.filter_by(assignment_id=assignment_id, student_id=student, pregenerated=True).first()
+    wait_until(pregenerated)
+
+    payload = client.post('/api/generate_quiz', json={"assignment_id": assignment_id}).get_json()
+    assert payload['quiz_id'] == pregenerated().id
+    assert len(payload['questions']) == 3
+    login(client, 'sensei')
+    assert client.get('/api/quiz_pregenerate/stats').get_json() == {"enabled": True, "pregenerated": 1, "used": 1}
+
+
+def test_opening_the_quiz_joins_the_running_pregeneration(app, client):
+    backend = GatedBackend()
+    llm.set_backend(backend)
+    student = login(client)
+    assignment_id = make_assignment()
+    db.session.add(LessonLog(assignment_id=assignment_id, student_id=student, slides_content='# スライド\n本文'))
+    db.session.commit()
+
+    pregen = threading.Thread(target=web._pregenerate_quiz, args=(app, assignment_id, student))
+    pregen.start()
+    wait_until(lambda: gen_cache.flight.in_flight(('quiz', assignment_id, student)) is not None)
+
+    responses = []
+    opener = threading.Thread(target=lambda: responses.append(
+        client.post('/api/generate_quiz', json={"assignment_id": assignment_id}).get_json()))
+    opener.start()
+    time.sleep(0.1)
+    backend.release.set()
+    pregen.join(5); opener.join(5)
+
+    # モデルの呼び出しは事前生成の1回だけで、開いた生徒はその結果を受け取る
+    assert backend.quiz_calls == 1
+    db.session.remove()
+    quiz = QuizLog.query.filter_by(assignment_id=assignment_id, student_id=student).one()
+    assert responses[0]['quiz_id'] == quiz.id
+    assert quiz.pregenerated and quiz.opened_at is not None
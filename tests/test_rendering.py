@@ -0,0 +1,45 @@
+import re
+from sqlalchemy import event
+import rendering
+from conftest import login, user_id
+from models import db, GradingLog, RenderedContent
+
+
+def test_literal_placeholder_text_is_kept():
+    # 数式の番号と重なる場合(0)も重ならない場合(7)も、本文の文字列はそのまま残す
+    html = rendering.render_markdown('MATHPH0END MATHPH7END と $x$')
+    assert 'MATHPH0END MATHPH7END' in html
+    assert html.count('<math') == 1
+
+
+def test_only_safe_url_schemes_survive():
+    for text in ('[x](&#106;avascript:alert(1))', '[x](JaVa&#x09;script:alert(1))', '[x](javascript:alert(1))',
+                 '[x](vbscript&colon;msgbox(1))', '![i](data:image/svg+xml;base64,PHN2Zz4=)'):
+        # 文字参照や空白でスキームを隠しても、リンク先は "#" に置き換わる
+        assert re.search(r'(href|src)="#"', rendering.render_markdown(text)), text
+    for text, url in (('[a](https://example.com/?q=1)', 'https://example.com/?q=1'), ('[b](/lesson_page/1)', '/lesson_page/1'),
+                      ('[c](#slide-2)', '#slide-2'), ('[d](mailto:sensei@example.com)', 'mailto:sensei@example.com')):
+        assert f'href="{url}"' in rendering.render_markdown(text)
+
+
+def test_grading_log_page_loads_rendered_html_in_one_query(client, monkeypatch):
+    login(client, 'sensei')
+    student = user_id('gakusei')
+    for i in range(5):
+        text = f"採点結果{i}: $a_{i}$"
+        db.session.add(GradingLog(student_id=student, mode='general', feedback_content=text))
+        rendering.render(text)
+    db.session.commit()
+    monkeypatch.setattr(rendering, "memory", rendering._Memory(rendering.MEMORY_SIZE))
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        if 'rendered_content' in statement: statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        response = client.get('/dashboard/more/grading_logs')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    assert len(statements) == 1
+    assert RenderedContent.query.count() == 5
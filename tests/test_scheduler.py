@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+import pytest
+from scheduler import LLMScheduler, LLMUnavailable, CircuitOpen
+
+
+class ServiceUnavailable(Exception):
+    """google.api_core の同名の例外と同じくリトライ対象になる"""
+
+
+def make_scheduler(**kwargs):
+    limits = {tier: {"rpm": 6000, "burst": 100, "max_inflight": 1} for tier in ('pro', 'flash')}
+    options = dict(fallbacks={'pro': 'flash'}, max_retries=1, base_delay=0, max_delay=0,
+                   queue_timeout=5, breaker_threshold=2, breaker_reset=30)
+    options.update(kwargs)
+    return LLMScheduler(limits, **options)
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_interactive_calls_jump_ahead_of_batch():
+    scheduler = make_scheduler()
+    lane = scheduler.lanes['pro']
+    release = threading.Event()
+    order = []
+
+    holder = threading.Thread(target=scheduler.call, args=('pro', lambda use: release.wait(5)))
+    holder.start()
+    wait_until(lambda: lane.inflight == 1)
+    threads = []
+    for priority in ('batch', 'normal', 'interactive'):
+        t = threading.Thread(target=scheduler.call, args=('pro', lambda use, p=priority: order.append(p)), kwargs={'priority': priority})
+        t.start()
+        threads.append(t)
+        wait_until(lambda n=len(threads): len(lane.waiters) == n)
+    release.set()
+    for t in [holder] + threads: t.join(5)
+    assert order == ['interactive', 'normal', 'batch']
+
+
+def test_retryable_errors_open_the_breaker_and_fall_back():
+    scheduler = make_scheduler()
+    calls = []
+
+    def failing(use):
+        calls.append(use)
+        raise ServiceUnavailable()
+
+    with pytest.raises(LLMUnavailable):
+        scheduler.call('pro', failing)
+    assert calls == ['pro', 'pro']
+    assert scheduler.breakers['pro'].state == 'open'
+
+    # pro が open の間は flash に切り替え、切り替えが許されなければ即座に失敗する
+    assert scheduler.call('pro', lambda use: use) == 'flash'
+    with pytest.raises(CircuitOpen):
+        scheduler.call('pro', lambda use: use, allow_fallback=False)
+    assert scheduler.stats()['pro']['fallbacks'] == 1
+
+
+def test_breaker_half_open_probe_closes_on_success():
+    scheduler = make_scheduler(breaker_reset=0.05, fallbacks={})
+    with pytest.raises(LLMUnavailable):
+        scheduler.call('pro', lambda use: (_ for _ in ()).throw(ServiceUnavailable()))
+    with pytest.raises(CircuitOpen):
+        scheduler.call('pro', lambda use: use)
+    time.sleep(0.06)
+    assert scheduler.call('pro', lambda use: 'ok') == 'ok'
+    assert scheduler.breakers['pro'].state == 'closed'
+
+
+def test_non_retryable_errors_do_not_trip_the_breaker():
+    scheduler = make_scheduler()
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            scheduler.call('pro', lambda use: int('x'))
+    assert scheduler.breakers['pro'].state == 'closed'
+    assert scheduler.stats()['pro']['retries'] == 0
+
+
+class Interrupted(BaseException):
+    """KeyboardInterrupt やタスクの取り消しのように Exception ではない中断"""
+
+
+def open_breaker(scheduler, tier='pro'):
+    with pytest.raises(LLMUnavailable):
+        scheduler.call(tier, lambda use: (_ for _ in ()).throw(ServiceUnavailable()))
+    time.sleep(0.06)
+
+
+def test_abandoned_probe_stream_does_not_wedge_the_breaker():
+    scheduler = make_scheduler(breaker_reset=0.05, fallbacks={})
+    breaker = scheduler.breakers['pro']
+
+    # 最初の断片が届く前に中断された試行は、次の試行を妨げない
+    def interrupted(use):
+        raise Interrupted()
+        yield
+    open_breaker(scheduler)
+    with pytest.raises(Interrupted):
+        list(scheduler.stream('pro', interrupted))
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+    breaker.cancel_probe()
+
+    # 断片を受け取ってから閉じた試行は成功として扱う
+    open_breaker(scheduler)
+    stream = scheduler.stream('pro', lambda use: iter(['a', 'b']))
+    assert next(stream) == 'a'
+    stream.close()
+    assert breaker.state == 'closed'
+    assert scheduler.lanes['pro'].inflight == 0
+
+
+def test_abandoned_async_probe_stream_does_not_wedge_the_breaker():
+    scheduler = make_scheduler(breaker_reset=0.05, fallbacks={})
+
+    async def pieces(use):
+        for piece in ('a', 'b'):
+            yield piece
+
+    async def consume_first():
+        stream = scheduler.astream('pro', pieces)
+        assert await stream.__anext__() == 'a'
+        await stream.aclose()
+
+    open_breaker(scheduler)
+    asyncio.run(consume_first())
+    assert scheduler.breakers['pro'].state == 'closed'
+    assert scheduler.breakers['pro'].allow()
+    assert scheduler.lanes['pro'].inflight == 0
+
+
+def test_cancelled_acall_releases_its_slot_and_probe():
+    scheduler = make_scheduler(breaker_reset=0.05, fallbacks={})
+    breaker = scheduler.breakers['pro']
+
+    async def scenario():
+        entered = asyncio.Event()
+
+        async def slow(use):
+            entered.set()
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(scheduler.acall('pro', slow))
+        await entered.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    open_breaker(scheduler)
+    asyncio.run(scenario())
+    assert scheduler.lanes['pro'].inflight == 0
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+
+
+def test_interrupted_call_releases_its_slot_and_probe():
+    scheduler = make_scheduler(breaker_reset=0.05, fallbacks={})
+    breaker = scheduler.breakers['pro']
+
+    def interrupted(use):
+        raise Interrupted()
+
+    open_breaker(scheduler)
+    with pytest.raises(Interrupted):
+        scheduler.call('pro', interrupted)
+    assert scheduler.lanes['pro'].inflight == 0
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
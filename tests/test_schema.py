@@ -0,0 +1,50 @@
+from sqlalchemy import inspect, text
+from conftest import user_id
+from models import db, ensure_schema, insert_or_get, Assignment, GradingJob, LessonLog
+
+
+def make_assignment():
+    assignment = Assignment(title='t', description='d', created_by=user_id('sensei'))
+    db.session.add(assignment)
+    db.session.commit()
+    return assignment.id
+
+
+def test_insert_or_get_returns_the_row_another_request_created(app):
+    assignment_id, student = make_assignment(), user_id('gakusei')
+    # 別のリクエストが先にコミットした行（このセッションはまだ知らない）
+    with db.engine.begin() as conn:
+        conn.execute(text("INSERT INTO lesson_log (assignment_id, student_id, slides_content) VALUES (:a, :s, '')"),
+                     {"a": assignment_id, "s": student})
+    inserted = []
+    row = insert_or_get(LessonLog, {"assignment_id": assignment_id, "student_id": student},
+                        on_insert=lambda r: inserted.append(r))
+    assert row.id is not None
+    assert inserted == []
+    assert LessonLog.query.filter_by(assignment_id=assignment_id).count() == 1
+
+    # 2回目も同じ行が返る
+    assert insert_or_get(LessonLog, {"assignment_id": assignment_id, "student_id": student}).id == row.id
+
+
+def test_ensure_schema_adds_missing_columns_and_dedupes_before_unique_index(app):
+    assignment_id, student = make_assignment(), user_id('gakusei')
+    # この機能より前のデータベース: 一意インデックスも新しい列もなく、同時クリックによる重複がある
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP INDEX ux_lesson_log_assignment_student'))
+        conn.execute(text('ALTER TABLE grading_job DROP COLUMN owner'))
+        for body in ('first', 'second', 'third'):
+            conn.execute(text("INSERT INTO lesson_log (assignment_id, student_id, slides_content) VALUES (:a, :s, :b)"),
+                         {"a": assignment_id, "s": student, "b": body})
+    db.session.remove()
+
+    ensure_schema()
+    ensure_schema()  # 何度実行しても安全
+
+    inspector = inspect(db.engine)
+    assert 'owner' in {c['name'] for c in inspector.get_columns('grading_job')}
+    assert 'ux_lesson_log_assignment_student' in {i['name'] for i in inspector.get_indexes('lesson_log')}
+    logs = LessonLog.query.filter_by(assignment_id=assignment_id).all()
+    assert [log.slides_content for log in logs] == ['first']
+    db.session.add(GradingJob(id='j', mode='report', owner='host:1'))
+    db.session.commit()
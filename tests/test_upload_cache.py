@@ -0,0 +1,83 @@
+import io
+import os
+import time
+from werkzeug.datastructures import FileStorage
+import upload_cache
+from conftest import login
+
+
+def upload(data, name='a.png'):
+    return FileStorage(stream=io.BytesIO(data), filename=name, content_type='image/png')
+
+
+def make_cache(tmp_path, **config):
+    cache = upload_cache.UploadCache()
+    cache.directory = str(tmp_path)
+    cache.max_bytes = 1024 * 1024
+    cache.answer_ttl = config.get('answer_ttl', 3600)
+    cache.remote_ttl, cache.remote_max_entries = 3600, 16
+    cache._last_sweep = 0.0
+    return cache
+
+
+def cached_files(cache):
+    return [n for n in os.listdir(cache.directory) if not n.startswith('.')]
+
+
+def test_shared_images_are_deduplicated_and_kept(tmp_path):
+    cache = make_cache(tmp_path)
+    first = cache.spool(upload(b'problem'), shared=True)
+    second = cache.spool(upload(b'problem'), shared=True)
+    assert first.digest == second.digest
+    # リクエストごとのファイルはキャッシュ本体と同じ実体を指す
+    assert cached_files(cache) == [first.digest]
+    assert os.stat(first.path).st_ino == os.stat(second.path).st_ino == os.stat(tmp_path / first.digest).st_ino
+    cache.release([first, second])
+    assert os.listdir(tmp_path) == [first.digest]
+
+
+def test_evicted_shared_image_stays_readable_until_released(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.max_bytes = 10
+    queued = cache.spool(upload(b'problem one'), shared=True)
+    # 採点ジョブが待っている間に、別の画像で本体が追い出される
+    cache.spool(upload(b'problem two'), shared=True)
+    assert queued.digest not in cached_files(cache)
+    assert queued.read() == b'problem one'
+    cache.release([queued])
+    assert not os.path.exists(queued.path)
+
+
+def test_answer_images_are_removed_after_release(tmp_path):
+    cache = make_cache(tmp_path)
+    # 同じ内容の解答でも生徒ごとに別ファイルなので、片方を消してももう片方は使える
+    mine = cache.spool(upload(b'answer'))
+    theirs = cache.spool(upload(b'answer'))
+    assert mine.path != theirs.path
+    cache.release(["text", mine])
+    assert not os.path.exists(mine.path)
+    assert theirs.read() == b'answer'
+
+
+def test_abandoned_answer_images_expire(tmp_path):
+    cache = make_cache(tmp_path, answer_ttl=60)
+    old = cache.spool(upload(b'left behind'))
+    past = time.time() - 120
+    os.utime(old.path, (past, past))
+    cache._last_sweep = 0.0
+    fresh = cache.spool(upload(b'new'))
+    assert not os.path.exists(old.path)
+    assert os.path.exists(fresh.path)
+
+
+def test_grading_request_leaves_only_shared_images(app, client):
+    login(client)
+    response = client.post('/api/general_grading', data={
+        'mode': 'problem',
+        'problem_images': (io.BytesIO(b'problem'), 'q.png'),
+        'student_images': (io.BytesIO(b'answer'), 'a.png'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200, response.json
+    # 残るのは共有の画像の本体だけ
+    assert len(cached_files(upload_cache.cache)) == 1
+    assert all(not n.startswith('.') for n in os.listdir(upload_cache.cache.directory))
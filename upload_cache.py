@@ -0,0 +1,175 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from gen_cache import SingleFlight
+
+# --- アップロード画像のキャッシュ ---
+# 問題採点では、クラス全員が同じ問題・模範解答の画像を送ってくる。
+#   1. 画像はメモリに読み込まず、SHA-256を計算しながらディスクへ書き出す（同じ内容は1ファイルにまとめる）
+#   2. バックエンドがファイルストアに対応していれば1回だけアップロードし、以降はハンドルで参照する
+# ディスク上のファイルは更新日時によるLRUで合計サイズを、リモートのハンドルは有効期限と件数で制限する。
+# 生徒ごとの解答画像は他の生徒と共有されないのでまとめず、採点が終わったら release() で消す。
+# 共有の画像も、採点に渡すのはリクエストごとのハードリンクにする。待ち行列にいる間に本体が LRU で
+# 消されても中身は残り、release() でリンクを外せばディスクから消える（参照カウントをファイルシステムに任せる）。
+# プロセスが落ちるなどして消し損ねたものは、UPLOAD_ANSWER_TTL 秒を過ぎたら次の書き出しのついでに消す。
+
+CHUNK_SIZE = 64 * 1024
+ANSWER_PREFIX = '.answer-'
+SWEEP_INTERVAL = 60  # 古い解答画像を探す間隔(秒)
+
+
+class CachedImage:
+    """ディスクに保存済みの画像への参照（ジョブキューにはバイト列ではなくこれを渡す）"""
+
+    def __init__(self, digest, path, mime_type, size, shared):
+        self.digest = digest
+        self.path = path
+        self.mime_type = mime_type
+        self.size = size
+        self.shared = shared  # 複数の生徒で共有される画像（問題・模範解答）ならリモートにアップロードする
+        # path はこのリクエスト専用のファイル（共有の画像ならキャッシュ本体へのハードリンク）。release() で消す
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+class UploadCache:
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._remote = OrderedDict()   # digest -> (ハンドル, 有効期限)
+        self._flight = SingleFlight()
+        if app is not None: self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config.get('UPLOAD_CACHE_DIR') or os.path.join(app.instance_path, 'upload_cache')
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = int(app.config.get('UPLOAD_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+        # Gemini のファイルストアは48時間で削除されるので少し手前で期限切れにする
+        self.remote_ttl = float(app.config.get('UPLOAD_REMOTE_TTL', 47 * 3600))
+        self.remote_max_entries = int(app.config.get('UPLOAD_REMOTE_MAX_ENTRIES', 256))
+        # 採点ジョブの待ち時間より十分長くする
+        self.answer_ttl = float(app.config.get('UPLOAD_ANSWER_TTL', 6 * 3600))
+        self._last_sweep = 0.0
+
+    # --- ディスクへの書き出し ---
+    def spool(self, storage, shared=False):
+        """werkzeug の FileStorage をチャンク単位でハッシュしながらディスクへ書き出し、CachedImage を返す"""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.spool-' if shared else ANSWER_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = storage.stream.read(CHUNK_SIZE)
+                    if not chunk: break
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            self._sweep()
+            if shared: self._share(tmp_path, os.path.join(self.directory, digest.hexdigest()))
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        return CachedImage(digest.hexdigest(), tmp_path, storage.mimetype or "image/jpeg", size, shared)
+
+    def _share(self, tmp_path, path):
+        """書き出したファイルをキャッシュ本体と同じ実体にする（tmp_path はこのリクエスト用のリンクとして残る）"""
+        try:
+            # 既にあれば本体へリンクし直して、書き出した分の容量を返す
+            os.link(path, tmp_path + '.link')
+            os.replace(tmp_path + '.link', tmp_path)
+            os.utime(path)  # 最近使われたものとして更新日時を進める
+            return
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return  # ハードリンクが使えないファイルシステムでは、このリクエスト用のコピーをそのまま使う
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return  # 同時に別のリクエストが保存した
+        except OSError:
+            return
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        # 複数のワーカープロセスで同じディレクトリを使うので、メモリ上の索引ではなく更新日時で判断する
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.'): continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            if path == keep: continue
+            _remove(path)
+            total -= size
+
+    def release(self, contents):
+        """モデル呼び出しが終わった contents の画像をこのリクエスト用のファイルごと消す（共有の画像の本体はキャッシュに残る）"""
+        if isinstance(contents, str): return
+        for c in contents:
+            if isinstance(c, CachedImage): _remove(c.path)
+
+    def _sweep(self):
+        now = time.time()
+        if now - self._last_sweep < SWEEP_INTERVAL: return
+        self._last_sweep = now
+        for name in os.listdir(self.directory):
+            if not name.startswith((ANSWER_PREFIX, '.spool-')): continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(path).st_mtime > self.answer_ttl: _remove(path)
+            except FileNotFoundError:
+                pass
+
+    # --- モデルへ渡す形式への変換 ---
+    def resolve(self, contents, backend):
+        """contents 内の CachedImage を、リモートのハンドルまたはインラインのバイト列に置き換える"""
+        if isinstance(contents, str): return contents
+        return [self._part(c, backend) if isinstance(c, CachedImage) else c for c in contents]
+
+    def _part(self, image, backend):
+        if image.shared and backend.supports_file_upload:
+            return self._remote_handle(image, backend)
+        return {"mime_type": image.mime_type, "data": image.read()}
+
+    def _remote_handle(self, image, backend):
+        now = time.time()
+        with self._lock:
+            entry = self._remote.get(image.digest)
+            if entry and entry[1] > now:
+                self._remote.move_to_end(image.digest)
+                return entry[0]
+        # 同じ画像のアップロードが同時に来ても1回にまとめる
+        handle = self._flight.do(image.digest, lambda: backend.upload_file(image.path, image.mime_type))
+        with self._lock:
+            self._remote[image.digest] = (handle, now + self.remote_ttl)
+            self._remote.move_to_end(image.digest)
+            while len(self._remote) > self.remote_max_entries:
+                self._remote.popitem(last=False)
+        return handle
+
+    def stats(self):
+        with self._lock:
+            return {"remote_handles": len(self._remote)}
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+cache = UploadCache()